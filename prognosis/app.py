@@ -2,22 +2,14 @@ import streamlit as st
 import datetime as dt
 import numpy as np
 import model_utils as mu
+import forecast_cache as fc
+import monte_carlo as mc
 import plotly.graph_objects as go
 import plotly.offline as py_offline
 import cufflinks as cf
 cf.go_offline()
 py_offline.__PLOTLY_OFFLINE_INITIALIZED = True
 
-mu.DEATH_RATE = 0.36
-mu.ICU_RATE = 0.78
-mu.HOSPITAL_RATE = 2.18
-mu.SYMPTOM_RATE = 10.2
-mu.INFECT_2_HOSPITAL_TIME = 11
-mu.HOSPITAL_2_ICU_TIME = 4
-mu.ICU_2_DEATH_TIME = 4
-mu.ICU_2_RECOVER_TIME = 7
-mu.NOT_ICU_DISCHARGE_TIME = 5
-
 st.title('Covid-19 Prediction')
 hide_menu_style = """
         <style>
@@ -28,16 +20,22 @@ st.markdown(hide_menu_style, unsafe_allow_html=True)
 st.markdown('COVID-19:  The prognosis for next 2 months. '
             ' How many hospital beds or ICU needed? In every countries and US states. ')
 
-def main(scope, local, lockdown_date, forecast_horizon, forecast_fun, debug_fun, metrics, show_debug, show_data,
-         back_test, last_data_date):
+def main(scope, local, lockdown_date, forecast_horizon, forecast_fun, debug_fun, interval_fun, metrics, show_debug,
+         show_data, back_test, last_data_date, params):
     data_load_state = st.text('Forecasting...')
     try:
         daily, cumulative, model_beta = forecast_fun(local,
                                                      forecast_horizon=forecast_horizon, lockdown_date=lockdown_date,
-                                                     back_test=back_test, last_data_date=last_data_date)
+                                                     back_test=back_test, last_data_date=last_data_date,
+                                                     params=params)
+        _, cumulative_quantiles = interval_fun(local, forecast_horizon=forecast_horizon, lockdown_date=lockdown_date,
+                                               back_test=back_test, last_data_date=last_data_date, params=params)
     except ValueError:
         st.error('Not enough fatality data to provide prognosis, please check input and lockdown date')
         return None
+    # Sum of daily bounds overstates the spread of the cumulative death, use the bounds of the sampled paths
+    cumulative['lower_bound'] = cumulative_quantiles[('predicted_death', mc.QUANTILES[0])]
+    cumulative['upper_bound'] = cumulative_quantiles[('predicted_death', mc.QUANTILES[-1])]
     data_load_state.text('Forecasting... done!')
 
     st.subheader('Deaths')
@@ -133,7 +131,7 @@ def main(scope, local, lockdown_date, forecast_horizon, forecast_fun, debug_fun,
 
     if show_debug:
         log_fit, _ = debug_fun(local, forecast_horizon=forecast_horizon, lockdown_date=lockdown_date,
-                               back_test=back_test, last_data_date=last_data_date)
+                               back_test=back_test, last_data_date=last_data_date, params=params)
         fig = log_fit.rename(columns={'death':'observed', 'predicted_death': 'predicted'})\
             .drop(columns=['lower_bound', 'upper_bound'], errors='ignore').iplot(asFigure=True)
         x = log_fit.index
@@ -264,6 +262,26 @@ def main(scope, local, lockdown_date, forecast_horizon, forecast_fun, debug_fun,
             line=dict(dash='solid'),
             selector=dict(name=observe_ln)
         )
+    for resource in ['hospital_beds', 'ICU']:
+        fig.add_trace(go.Scatter(
+            x=cumulative_quantiles.index,
+            y=cumulative_quantiles[(resource, mc.QUANTILES[-1])].values,
+            fill=None,
+            line_color='rgba(128,128,128,0)',
+            legendgroup=resource + ' CI',
+            showlegend=False,
+            visible='legendonly' if resource in metrics else True,
+            name=resource + ' upper bound'))
+
+        fig.add_trace(go.Scatter(
+            x=cumulative_quantiles.index,
+            y=cumulative_quantiles[(resource, mc.QUANTILES[0])].values,
+            fill='tonexty',
+            fillcolor='rgba(128,128,128,0.1)',
+            line_color='rgba(128,128,128,0)',
+            legendgroup=resource + ' CI',
+            visible='legendonly' if resource in metrics else True,
+            name=resource + ' 95% interval'))
     if back_test:
         max_y = np.nanmax(y_upper)
         fig.add_trace(go.Scatter(
@@ -295,6 +313,23 @@ def main(scope, local, lockdown_date, forecast_horizon, forecast_fun, debug_fun,
         st.write('Cumulative metrics', cumulative)
     mu.append_row_2_logs([dt.datetime.today(), scope, local, model_beta], 'logs/fitted_models.csv')
 
+
+def get_default_lockdown_date(lockdown_date, estimate_fun, local):
+    '''Lockdown date of the table. When the region is not in the table and the user asks for it, the date estimated
+    from the death curve, shown with its standard error so it is not mistaken for a date of the table'''
+    if lockdown_date is not None or not st.sidebar.checkbox('Estimate unknown lockdown date from data', value=False):
+        return lockdown_date
+    try:
+        estimate = estimate_fun(local)
+    except ValueError as e:
+        st.sidebar.warning('No lockdown date can be estimated: {}'.format(e))
+        return None
+    st.sidebar.info('{} is not in the lockdown table, lockdown date estimated from the death curve: {} (standard '
+                    'error {:.1f} days, 95% range {} to {})'.format(
+                        local, estimate.lockdown_date.date(), estimate.std_error_days, estimate.lower_date.date(),
+                        estimate.upper_date.date()))
+    return estimate.lockdown_date.date()
+
 scope = st.sidebar.selectbox('Country or US State', ['Country', 'State'], index=0)
 if scope=='Country':
     #data_load_state = st.text('Loading data...')
@@ -302,18 +337,22 @@ if scope=='Country':
     #data_load_state.text('Loading data... done!')
     local = st.sidebar.selectbox('Which country do you like to see prognosis', death_data.Country.unique(), index=156)
     lockdown_date = st.sidebar.date_input('When did full lockdown happen? Very IMPORTANT to get accurate prediction',
-                                          mu.get_lockdown_date_by_country(local))
-    forecast_fun = mu.get_metrics_by_country
-    debug_fun = mu.get_log_daily_predicted_death_by_country
+                                          get_default_lockdown_date(mu.get_lockdown_date_by_country(local),
+                                                                    fc.estimate_lockdown_date_by_country, local))
+    forecast_fun = fc.get_metrics_by_country
+    debug_fun = fc.get_log_daily_predicted_death_by_country
+    interval_fun = fc.get_metric_quantiles_by_country
 else:
     #data_load_state = st.text('Loading data...')
     death_data = mu.get_data(scope='US', type='deaths')
     #data_load_state.text('Loading data... done!')
     local = st.sidebar.selectbox('Which US state do you like to see prognosis', death_data.State.unique(), index=9)
     lockdown_date = st.sidebar.date_input('When did full lockdown happen? Very IMPORTANT to get accurate prediction',
-                                          mu.get_lockdown_date_by_state_US(local))
-    forecast_fun = mu.get_metrics_by_state_US
-    debug_fun = mu.get_log_daily_predicted_death_by_state_US
+                                          get_default_lockdown_date(mu.get_lockdown_date_by_state_US(local),
+                                                                    fc.estimate_lockdown_date_by_state_US, local))
+    forecast_fun = fc.get_metrics_by_state_US
+    debug_fun = fc.get_log_daily_predicted_death_by_state_US
+    interval_fun = fc.get_metric_quantiles_by_state_US
 
 
 
@@ -322,27 +361,33 @@ else:
 forecast_horizon = st.sidebar.slider('Forecast Horizon', value=60, min_value=30, max_value=90)
 show_debug = st.sidebar.checkbox('Show fitted log death', value=True)
 show_data = st.sidebar.checkbox('Show raw output data')
+# Every session builds its own parameters, module globals are shared by all sessions of the app process
+params = mu.ModelParams()
 if st.sidebar.checkbox('Advance: change assumptions'):
     if st.sidebar.checkbox('Change rates'):
-        mu.DEATH_RATE = st.sidebar.slider('Overall death rate', value=mu.DEATH_RATE,
-                                       min_value=0.01, max_value=10.0, step=0.01)
-        mu.ICU_RATE = st.sidebar.slider('ICU rate', value=max(mu.ICU_RATE, mu.DEATH_RATE),
-                                       min_value=mu.DEATH_RATE, max_value=15.0, step=0.01)
-        mu.HOSPITAL_RATE = st.sidebar.slider('Hospitalized rate', value=max(mu.ICU_RATE, mu.HOSPITAL_RATE),
-                                       min_value=mu.ICU_RATE, max_value=20.0, step=0.01)
-        mu.SYMPTOM_RATE = st.sidebar.slider('Symptomatic rate', value=max(mu.SYMPTOM_RATE, mu.HOSPITAL_RATE),
-                                       min_value=mu.HOSPITAL_RATE, max_value=25.0, step=0.01)
+        params = params.replace(DEATH_RATE=st.sidebar.slider('Overall death rate', value=params.DEATH_RATE,
+                                                             min_value=0.01, max_value=10.0, step=0.01))
+        params = params.replace(ICU_RATE=st.sidebar.slider('ICU rate', value=max(params.ICU_RATE, params.DEATH_RATE),
+                                                           min_value=params.DEATH_RATE, max_value=15.0, step=0.01))
+        params = params.replace(HOSPITAL_RATE=st.sidebar.slider('Hospitalized rate',
+                                                                value=max(params.ICU_RATE, params.HOSPITAL_RATE),
+                                                                min_value=params.ICU_RATE, max_value=20.0, step=0.01))
+        params = params.replace(SYMPTOM_RATE=st.sidebar.slider('Symptomatic rate',
+                                                               value=max(params.SYMPTOM_RATE, params.HOSPITAL_RATE),
+                                                               min_value=params.HOSPITAL_RATE, max_value=25.0,
+                                                               step=0.01))
     if st.sidebar.checkbox('Change time'):
-        mu.INFECT_2_HOSPITAL_TIME = st.sidebar.slider('Time to hospitalized since infected',
-                                                      value=mu.INFECT_2_HOSPITAL_TIME, min_value=1, max_value=21)
-        mu.HOSPITAL_2_ICU_TIME = st.sidebar.slider('Time to ICU since hospitalized',
-                                                      value=mu.HOSPITAL_2_ICU_TIME, min_value=1, max_value=21)
-        mu.ICU_2_DEATH_TIME = st.sidebar.slider('Time to death since ICU ',
-                                                      value=mu.ICU_2_DEATH_TIME, min_value=1, max_value=21)
-        mu.ICU_2_RECOVER_TIME = st.sidebar.slider('Time to recover since ICU ',
-                                                      value=mu.ICU_2_RECOVER_TIME, min_value=1, max_value=30)
-        mu.NOT_ICU_DISCHARGE_TIME = st.sidebar.slider('Time to discharge',
-                                                      value=mu.NOT_ICU_DISCHARGE_TIME, min_value=1, max_value=21)
+        params = params.replace(
+            INFECT_2_HOSPITAL_TIME=st.sidebar.slider('Time to hospitalized since infected',
+                                                     value=params.INFECT_2_HOSPITAL_TIME, min_value=1, max_value=21),
+            HOSPITAL_2_ICU_TIME=st.sidebar.slider('Time to ICU since hospitalized',
+                                                  value=params.HOSPITAL_2_ICU_TIME, min_value=1, max_value=21),
+            ICU_2_DEATH_TIME=st.sidebar.slider('Time to death since ICU ',
+                                               value=params.ICU_2_DEATH_TIME, min_value=1, max_value=21),
+            ICU_2_RECOVER_TIME=st.sidebar.slider('Time to recover since ICU ',
+                                                 value=params.ICU_2_RECOVER_TIME, min_value=1, max_value=30),
+            NOT_ICU_DISCHARGE_TIME=st.sidebar.slider('Time to discharge',
+                                                     value=params.NOT_ICU_DISCHARGE_TIME, min_value=1, max_value=21))
 metrics = ['infected']
 if st.sidebar.checkbox('Hide some metrics'):
     metrics = st.sidebar.multiselect('Which metrics you like to be invisible by default?',
@@ -356,11 +401,12 @@ if back_test:
     'Run back test with data up to', last_data_date
 
 if st.sidebar.button('Run'):
-    main(scope, local, lockdown_date, forecast_horizon, forecast_fun, debug_fun, metrics, show_debug,show_data,
-         back_test, last_data_date)
-    model_params = [dt.datetime.today(), scope, local, lockdown_date, mu.DEATH_RATE, mu.ICU_RATE, mu.HOSPITAL_RATE,
-                    mu.SYMPTOM_RATE, mu.INFECT_2_HOSPITAL_TIME, mu.HOSPITAL_2_ICU_TIME, mu.ICU_2_DEATH_TIME, 
-                    mu.ICU_2_RECOVER_TIME, mu.NOT_ICU_DISCHARGE_TIME, back_test, last_data_date]
+    main(scope, local, lockdown_date, forecast_horizon, forecast_fun, debug_fun, interval_fun, metrics, show_debug,
+         show_data, back_test, last_data_date, params)
+    model_params = [dt.datetime.today(), scope, local, lockdown_date, params.DEATH_RATE, params.ICU_RATE,
+                    params.HOSPITAL_RATE, params.SYMPTOM_RATE, params.INFECT_2_HOSPITAL_TIME,
+                    params.HOSPITAL_2_ICU_TIME, params.ICU_2_DEATH_TIME, params.ICU_2_RECOVER_TIME,
+                    params.NOT_ICU_DISCHARGE_TIME, back_test, last_data_date]
     mu.append_row_2_logs(model_params)
 st.sidebar.subheader('Authors')
 st.sidebar.info(
@@ -0,0 +1,281 @@
+import os
+import time
+import datetime as dt
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import model_utils as mu
+import huber as hb
+import batch_forecast as bf
+
+BACKTEST_COLUMNS = ['date', 'death', 'predicted_death', 'lower_bound', 'upper_bound', 'hospital_beds', 'ICU',
+                    'observed_hospital_beds', 'observed_ICU']
+
+
+def get_observed_occupancy(local_death_data, params=None):
+    '''Beds and ICU implied by the deaths that were actually reported, the reference for back test errors'''
+    daily_local_death_new = mu.get_daily_data(local_death_data)
+    daily_local_death_new = daily_local_death_new.reindex(
+        pd.date_range(daily_local_death_new.index[0], daily_local_death_new.index[-1]), fill_value=0)
+    return (mu.get_number_hospital_beds_need(daily_local_death_new, params=params)['hospital_beds'],
+            mu.get_number_ICU_need(daily_local_death_new, params=params)['ICU'])
+
+
+def fit_cutoffs(A, y, finite, n_rows, outliers):
+    '''Fixed breakpoint least squares of every cutoff. Cutoff c uses the first n_rows[c] rows of A and y without
+    non finite values and its outliers. The normal equations of all prefixes come from one running sum over the
+    rows, outliers are then removed from each prefix by a downdate. Return beta, the pseudo inverse of the normal
+    matrix (as pwlf uses for the prediction variance) and the mask of the rows fitted by every cutoff'''
+    y = np.where(finite, y, 0)
+    rows = A * finite[:, None]
+    AtA = np.cumsum(np.einsum('ip,iq->ipq', rows, rows), axis=0)[n_rows - 1]
+    Aty = np.cumsum(rows * y[:, None], axis=0)[n_rows - 1]
+    in_prefix = (np.arange(len(y))[None, :] < n_rows[:, None]) & finite[None, :]
+    removed = (in_prefix & outliers).astype(float)
+    AtA -= np.einsum('ci,ip,iq->cpq', removed, A, A)
+    Aty -= np.einsum('ci,ip->cp', removed, A * y[:, None])
+    AtA_inv = np.linalg.pinv(AtA)
+    # Minimum norm solution, same as the lstsq of pwlf when a segment has no data yet
+    beta = np.einsum('cpq,cq->cp', AtA_inv, Aty)
+    return beta, AtA_inv, in_prefix & ~outliers
+
+
+def get_variance(A, y, in_fit, beta):
+    '''Unbiased residual variance of every cutoff'''
+    residual = (np.einsum('ip,cp->ci', A, beta) - np.where(np.isfinite(y), y, 0)[None, :]) * in_fit
+    return np.einsum('ci,ci->c', residual, residual) / (in_fit.sum(axis=1) - A.shape[1])
+
+
+def get_backtest_forecasts(local_death_data, cutoffs, forecast_horizon=60, lockdown_date=None, params=None):
+    '''Forecast of every cutoff date as get_daily_metrics_from_death_data makes it with the data up to the cutoff,
+    compared with what happened in the forecast_horizon days after the cutoff.
+    All transforms of the death series are causal, so every cutoff works on a prefix of the same arrays: the robust
+    fits of all cutoffs run as one batch and the regression of each extra day is a running sum update.
+    Return the forecasts indexed by (cutoff, horizon) and the error message of the cutoffs that could not be
+    forecast'''
+    backtest, (x, y, mask) = prepare_backtest(local_death_data, cutoffs, forecast_horizon, lockdown_date, params=params)
+    _, _, _, outliers = hb.fit_huber(x, y, mask)
+    return finish_backtest(backtest, outliers)
+
+
+def prepare_backtest(local_death_data, cutoffs, forecast_horizon=60, lockdown_date=None, params=None):
+    '''get_backtest_forecasts up to the robust fits. Return the state of the back test for finish_backtest and the
+    (x, y, mask) rows of the robust fits, the curve before lockdown of every cutoff then the curve after lockdown'''
+    params = params or mu.get_default_params()
+    local_death_data = local_death_data.sort_index()
+    dates = local_death_data.index
+    cutoffs = pd.DatetimeIndex(sorted(set(pd.to_datetime(cutoffs))))
+    n_rows = np.searchsorted(dates.values, cutoffs.values, side='right')
+    errors = {cutoff: 'ValueError: No fatality data before the cutoff' for cutoff in cutoffs[n_rows == 0]}
+    cutoffs = cutoffs[n_rows > 0]
+    n_rows = n_rows[n_rows > 0]
+    backtest = {'local_death_data': local_death_data, 'cutoffs': cutoffs, 'n_rows': n_rows, 'errors': errors,
+                'forecast_horizon': forecast_horizon, 'params': params}
+    if len(cutoffs) == 0:
+        return backtest, (np.zeros((0, len(dates))), np.zeros((0, len(dates))), np.zeros((0, len(dates)), dtype=bool))
+    daily_local_death_new = mu.get_daily_data(local_death_data)
+    with np.errstate(divide='ignore'):
+        log_daily_death = np.log(daily_local_death_new.rolling(3, min_periods=1).mean().values[:, 0])
+    finite = np.isfinite(log_daily_death)
+    day = (dates - dates[0]).days.values
+    end_day = day[n_rows - 1]
+    delay = params.INFECT_2_HOSPITAL_TIME + params.HOSPITAL_2_ICU_TIME + params.ICU_2_DEATH_TIME
+    if lockdown_date is None:
+        effective_day = end_day + forecast_horizon + delay
+    else:
+        effective_day = np.full(len(cutoffs), (pd.to_datetime(lockdown_date) + dt.timedelta(delay) - dates[0]).days)
+    # Same model and outlier segments of every cutoff as fit_log_daily_death
+    branch = mu.get_model_branch(end_day - effective_day, forecast_horizon)
+
+    # Outliers of the curves before and after lockdown, every cutoff in one batch
+    time_idx = day[None, :] - effective_day[:, None]
+    in_prefix = (np.arange(len(dates))[None, :] < n_rows[:, None]) & finite[None, :]
+    before, after = mu.get_outlier_segments(time_idx, branch)
+    before, after = before & in_prefix, after & in_prefix
+    backtest.update(daily_local_death_new=daily_local_death_new, log_daily_death=log_daily_death, finite=finite,
+                    day=day, end_day=end_day, effective_day=effective_day, branch=branch, before=before, after=after)
+    return backtest, (np.concatenate([time_idx, time_idx]),
+                      np.tile(np.where(finite, log_daily_death, 0), (2 * len(cutoffs), 1)),
+                      np.concatenate([before, after]))
+
+
+def finish_backtest(backtest, outliers):
+    '''get_backtest_forecasts from the result of prepare_backtest and the outliers of its robust fits'''
+    local_death_data, cutoffs, n_rows, errors, forecast_horizon, params = [
+        backtest[name] for name in ['local_death_data', 'cutoffs', 'n_rows', 'errors', 'forecast_horizon', 'params']]
+    if len(cutoffs) == 0:
+        return (pd.DataFrame(columns=BACKTEST_COLUMNS, index=pd.MultiIndex.from_arrays(
+            [pd.DatetimeIndex([]), np.array([], dtype=int)], names=['cutoff', 'horizon'])),
+            pd.Series(errors, dtype=object).sort_index())
+    daily_local_death_new, log_daily_death, finite, day, end_day, effective_day, branch, before, after = [
+        backtest[name] for name in ['daily_local_death_new', 'log_daily_death', 'finite', 'day', 'end_day',
+                                    'effective_day', 'branch', 'before', 'after']]
+    dates = local_death_data.index
+    outliers = outliers[:len(cutoffs)] | outliers[len(cutoffs):]
+    empty = ~before.any(axis=1) | (~after.any(axis=1) & (branch == mu.TWO_SEGMENTS))
+    for cutoff in cutoffs[empty]:
+        errors[cutoff] = 'ValueError: Not enough fatality data to fit the death curve'
+
+    forecast_days = np.arange(end_day.max() + forecast_horizon + 1)
+    log_predicted = np.full((len(cutoffs), len(forecast_days)), np.nan)
+    log_predicted_var = np.full(log_predicted.shape, np.nan)
+    for lockdown_model in [False, True]:
+        group = np.flatnonzero(((branch != mu.NO_LOCKDOWN) == lockdown_model) & ~empty)
+        if len(group) == 0:
+            continue
+        # The lockdown breakpoint is the same for every cutoff, so they all share one regression matrix
+        A = np.stack([np.ones(len(day)), day] + [np.maximum(day - effective_day[group[0]], 0)] * lockdown_model,
+                     axis=1).astype(float)
+        A_forecast = np.stack([np.ones(len(forecast_days)), forecast_days] +
+                              [np.maximum(forecast_days - effective_day[group[0]], 0)] * lockdown_model,
+                              axis=1).astype(float)
+        beta, AtA_inv, in_fit = fit_cutoffs(A, log_daily_death, finite, n_rows[group], outliers[group])
+        # Not enough data after lockdown, second slope is the default value
+        beta[branch[group] == mu.DEFAULT_SECOND_MODEL, -1] = mu.DEFAULT_SECOND_SLOPE
+        variance = get_variance(A, log_daily_death, in_fit, beta)
+        log_predicted[group] = np.einsum('dp,cp->cd', A_forecast, beta)
+        log_predicted_var[group] = variance[:, None] * np.einsum('dp,cpq,dq->cd', A_forecast, AtA_inv, A_forecast)
+        oos_step_variance = np.where(branch[group] == mu.TWO_SEGMENTS, np.nan, variance)
+        log_predicted_var[group] = np.where(
+            forecast_days[None, :] > end_day[group, None],
+            mu.get_out_of_sample_variance(log_predicted_var[group], oos_step_variance, forecast_days, end_day[group]),
+            log_predicted_var[group])
+
+    in_forecast = forecast_days[None, :] <= (end_day + forecast_horizon)[:, None]
+    predicted = np.where(in_forecast, np.exp(log_predicted), 0)
+    beds_window = mu.get_hospital_beds_window(params=params)
+    ICU_window = mu.get_ICU_window(params=params)
+    # Padding after the last forecast day of a cutoff only adds occupancy after its own window
+    hospital_beds = mu.convolve_occupancy(predicted, *mu.get_hospital_beds_kernel(params=params), beds_window)
+    ICU_n = mu.convolve_occupancy(predicted, *mu.get_ICU_kernel(params=params), ICU_window)
+
+    kept = ~empty
+    horizons = np.arange(1, forecast_horizon + 1)
+    forecast_day = end_day[kept, None] + horizons[None, :]
+    rows = np.arange(len(cutoffs))[kept, None]
+    forecast_dates = dates[0] + pd.to_timedelta(forecast_day.ravel(), unit='D')
+    observed_beds, observed_ICU = get_observed_occupancy(local_death_data, params=params)
+    forecasts = {'date': forecast_dates,
+                 'death': daily_local_death_new.iloc[:, 0].reindex(forecast_dates).values,
+                 'predicted_death': np.exp(log_predicted[rows, forecast_day]).ravel(),
+                 'lower_bound': np.exp(log_predicted[rows, forecast_day] -
+                                       1.96 * np.sqrt(log_predicted_var[rows, forecast_day])).ravel(),
+                 'upper_bound': np.exp(log_predicted[rows, forecast_day] +
+                                       1.96 * np.sqrt(log_predicted_var[rows, forecast_day])).ravel()}
+    for column, occupancy, window in [('hospital_beds', hospital_beds, beds_window), ('ICU', ICU_n, ICU_window)]:
+        position = forecast_day - window[0]
+        n_days = end_day[kept, None] + forecast_horizon + 1 + window[1] - window[0]
+        forecasts[column] = np.where((position >= 0) & (position < n_days),
+                                     occupancy[rows, np.clip(position, 0, occupancy.shape[1] - 1)], np.nan).ravel()
+    forecasts['observed_hospital_beds'] = observed_beds.reindex(forecast_dates).values
+    forecasts['observed_ICU'] = observed_ICU.reindex(forecast_dates).values
+    forecasts = pd.DataFrame(forecasts, columns=BACKTEST_COLUMNS, index=pd.MultiIndex.from_arrays(
+        [np.repeat(cutoffs[kept], forecast_horizon), np.tile(horizons, kept.sum())], names=['cutoff', 'horizon']))
+    return forecasts, pd.Series(errors, dtype=object).sort_index()
+
+
+def get_backtest_errors(forecasts, by='horizon'):
+    '''Error metrics of back test forecasts grouped by horizon (or any index level or column): MAE and MAPE of the
+    predicted daily death, coverage of the 95% band and MAE of beds and ICU against the occupancy implied by the
+    reported deaths'''
+    data = forecasts.reset_index()
+    data = data[data['death'].notna()]
+    error = (data['predicted_death'] - data['death']).abs()
+    metrics = pd.DataFrame({by: data[by],
+                            'MAE': error,
+                            'MAPE': (error / data['death']).where(data['death'] > 0),
+                            'coverage': ((data['lower_bound'] <= data['death']) &
+                                         (data['death'] <= data['upper_bound'])).astype(float),
+                            'hospital_beds_MAE': (data['hospital_beds'] - data['observed_hospital_beds']).abs(),
+                            'ICU_MAE': (data['ICU'] - data['observed_ICU']).abs(),
+                            'n': 1})
+    return metrics.groupby(by).agg({'MAE': 'mean', 'MAPE': 'mean', 'coverage': 'mean', 'hospital_beds_MAE': 'mean',
+                                    'ICU_MAE': 'mean', 'n': 'sum'})
+
+
+def backtest_regions(batch):
+    '''Back test a batch of regions of batch_forecast.WORKER_STORE, the robust fits of all cutoffs of all of them
+    run as one hb.fit_huber batch. Return one (region, forecasts, errors, seconds) per task, the seconds of a region
+    include an equal share of the batched fits'''
+    tasks, cutoffs, forecast_horizon, params = batch
+    results = {}
+    prepared = []
+    for region, rows, lockdown_date in tasks:
+        start = time.perf_counter()
+        try:
+            prepared.append((region, start) + prepare_backtest(bf.WORKER_STORE.get_local_data(rows, 'deaths'),
+                                                               cutoffs, forecast_horizon, lockdown_date,
+                                                               params=params))
+        except Exception as e:
+            results[region] = (region, None, pd.Series({None: '{}: {}'.format(type(e).__name__, e)}),
+                               time.perf_counter() - start)
+    start = time.perf_counter()
+    n_rows = [len(x) for _, _, _, (x, _, _) in prepared]
+    width = max([x.shape[1] for _, _, _, (x, _, _) in prepared], default=0)
+    huber = [np.zeros((sum(n_rows), width)), np.zeros((sum(n_rows), width)), np.zeros((sum(n_rows), width), bool)]
+    first = 0
+    for _, _, _, region_huber in prepared:
+        for padded, values in zip(huber, region_huber):
+            padded[first:first + len(values), :values.shape[1]] = values
+        first += len(region_huber[0])
+    _, _, _, outliers = hb.fit_huber(*huber)
+    batch_seconds = (time.perf_counter() - start) / max(len(prepared), 1)
+    first = 0
+    for (region, start, backtest, (x, _, _)), rows in zip(prepared, n_rows):
+        try:
+            forecasts, errors = finish_backtest(backtest, outliers[first:first + rows, :x.shape[1]])
+        except Exception as e:
+            forecasts, errors = None, pd.Series({None: '{}: {}'.format(type(e).__name__, e)})
+        first += rows
+        results[region] = (region, forecasts, errors, time.perf_counter() - start + batch_seconds)
+    return [results[region] for region, _, _ in tasks]
+
+
+def backtest_all(scope='US', start_date=None, end_date=None, forecast_horizon=60, regions=None, max_workers=None,
+                 params=None):
+    '''Rolling origin back test of every country (scope global) or US state (scope US): one forecast per cutoff
+    date between start_date and end_date, regions forecast in batches of backtest_regions in parallel from one load
+    of the data store.
+    Return the forecasts indexed by (region, cutoff, horizon), the errors by horizon and the failed cutoffs'''
+    params = params or mu.get_default_params()
+    data_store = mu.get_data_store(scope)
+    end_date = data_store.dates[-1] - dt.timedelta(1) if end_date is None else pd.to_datetime(end_date)
+    start_date = end_date - dt.timedelta(59) if start_date is None else pd.to_datetime(start_date)
+    cutoffs = pd.date_range(start_date, end_date)
+    tasks = [(region, rows, lockdown_date) for region, rows, lockdown_date in bf.get_regions(data_store, scope)
+             if regions is None or region in regions]
+    if max_workers == 1 or len(tasks) <= 1:
+        bf.WORKER_STORE = data_store
+        try:
+            results = backtest_regions((tasks, cutoffs, forecast_horizon, params))
+        finally:
+            bf.WORKER_STORE = None
+    else:
+        max_workers = os.cpu_count() if max_workers is None else max_workers
+        memory, template = bf.share_data_store(data_store)
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=bf.init_worker,
+                                     initargs=(memory.name, data_store.values.shape, data_store.values.dtype,
+                                               template)) as executor:
+                results = [result for batch_results in executor.map(
+                    backtest_regions, [(batch, cutoffs, forecast_horizon, params)
+                                       for batch in bf.get_batches(tasks, max_workers)])
+                           for result in batch_results]
+        finally:
+            memory.close()
+            memory.unlink()
+    forecasts = {region: forecasts for region, forecasts, _, _ in results if forecasts is not None}
+    forecasts = pd.concat(forecasts, names=['region']) if len(forecasts) > 0 else pd.DataFrame(
+        columns=BACKTEST_COLUMNS, index=pd.MultiIndex.from_arrays([[], [], []], names=['region', 'cutoff', 'horizon']))
+    failures = {region: errors for region, _, errors, _ in results if len(errors) > 0}
+    failures = pd.concat(failures, names=['region', 'cutoff']) if len(failures) > 0 else pd.Series(dtype=object)
+    return forecasts, get_backtest_errors(forecasts), failures
+
+
+if __name__ == '__main__':
+    for scope in ['global', 'US']:
+        start = time.perf_counter()
+        forecasts, errors, failures = backtest_all(scope, forecast_horizon=14)
+        print('{}: back tested {} forecasts in {:.1f}s, {} failed'.format(
+            scope, forecasts.index.droplevel('horizon').nunique(), time.perf_counter() - start, len(failures)))
+        print(errors.loc[[1, 7, 14]])
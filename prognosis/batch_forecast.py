@@ -0,0 +1,145 @@
+import os
+import copy
+import time
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+import model_utils as mu
+
+FORECAST_COLUMNS = ['predicted_death', 'lower_bound', 'upper_bound', 'hospital_beds', 'ICU']
+
+# Data store of the scope being forecast, set in every worker by init_worker
+WORKER_STORE = None
+WORKER_MEMORY = None
+
+
+def get_lockdown_date(lockdown_dates, region):
+    '''Same lookup as model_utils.get_lockdown_date_by_country on an already loaded lockdown table'''
+    try:
+        return pd.to_datetime(lockdown_dates.loc[region][0])
+    except KeyError:
+        return None
+
+
+def get_regions(data_store, scope):
+    '''Every country of the global scope or every state of the US scope, as (region, rows, lockdown_date)'''
+    if scope == 'global':
+        lockdown_dates = mu.get_lockdown_date_global()
+        offsets = data_store.index.country
+    else:
+        lockdown_dates = mu.get_lockdown_date_US()
+        offsets = data_store.index.state
+    return [(region, rows, get_lockdown_date(lockdown_dates, region)) for region, rows in sorted(offsets.items())]
+
+
+def share_data_store(data_store):
+    '''Copy the values of data_store into shared memory. Return the shared memory and a copy of data_store without
+    its values, which is small enough to send to every worker'''
+    memory = shared_memory.SharedMemory(create=True, size=max(data_store.values.nbytes, 1))
+    np.ndarray(data_store.values.shape, dtype=data_store.values.dtype, buffer=memory.buf)[...] = data_store.values
+    template = copy.copy(data_store)
+    template.values = None
+    return memory, template
+
+
+def init_worker(memory_name, shape, dtype, data_store):
+    '''Attach the worker to the shared values of data_store, they are read only in workers'''
+    global WORKER_STORE, WORKER_MEMORY
+    WORKER_MEMORY = shared_memory.SharedMemory(name=memory_name)
+    data_store.values = np.ndarray(shape, dtype=dtype, buffer=WORKER_MEMORY.buf)
+    data_store.values.flags.writeable = False
+    WORKER_STORE = data_store
+
+
+def get_batches(tasks, max_workers):
+    '''Split tasks in order into about 4 batches per worker'''
+    size = max(1, -(-len(tasks) // (4 * max_workers)))
+    return [tasks[first:first + size] for first in range(0, len(tasks), size)]
+
+
+def forecast_regions(batch):
+    '''Forecast a batch of regions of WORKER_STORE with the same forecast_args, the robust fits of all of them run
+    as one batch of mu.fit_log_daily_death_batch. Return one (region, daily forecast, model_beta, error, seconds) per
+    task, a region that can not be forecast gets an error message instead of the forecast. The seconds of a region
+    include an equal share of the batched fits'''
+    tasks, forecast_args = batch
+    start = time.perf_counter()
+    local_death_data = [WORKER_STORE.get_local_data(rows, 'deaths') for _, rows, _ in tasks]
+    fits, errors = mu.fit_log_daily_death_batch(local_death_data, forecast_args['forecast_horizon'],
+                                                [lockdown_date for _, _, lockdown_date in tasks],
+                                                params=forecast_args['params'])
+    batch_seconds = (time.perf_counter() - start) / max(len(tasks), 1)
+    results = []
+    for (region, _, _), data, fit, error in zip(tasks, local_death_data, fits, errors):
+        start = time.perf_counter()
+        try:
+            if error is not None:
+                raise error
+            daily_metrics, model_beta = mu.get_daily_metrics_from_fit(
+                data, fit, forecast_args['relax_date'], forecast_args['contain_rate'], forecast_args['test_rate'],
+                params=forecast_args['params'])
+        except Exception as e:
+            results.append((region, None, None, '{}: {}'.format(type(e).__name__, e),
+                            batch_seconds + time.perf_counter() - start))
+            continue
+        results.append((region, daily_metrics[FORECAST_COLUMNS], model_beta, None,
+                        batch_seconds + time.perf_counter() - start))
+    return results
+
+
+def forecast_all(scope='global', forecast_horizon=60, relax_date=None, contain_rate=0.5, test_rate=0.2,
+                 regions=None, max_workers=None, params=None):
+    '''Forecast every country (scope global) or US state (scope US) from one load of the data store. Regions are
+    forecast in batches of forecast_regions by a process pool that reads the store from shared memory, regions
+    restricts the run to some of them.
+    Return the forecasts indexed by (region, date) and a summary with one row per region holding its lockdown date,
+    model_beta and the error of the regions that could not be forecast. The parameters are resolved once here,
+    workers get them with every batch'''
+    params = params or mu.get_default_params()
+    data_store = mu.get_data_store(scope)
+    tasks = [(region, rows, lockdown_date) for region, rows, lockdown_date in get_regions(data_store, scope)
+             if regions is None or region in regions]
+    forecast_args = {'forecast_horizon': forecast_horizon, 'relax_date': relax_date, 'contain_rate': contain_rate,
+                     'test_rate': test_rate, 'params': params}
+    if max_workers == 1 or len(tasks) <= 1:
+        global WORKER_STORE
+        WORKER_STORE = data_store
+        try:
+            results = forecast_regions((tasks, forecast_args))
+        finally:
+            WORKER_STORE = None
+    else:
+        max_workers = os.cpu_count() if max_workers is None else max_workers
+        memory, template = share_data_store(data_store)
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=init_worker,
+                                     initargs=(memory.name, data_store.values.shape, data_store.values.dtype,
+                                               template)) as executor:
+                results = [result for batch_results in executor.map(
+                    forecast_regions, [(batch, forecast_args) for batch in get_batches(tasks, max_workers)])
+                           for result in batch_results]
+        finally:
+            memory.close()
+            memory.unlink()
+    forecasts = [daily_metrics for _, daily_metrics, _, error, _ in results if error is None]
+    if len(forecasts) > 0:
+        forecasts = pd.concat(forecasts, keys=[region for region, _, _, error, _ in results if error is None],
+                              names=['region', 'date'])
+    else:
+        forecasts = pd.DataFrame(columns=FORECAST_COLUMNS,
+                                 index=pd.MultiIndex.from_arrays([[], []], names=['region', 'date']))
+    summary = pd.DataFrame({'region': [region for region, _, _, _, _ in results],
+                            'lockdown_date': [lockdown_date for _, _, lockdown_date in tasks],
+                            'model_beta': [model_beta for _, _, model_beta, _, _ in results],
+                            'error': [error for _, _, _, error, _ in results],
+                            'seconds': [seconds for _, _, _, _, seconds in results]}).set_index('region')
+    return forecasts, summary
+
+
+if __name__ == '__main__':
+    for scope in ['global', 'US']:
+        start = time.perf_counter()
+        forecasts, summary = forecast_all(scope)
+        print('{}: forecast {} regions in {:.1f}s, {} failed'.format(
+            scope, len(summary), time.perf_counter() - start, summary['error'].notna().sum()))
@@ -10,16 +10,11 @@ cf.go_offline()
 py_offline.__PLOTLY_OFFLINE_INITIALIZED = True
 
 import model_utils as mu
+import scenario_sweep as ss
 
-mu.DEATH_RATE = 1.0
-mu.ICU_RATE = 5.0
-mu.HOSPITAL_RATE = 15.0
-mu.SYMPTOM_RATE = 20.0
-mu.INFECT_2_HOSPITAL_TIME = 12
-mu.HOSPITAL_2_ICU_TIME = 2
-mu.ICU_2_DEATH_TIME = 5
-mu.ICU_2_RECOVER_TIME = 11
-mu.NOT_ICU_DISCHARGE_TIME = 7
+params = mu.ModelParams(DEATH_RATE=1.0, ICU_RATE=5.0, HOSPITAL_RATE=15.0, SYMPTOM_RATE=20.0,
+                        INFECT_2_HOSPITAL_TIME=12, HOSPITAL_2_ICU_TIME=2, ICU_2_DEATH_TIME=5, ICU_2_RECOVER_TIME=11,
+                        NOT_ICU_DISCHARGE_TIME=7)
 
 st.title('C*apacity* I*ncidence* C*ontaining* T*esting* (CICT) Demo')
 hide_menu_style = """
@@ -30,6 +25,13 @@ hide_menu_style = """
 st.markdown(hide_menu_style, unsafe_allow_html=True)
 current_capacity = 2000
 
+
+@st.cache(allow_output_mutation=True, ttl=3600)
+def get_scenario_sweep(state, forecast_horizon):
+    '''Fit once per state and horizon, moving the scenario sliders only evaluates the fitted model'''
+    return ss.get_scenario_sweep_by_state_US(state, forecast_horizon, lockdown_date='20200322', params=params)
+
+
 cap_ratio = st.sidebar.slider('Capacity', min_value=1.0, max_value=10.0)
 contain_rate_slot = st.sidebar.empty()
 test_rate_slot = st.sidebar.empty()
@@ -43,13 +45,10 @@ relax_date = dt.date.today()+dt.timedelta(days_till_lock_down_end)
 forecast_horizon = st.sidebar.slider('Forecast Horizon', value=90, min_value=60, max_value=180)
 state = 'New York'
 #state = 'Washington'
-daily, cumulative, model_beta = mu.get_metrics_by_state_US(state, lockdown_date='20200322',
-                                                           forecast_horizon=forecast_horizon,
-                                                           relax_date=relax_date, contain_rate=contain_rate,
-                                                           test_rate=test_rate)
-
-model_beta_new = np.append(model_beta, ((model_beta[1]+model_beta[2])*contain_rate+model_beta[1]*(1-contain_rate))-
-                                        (model_beta[1]+model_beta[2]))
+sweep = get_scenario_sweep(state, forecast_horizon)
+daily = sweep.evaluate([relax_date], [contain_rate], [test_rate]).droplevel(ss.SCENARIO_LEVELS)
+model_beta = sweep.model_beta
+model_beta_new = np.append(model_beta, mu.get_relax_beta(model_beta, contain_rate))
 incidence = 'predicted_death'
 #incidence = 'ICU'
 incidence_func = mu.get_number_ICU_need
@@ -89,10 +88,7 @@ fig.add_trace(go.Scatter(
 st.plotly_chart(fig)
 
 
-log_fit, model_beta_log = mu.get_log_daily_predicted_death_by_state_US(state, lockdown_date='20200322',
-                                                                       forecast_horizon=forecast_horizon,
-                                                                       relax_date=relax_date, contain_rate=contain_rate,
-                                                                       test_rate=test_rate)
+log_fit = sweep.get_log_fit(relax_date, contain_rate, test_rate)
 st.subheader('Fitted log of incidences')
 log_fit.rename(columns={'predicted_death':'Predicted_Incidence', 'death': 'Incidence'}, inplace=True)
 fig = log_fit.drop(columns=['lower_bound', 'upper_bound', 'Incidence'], errors='ignore').iplot(asFigure=True)
@@ -118,4 +114,14 @@ st.plotly_chart(fig)
 
 
 st.write(pd.concat([pd.Series(model_beta), pd.Series(model_beta_new)], axis=1))
+
+if st.sidebar.checkbox('Show peak ICU of every lock down end and containing'):
+    relax_dates = [dt.date.today()+dt.timedelta(days) for days in range(1, 61, 3)]
+    summary = ss.get_scenario_summary(sweep.evaluate_grid(relax_dates, np.round(np.linspace(0, 1, 11), 2),
+                                                          [test_rate]))
+    peak_ICU = summary['peak_ICU'].droplevel('test_rate').unstack('relax_date')
+    st.subheader('Peak ICU')
+    st.plotly_chart(px.imshow(peak_ICU.values, x=[str(date.date()) for date in peak_ICU.columns],
+                              y=list(peak_ICU.index), labels={'x': 'Lock down end', 'y': 'Containing',
+                                                              'color': 'Peak ICU'}, aspect='auto'))
 st.write('Will be available at https://aipert.org')
\ No newline at end of file
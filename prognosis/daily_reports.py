@@ -0,0 +1,202 @@
+import os
+import glob
+import time
+import pickle
+import datetime as dt
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import data_cache as dc
+
+DAILY_REPORTS_DIR = '../csse_covid_19_data/csse_covid_19_daily_reports'
+DAILY_REPORTS_STORE = os.path.join(dc.CACHE_DIR, 'daily_reports')
+
+# Every schema JHU used over time, mapped to one canonical column set
+COLUMN_NAMES = {'Province/State': 'State',
+                'Province_State': 'State',
+                'Country/Region': 'Country',
+                'Country_Region': 'Country',
+                'Admin2': 'County',
+                'Last Update': 'Last_Update',
+                'Latitude': 'Lat',
+                'Longitude': 'Long_',
+                'Case-Fatality_Ratio': 'Case_Fatality_Ratio'}
+STRING_COLUMNS = ['County', 'State', 'Country', 'Combined_Key']
+NUMERIC_COLUMNS = ['FIPS', 'Lat', 'Long_', 'Confirmed', 'Deaths', 'Recovered', 'Active', 'Incidence_Rate',
+                   'Case_Fatality_Ratio']
+CANONICAL_COLUMNS = ['Date', 'Last_Update'] + STRING_COLUMNS + NUMERIC_COLUMNS
+
+
+def get_report_date(csv_file):
+    '''Daily reports are named MM-DD-YYYY.csv after the day they cover'''
+    return dt.datetime.strptime(os.path.splitext(os.path.basename(csv_file))[0], '%m-%d-%Y')
+
+
+def list_daily_reports(report_dir=DAILY_REPORTS_DIR):
+    '''All daily report files sorted by report date'''
+    return sorted(glob.glob(os.path.join(report_dir, '[0-9][0-9]-[0-9][0-9]-[0-9][0-9][0-9][0-9].csv')),
+                  key=get_report_date)
+
+
+def normalize_daily_report(data, report_date):
+    '''Rename the columns of one daily report to the canonical set and add the missing ones as empty'''
+    data = data.rename(columns=lambda column: COLUMN_NAMES.get(column.strip(), column.strip()))
+    for column in STRING_COLUMNS:
+        if column not in data.columns:
+            data[column] = np.nan
+        data[column] = data[column].astype(object)
+    for column in NUMERIC_COLUMNS:
+        if column not in data.columns:
+            data[column] = np.nan
+        data[column] = pd.to_numeric(data[column], errors='coerce').astype(np.float64)
+    data['Last_Update'] = pd.to_datetime(data['Last_Update'], errors='coerce')
+    data['Date'] = pd.Timestamp(report_date)
+    return data[CANONICAL_COLUMNS]
+
+
+def read_daily_report(csv_file):
+    '''Parse and normalize one daily report, return the frame and the time it took in seconds'''
+    start = time.perf_counter()
+    data = normalize_daily_report(pd.read_csv(csv_file, encoding='utf-8-sig'), get_report_date(csv_file))
+    return data, time.perf_counter() - start
+
+
+def get_source_key(csv_file):
+    '''Identify the version of a source file by name, size and modified time'''
+    stat = os.stat(csv_file)
+    return os.path.basename(csv_file), stat.st_size, stat.st_mtime_ns
+
+
+def ingest_daily_reports(csv_files, max_workers=None):
+    '''Parse csv_files in a process pool. Return the consolidated canonical frame ordered by report date and the
+    per-file parse timings'''
+    if len(csv_files) == 0:
+        return pd.DataFrame(columns=CANONICAL_COLUMNS), pd.DataFrame(columns=['file', 'rows', 'seconds'])
+    if len(csv_files) == 1 or max_workers == 1:
+        # Not worth starting a pool for a single new report
+        results = [read_daily_report(csv_file) for csv_file in csv_files]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(read_daily_report, csv_files, chunksize=8))
+    timings = pd.DataFrame({'file': [os.path.basename(csv_file) for csv_file in csv_files],
+                            'rows': [len(data) for data, _ in results],
+                            'seconds': [seconds for _, seconds in results]})
+    data = pd.concat([data for data, _ in results], ignore_index=True)
+    return data, timings
+
+
+def encode_daily_reports(data, categories=None):
+    '''Turn the canonical frame into one numpy array per stored column. Strings become codes into categories,
+    which are extended with the strings not seen before'''
+    categories = {} if categories is None else dict(categories)
+    columns = {'Date': data['Date'].values.astype('datetime64[D]'),
+               'Last_Update': data['Last_Update'].values.astype('datetime64[s]')}
+    for column in STRING_COLUMNS:
+        known = categories.get(column, [])
+        values = data[column].dropna().unique()
+        categories[column] = known + sorted(set(values) - set(known))
+        columns[column] = pd.Categorical(data[column], categories=categories[column]).codes.astype(np.int32)
+    for column in NUMERIC_COLUMNS:
+        columns[column] = data[column].values.astype(np.float64)
+    return columns, categories
+
+
+def get_column_file(store_dir, column):
+    return os.path.join(store_dir, column + '.npy')
+
+
+def write_daily_reports_store(data, sources, store_dir=DAILY_REPORTS_STORE):
+    '''Save the consolidated frame with one npy file per column, so later days can be appended column by column.
+    sources are the get_source_key of every ingested file'''
+    columns, categories = encode_daily_reports(data)
+    os.makedirs(store_dir, exist_ok=True)
+    for column, values in columns.items():
+        dc.replace_file(get_column_file(store_dir, column), lambda f: np.save(f, values))
+    dc.write_meta({'sources': sources, 'categories': categories, 'rows': len(data)},
+                  os.path.join(store_dir, 'meta.pkl'))
+
+
+def load_daily_reports_meta(store_dir=DAILY_REPORTS_STORE):
+    return dc.read_meta(os.path.join(store_dir, 'meta.pkl'))
+
+
+def load_daily_reports_store(store_dir=DAILY_REPORTS_STORE):
+    '''Return the consolidated frame and the source keys it was built from'''
+    meta = load_daily_reports_meta(store_dir)
+    columns = {column: np.load(get_column_file(store_dir, column))
+               for column in ['Date', 'Last_Update'] + STRING_COLUMNS + NUMERIC_COLUMNS}
+    if any(len(values) != meta['rows'] for values in columns.values()):
+        raise ValueError('Daily reports store {} is incomplete'.format(store_dir))
+    data = pd.DataFrame({'Date': pd.to_datetime(columns['Date']),
+                         'Last_Update': pd.to_datetime(columns['Last_Update'])})
+    for column in STRING_COLUMNS:
+        data[column] = pd.Categorical.from_codes(columns[column],
+                                                 pd.Index(meta['categories'][column], dtype=object)).astype(object)
+    for column in NUMERIC_COLUMNS:
+        data[column] = columns[column]
+    if not data['Date'].is_monotonic_increasing:
+        data = data.sort_values('Date', kind='mergesort', ignore_index=True)
+    return data[CANONICAL_COLUMNS], meta['sources']
+
+
+def build_daily_reports_store(report_dir=DAILY_REPORTS_DIR, store_dir=DAILY_REPORTS_STORE, max_workers=None):
+    '''Full rebuild of the consolidated store from every daily report, return the data and per-file timings'''
+    csv_files = list_daily_reports(report_dir)
+    data, timings = ingest_daily_reports(csv_files, max_workers=max_workers)
+    write_daily_reports_store(data, [get_source_key(csv_file) for csv_file in csv_files], store_dir)
+    return data, timings
+
+
+def update_daily_reports_store(report_dir=DAILY_REPORTS_DIR, store_dir=DAILY_REPORTS_STORE, max_workers=None):
+    '''Parse only the daily reports that are new or modified since the store was written. Rows of new days are
+    appended to the column files, a day already in the store is rewritten only when its values actually changed.
+    Return the data, the new and the changed report dates and the per-file parse timings'''
+    try:
+        data, sources = load_daily_reports_store(store_dir)
+        meta = load_daily_reports_meta(store_dir)
+    except (OSError, EOFError, KeyError, ValueError, pickle.UnpicklingError):
+        data, timings = build_daily_reports_store(report_dir, store_dir, max_workers)
+        return data, list(data['Date'].drop_duplicates()), [], timings
+    csv_files = list_daily_reports(report_dir)
+    keys = [get_source_key(csv_file) for csv_file in csv_files]
+    stale_files = [csv_file for csv_file, key in zip(csv_files, keys) if key not in set(sources)]
+    update, timings = ingest_daily_reports(stale_files, max_workers=max_workers)
+    new_dates = []
+    changed_dates = []
+    for date, rows in update.groupby('Date', sort=False):
+        current = data[data['Date'] == date]
+        if len(current) == 0:
+            new_dates.append(date)
+        elif not current.reset_index(drop=True).equals(rows.reset_index(drop=True)):
+            changed_dates.append(date)
+    appended = update[update['Date'].isin(new_dates)]
+    changed = update[update['Date'].isin(changed_dates)]
+    if len(changed) > 0:
+        data = pd.concat([data[~data['Date'].isin(changed_dates)], changed, appended], ignore_index=True)
+        data = data.sort_values('Date', kind='mergesort', ignore_index=True)
+        write_daily_reports_store(data, keys, store_dir)
+        return data, new_dates, changed_dates, timings
+    if len(appended) > 0:
+        columns, categories = encode_daily_reports(appended, meta['categories'])
+        if not all(dc.append_npy_rows(get_column_file(store_dir, column), values)
+                   for column, values in columns.items()):
+            data = pd.concat([data, appended], ignore_index=True)
+            write_daily_reports_store(data, keys, store_dir)
+            return data, new_dates, changed_dates, timings
+        meta['categories'] = categories
+        meta['rows'] += len(appended)
+        data = pd.concat([data, appended], ignore_index=True)
+    if len(appended) > 0 or keys != sources:
+        meta['sources'] = keys
+        dc.write_meta(meta, os.path.join(store_dir, 'meta.pkl'))
+    if not data['Date'].is_monotonic_increasing:
+        data = data.sort_values('Date', kind='mergesort', ignore_index=True)
+    return data, new_dates, changed_dates, timings
+
+
+if __name__ == '__main__':
+    start = time.perf_counter()
+    daily_reports, new_dates, changed_dates, parse_timings = update_daily_reports_store()
+    print(parse_timings.to_string(index=False))
+    print('Ingested {} files in {:.2f}s, {} new and {} changed days, {} rows in store'.format(
+        len(parse_timings), time.perf_counter() - start, len(new_dates), len(changed_dates), len(daily_reports)))
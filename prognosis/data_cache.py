@@ -0,0 +1,189 @@
+import os
+import pickle
+import shutil
+import hashlib
+import tempfile
+import datetime as dt
+import numpy as np
+import pandas as pd
+
+CACHE_DIR = 'cache'
+# Bump when the layout of cache files changes so old entries get rebuilt
+CACHE_VERSION = 2
+
+
+def is_date_column(column):
+    '''JHU time series files have one column per day, named like 1/22/20'''
+    try:
+        dt.datetime.strptime(str(column), '%m/%d/%y')
+    except ValueError:
+        return False
+    return True
+
+
+def get_cache_key(csv_file):
+    '''Cache entry is valid as long as the source csv keeps the same path, size and modified time'''
+    stat = os.stat(csv_file)
+    return os.path.abspath(csv_file), stat.st_size, stat.st_mtime_ns
+
+
+def get_cache_files(csv_file, cache_dir=CACHE_DIR):
+    '''Return (values_file, meta_file) of the cache entry for csv_file'''
+    path_hash = hashlib.sha1(os.path.abspath(csv_file).encode()).hexdigest()[:10]
+    name = '{}_{}'.format(os.path.splitext(os.path.basename(csv_file))[0], path_hash)
+    return os.path.join(cache_dir, name + '.npy'), os.path.join(cache_dir, name + '.meta.pkl')
+
+
+def split_csv_data(data):
+    '''Split a time series table into its date columns, stored day by day as a (date, row) matrix, and the
+    metadata of the other columns'''
+    date_columns = [column for column in data.columns if is_date_column(column)]
+    meta = {'version': CACHE_VERSION,
+            'columns': list(data.columns),
+            'date_columns': date_columns,
+            'info': data.drop(columns=date_columns)}
+    return np.ascontiguousarray(data[date_columns].values.T), meta
+
+
+def replace_file(file, write):
+    '''Call write with a unique temporary file next to file, then move it over file. Concurrent writers never share
+    a temporary file and readers see either the old or the new file, never half of one'''
+    fd, tmp_file = tempfile.mkstemp(suffix='.tmp', prefix=os.path.basename(file) + '.',
+                                    dir=os.path.dirname(file) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.replace(tmp_file, file)
+    except BaseException:
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        raise
+
+
+def write_meta(meta, meta_file):
+    replace_file(meta_file, lambda f: pickle.dump(meta, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def read_meta(meta_file):
+    with open(meta_file, 'rb') as f:
+        return pickle.load(f)
+
+
+def write_csv_cache(data, csv_file, key=None, cache_dir=CACHE_DIR):
+    '''Store the date columns of data as one numpy matrix, the other columns go into a pickled sidecar together
+    with the cache key. Files are written through replace_file so other workers never read half a file'''
+    if key is None:
+        key = get_cache_key(csv_file)
+    values_file, meta_file = get_cache_files(csv_file, cache_dir)
+    values, meta = split_csv_data(data)
+    meta['key'] = key
+    os.makedirs(cache_dir, exist_ok=True)
+    replace_file(values_file, lambda f: np.save(f, values))
+    write_meta(meta, meta_file)
+
+
+def build_csv_data(values, meta):
+    dates = pd.DataFrame(values.T, index=meta['info'].index, columns=meta['date_columns'])
+    data = pd.concat([meta['info'], dates], axis=1, copy=False)
+    if list(data.columns) != meta['columns']:
+        data = data[meta['columns']]
+    return data
+
+
+def load_csv_cache(csv_file, key=None, cache_dir=CACHE_DIR):
+    '''Rebuild the DataFrame from cache, return None if there is no valid cache entry for csv_file'''
+    if key is None:
+        key = get_cache_key(csv_file)
+    values_file, meta_file = get_cache_files(csv_file, cache_dir)
+    try:
+        meta = read_meta(meta_file)
+        if meta['key'] != key or meta.get('version') != CACHE_VERSION:
+            return None
+        values = np.load(values_file)
+    except (OSError, EOFError, ValueError, KeyError, pickle.UnpicklingError):
+        return None
+    if values.shape != (len(meta['date_columns']), len(meta['info'])):
+        return None
+    return build_csv_data(values, meta)
+
+
+def append_npy_rows(npy_file, rows):
+    '''Append rows to the end of a C ordered npy file by growing its first axis. The cached rows are copied as raw
+    bytes behind a new header, without parsing them, and the grown file replaces the old one through replace_file.
+    Return False when the file has another layout, the caller then has to write the whole file'''
+    with open(npy_file, 'rb') as source:
+        version = np.lib.format.read_magic(source)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(source)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(source)
+        if fortran_order or dtype != rows.dtype or tuple(shape[1:]) != rows.shape[1:]:
+            return False
+        header_data = {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+                       'shape': (shape[0] + rows.shape[0],) + tuple(shape[1:])}
+
+        def write(f):
+            if version == (1, 0):
+                np.lib.format.write_array_header_1_0(f, header_data)
+            else:
+                np.lib.format.write_array_header_2_0(f, header_data)
+            shutil.copyfileobj(source, f)
+            f.write(np.ascontiguousarray(rows).tobytes())
+
+        replace_file(npy_file, write)
+    return True
+
+
+def update_csv_cache(csv_file, cache_dir=CACHE_DIR):
+    '''Bring the cache entry of csv_file up to date. Days that are new in the csv are appended to the cached matrix
+    when no cached day changed, otherwise, e.g. after a JHU correction, or when rows or the day layout changed, the
+    whole entry is rewritten. Files are only ever replaced, never changed in place, so readers and concurrent
+    updates see whole files. Return the data and the lists of new and changed days'''
+    key = get_cache_key(csv_file)
+    values_file, meta_file = get_cache_files(csv_file, cache_dir)
+    meta = None
+    cached_values = None
+    try:
+        meta = read_meta(meta_file)
+        cached_values = np.load(values_file, mmap_mode='r')
+    except (OSError, EOFError, ValueError, KeyError, pickle.UnpicklingError):
+        meta = None
+    if meta is not None and (meta.get('version') != CACHE_VERSION or
+                             cached_values.shape != (len(meta['date_columns']), len(meta['info']))):
+        meta = None
+    if meta is not None and meta['key'] == key:
+        return build_csv_data(np.array(cached_values), meta), [], []
+    data = pd.read_csv(csv_file)
+    values, new_meta = split_csv_data(data)
+    n_cached = 0 if meta is None else len(meta['date_columns'])
+    if (meta is None or cached_values.dtype != values.dtype
+            or new_meta['date_columns'][:n_cached] != meta['date_columns']
+            or not new_meta['info'].equals(meta['info'])):
+        cached_values = None
+        write_csv_cache(data, csv_file, key=key, cache_dir=cache_dir)
+        return data, new_meta['date_columns'], []
+    changed_days = np.flatnonzero((cached_values != values[:n_cached]).any(axis=1))
+    del cached_values
+    if len(changed_days) > 0 or (n_cached < len(values) and not append_npy_rows(values_file, values[n_cached:])):
+        write_csv_cache(data, csv_file, key=key, cache_dir=cache_dir)
+    else:
+        new_meta['key'] = key
+        write_meta(new_meta, meta_file)
+    return data, new_meta['date_columns'][n_cached:], [meta['date_columns'][i] for i in changed_days]
+
+
+def read_csv_cached(csv_file, cache_dir=CACHE_DIR):
+    '''Drop-in replacement for pd.read_csv of the JHU time series files. The csv is only parsed when it is new or
+    has changed since the cache was written'''
+    key = get_cache_key(csv_file)
+    data = load_csv_cache(csv_file, key=key, cache_dir=cache_dir)
+    if data is not None:
+        return data
+    try:
+        data, _, _ = update_csv_cache(csv_file, cache_dir=cache_dir)
+    except OSError:
+        # Read only deployment, keep serving from csv
+        data = pd.read_csv(csv_file)
+    return data
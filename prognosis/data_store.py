@@ -0,0 +1,101 @@
+import numpy as np
+import pandas as pd
+import data_cache as dc
+
+REGION_COLUMNS = ['County', 'State', 'Country']
+LOOKUP_COLUMNS = ['UID', 'iso2', 'iso3', 'code3', 'FIPS', 'Lat', 'Long_', 'Combined_Key', 'Population']
+
+
+class RegionIndex(object):
+    '''Row offsets of every Country, State and (County, State) in a table of regions, so that the series of a region
+    is a sum over only its own rows of a prebuilt value matrix'''
+
+    def __init__(self, regions):
+        '''regions has columns named Country, State and County as in model_utils.get_data'''
+        self.country = self.get_offsets(regions, 'Country')
+        self.state = self.get_offsets(regions, 'State')
+        self.county_state = self.get_offsets(regions, ['County', 'State'])
+
+    @staticmethod
+    def get_offsets(regions, columns):
+        if isinstance(columns, str):
+            if columns not in regions.columns:
+                return {}
+        elif not set(columns).issubset(regions.columns):
+            return {}
+        return {key: np.asarray(rows, dtype=np.intp)
+                for key, rows in regions.reset_index(drop=True).groupby(columns, sort=False).indices.items()}
+
+    def get_rows(self, country=None, state=None, county=None):
+        '''Row offsets of a region, empty if the region is not in the table'''
+        if county is not None:
+            rows = self.county_state.get((county, state))
+        elif state is not None:
+            rows = self.state.get(state)
+        else:
+            rows = self.country.get(country)
+        if rows is None:
+            return np.array([], dtype=np.intp)
+        return rows
+
+
+class DataStore(object):
+    '''Counts of every region, date and metric of one scope in a single contiguous int32 array shaped
+    [region, date, metric]. Region names and the UID lookup metadata are kept in the regions DataFrame, in the
+    same order as the first axis'''
+
+    def __init__(self, tables, lookup=None, key=None):
+        '''tables maps metric name (deaths, confirmed, recovered) to its time series table with columns renamed as
+        in model_utils.get_data, lookup is UID_ISO_FIPS_LookUp_Table.csv, key identifies the data load'''
+        self.key = key
+        self.metrics = list(tables)
+        region_keys = {}
+        table_rows = {}
+        table_dates = {}
+        for metric, data in tables.items():
+            keys = list(zip(*[data[column].fillna('') if column in data.columns else [''] * len(data)
+                              for column in REGION_COLUMNS]))
+            table_rows[metric] = np.array([region_keys.setdefault(key, len(region_keys)) for key in keys],
+                                          dtype=np.intp)
+            table_dates[metric] = [column for column in data.columns if dc.is_date_column(column)]
+        self.dates = pd.DatetimeIndex(sorted(set(pd.to_datetime(date, format='%m/%d/%y')
+                                                 for dates in table_dates.values() for date in dates)))
+        self.values = np.zeros((len(region_keys), len(self.dates), len(self.metrics)), dtype=np.int32)
+        for m, (metric, data) in enumerate(tables.items()):
+            date_idx = self.dates.get_indexer(pd.to_datetime(table_dates[metric], format='%m/%d/%y'))
+            self.values[table_rows[metric][:, None], date_idx[None, :], m] = data[table_dates[metric]].values
+        regions = pd.DataFrame(list(region_keys), columns=REGION_COLUMNS)
+        if lookup is not None:
+            lookup = lookup.rename(columns={'Admin2': 'County', 'Province_State': 'State',
+                                            'Country_Region': 'Country'})
+            lookup[REGION_COLUMNS] = lookup[REGION_COLUMNS].fillna('')
+            regions = regions.merge(lookup[REGION_COLUMNS + [column for column in LOOKUP_COLUMNS
+                                                             if column in lookup.columns]],
+                                    on=REGION_COLUMNS, how='left')
+        regions[REGION_COLUMNS] = regions[REGION_COLUMNS].replace('', np.nan)
+        self.index = RegionIndex(regions)
+        for column in REGION_COLUMNS:
+            regions[column] = regions[column].astype('category')
+        self.regions = regions
+
+    def get_date_slice(self, start_date=None, end_date=None):
+        '''Slice of the date axis between start_date and end_date, both included'''
+        start = None if start_date is None else self.dates.searchsorted(pd.to_datetime(start_date), side='left')
+        end = None if end_date is None else self.dates.searchsorted(pd.to_datetime(end_date), side='right')
+        return slice(start, end)
+
+    def get_values(self, rows=slice(None), metric=None, start_date=None, end_date=None):
+        '''Counts of the given rows, date window and metric. Returns a view of the store unless rows is an array
+        of offsets'''
+        metric_idx = slice(None) if metric is None else self.metrics.index(metric)
+        return self.values[rows, self.get_date_slice(start_date, end_date), metric_idx]
+
+    def get_series(self, rows, metric='deaths', start_date=None, end_date=None):
+        '''Sum of the rows of a region for every date in the window'''
+        return self.get_values(rows, metric, start_date, end_date).sum(axis=0, dtype=np.int64)
+
+    def get_local_data(self, rows, metric='deaths', start_date=None, end_date=None):
+        '''Cumulative series of a region in the format of model_utils.get_data_by_* helpers'''
+        date_slice = self.get_date_slice(start_date, end_date)
+        local_data = pd.DataFrame(self.get_series(rows, metric, start_date, end_date), index=self.dates[date_slice])
+        return local_data[local_data > 0].dropna()
@@ -0,0 +1,127 @@
+import re
+import numpy as np
+import pandas as pd
+
+ERRATA_FILE = '../csse_covid_19_data/csse_covid_19_time_series/Errata.csv'
+# Errata.csv is maintained by hand, file names are not always spelled like the real files
+ERRATA_FILE_PATTERN = re.compile(r'times?_series_covid19_(deaths|confirmed|recovered|cases)_(global|us)\.csv',
+                                 re.IGNORECASE)
+US_STATES = {'AL': 'Alabama', 'AK': 'Alaska', 'AZ': 'Arizona', 'AR': 'Arkansas', 'CA': 'California',
+             'CO': 'Colorado', 'CT': 'Connecticut', 'DE': 'Delaware', 'DC': 'District of Columbia',
+             'FL': 'Florida', 'GA': 'Georgia', 'HI': 'Hawaii', 'ID': 'Idaho', 'IL': 'Illinois', 'IN': 'Indiana',
+             'IA': 'Iowa', 'KS': 'Kansas', 'KY': 'Kentucky', 'LA': 'Louisiana', 'ME': 'Maine', 'MD': 'Maryland',
+             'MA': 'Massachusetts', 'MI': 'Michigan', 'MN': 'Minnesota', 'MS': 'Mississippi', 'MO': 'Missouri',
+             'MT': 'Montana', 'NE': 'Nebraska', 'NV': 'Nevada', 'NH': 'New Hampshire', 'NJ': 'New Jersey',
+             'NM': 'New Mexico', 'NY': 'New York', 'NC': 'North Carolina', 'ND': 'North Dakota', 'OH': 'Ohio',
+             'OK': 'Oklahoma', 'OR': 'Oregon', 'PA': 'Pennsylvania', 'RI': 'Rhode Island',
+             'SC': 'South Carolina', 'SD': 'South Dakota', 'TN': 'Tennessee', 'TX': 'Texas', 'UT': 'Utah',
+             'VT': 'Vermont', 'VA': 'Virginia', 'WA': 'Washington', 'WV': 'West Virginia', 'WI': 'Wisconsin',
+             'WY': 'Wyoming', 'PR': 'Puerto Rico', 'GU': 'Guam', 'VI': 'Virgin Islands'}
+
+
+def get_errata(csv_file=ERRATA_FILE):
+    return pd.read_csv(csv_file, encoding='utf-8-sig', dtype=str)
+
+
+def parse_errata_file(file_name):
+    '''Return (type, scope) of the time series file an erratum is about, None if it can not be recognized'''
+    match = ERRATA_FILE_PATTERN.fullmatch(str(file_name).strip())
+    if match is None:
+        return None
+    type = 'confirmed' if match.group(1).lower() == 'cases' else match.group(1).lower()
+    scope = 'US' if match.group(2).lower() == 'us' else 'global'
+    return type, scope
+
+
+def parse_errata_date(field):
+    '''Only errata about a single day cell can be applied, ranges like 4/1 - 4/8 are skipped'''
+    for date_format in ('%m/%d/%y', '%m/%d/%Y'):
+        try:
+            return pd.to_datetime(str(field).strip(), format=date_format)
+        except ValueError:
+            pass
+    return None
+
+
+def parse_errata_value(value):
+    try:
+        return int(str(value).strip().replace(',', ''))
+    except ValueError:
+        return None
+
+
+def get_single_row(rows):
+    return rows[0] if len(rows) == 1 else None
+
+
+def get_errata_row(data_store, location, scope):
+    '''Return the row of data_store a location of Errata.csv refers to, None if it is not exactly one region'''
+    regions = data_store.regions
+    location = str(location).strip()
+    if scope == 'global':
+        if ' - ' in location:
+            state, country = [part.strip() for part in location.rsplit(' - ', 1)]
+            return get_single_row(data_store.index.get_rows(state=state))
+        rows = data_store.index.get_rows(country=location)
+        return get_single_row(rows[regions['State'].values[rows].isna()])
+    parts = [part.strip() for part in location.split(',')]
+    if len(parts) == 3 and parts[0].isdigit():
+        return get_single_row(np.flatnonzero(regions['UID'].values == int(parts[0])))
+    if len(parts) == 2 and parts[1] == 'US':
+        return get_single_row(data_store.index.get_rows(state=US_STATES.get(parts[0], parts[0])))
+    if len(parts) == 2:
+        county, state = parts
+        state = US_STATES.get(state, state)
+        rows = data_store.index.get_rows(county=county, state=state)
+        if len(rows) == 0 and county.endswith(' County'):
+            rows = data_store.index.get_rows(county=county[:-len(' County')], state=state)
+        return get_single_row(rows)
+    if len(parts) == 1:
+        rows = data_store.index.get_rows(state=location)
+        if len(rows) == 0:
+            rows = np.flatnonzero(regions['County'].values == location)
+        return get_single_row(rows)
+    return None
+
+
+def compile_errata(errata, data_store, scope):
+    '''Turn the cell level errata of one scope into (region index, date index, metric index, old value, new value)
+    arrays. Several days in one line separated by ; are split. Errata that are ranges, free text or do not point
+    to exactly one cell of data_store are left out'''
+    cells = []
+    for _, erratum in errata.iterrows():
+        file_type = parse_errata_file(erratum['File'])
+        if file_type is None or file_type[1] != scope or file_type[0] not in data_store.metrics:
+            continue
+        row = get_errata_row(data_store, erratum['Location'], scope)
+        if row is None:
+            continue
+        fields = str(erratum['Field Updated']).split(';')
+        olds = str(erratum['Old']).split(';')
+        news = str(erratum['New']).split(';')
+        if not len(fields) == len(olds) == len(news):
+            continue
+        for field, old, new in zip(fields, olds, news):
+            date = parse_errata_date(field)
+            old = parse_errata_value(old)
+            new = parse_errata_value(new)
+            if date is None or old is None or new is None or date not in data_store.dates:
+                continue
+            cells.append((row, data_store.dates.get_loc(date), data_store.metrics.index(file_type[0]), old, new))
+    cells = np.array(cells, dtype=np.int64).reshape(-1, 5)
+    return {'region': cells[:, 0].astype(np.intp),
+            'date': cells[:, 1].astype(np.intp),
+            'metric': cells[:, 2].astype(np.intp),
+            'old': cells[:, 3],
+            'new': cells[:, 4]}
+
+
+def apply_errata(data_store, compiled):
+    '''Apply compiled errata to data_store.values in place with one scatter. A cell is only corrected while it still
+    holds the old value, so corrections JHU already made in the csv or revised later are left alone.
+    Return the number of corrected cells'''
+    current = data_store.values[compiled['region'], compiled['date'], compiled['metric']]
+    to_correct = current == compiled['old']
+    data_store.values[compiled['region'][to_correct], compiled['date'][to_correct],
+                      compiled['metric'][to_correct]] = compiled['new'][to_correct]
+    return int(to_correct.sum())
@@ -0,0 +1,172 @@
+import os
+import copy
+import glob
+import pickle
+import hashlib
+import inspect
+import threading
+from collections import OrderedDict
+import pandas as pd
+import data_cache as dc
+import model_utils as mu
+import monte_carlo as mc
+import lockdown_estimate as le
+
+FORECAST_CACHE_DIR = os.path.join(dc.CACHE_DIR, 'forecasts')
+# Bump when a model change makes cached forecasts stale
+FORECAST_CACHE_VERSION = 2
+MAX_MEMORY_ITEMS = 256
+MAX_DISK_BYTES = 512 * 2**20
+
+
+class ForecastCache(object):
+    '''Forecast results by key in two tiers: an in memory LRU of the most recently used entries, shared by every
+    session of the app process, and pickled files on disk that survive restarts and are shared between processes.
+    When the disk tier grows over max_disk_bytes, the least recently used files are removed'''
+
+    def __init__(self, cache_dir=FORECAST_CACHE_DIR, max_items=MAX_MEMORY_ITEMS, max_disk_bytes=MAX_DISK_BYTES):
+        self.cache_dir = cache_dir
+        self.max_items = max_items
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_digest(key):
+        return hashlib.sha1(pickle.dumps(key, protocol=pickle.HIGHEST_PROTOCOL)).hexdigest()
+
+    def get_file(self, digest):
+        return os.path.join(self.cache_dir, digest + '.pkl')
+
+    def get(self, key):
+        '''Cached value of key or None. Returns a copy, callers can modify it'''
+        digest = self.get_digest(key)
+        with self.lock:
+            if digest in self.memory:
+                self.memory.move_to_end(digest)
+                self.hits += 1
+                return copy.deepcopy(self.memory[digest])
+        try:
+            with open(self.get_file(digest), 'rb') as f:
+                value = pickle.load(f)
+            # Modified time marks the last use for eviction
+            os.utime(self.get_file(digest))
+        except (OSError, EOFError, pickle.UnpicklingError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+            self.put_memory(digest, value)
+        return copy.deepcopy(value)
+
+    def put_memory(self, digest, value):
+        self.memory[digest] = value
+        self.memory.move_to_end(digest)
+        while len(self.memory) > self.max_items:
+            self.memory.popitem(last=False)
+
+    def put(self, key, value):
+        digest = self.get_digest(key)
+        value = copy.deepcopy(value)
+        with self.lock:
+            self.put_memory(digest, value)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            dc.replace_file(self.get_file(digest),
+                            lambda f: pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL))
+            self.evict_disk()
+        except OSError:
+            # Read only deployment, keep the memory tier only
+            pass
+
+    def evict_disk(self):
+        '''Remove the least recently used files until the disk tier fits in max_disk_bytes'''
+        files = []
+        for file in glob.glob(os.path.join(self.cache_dir, '*.pkl')):
+            try:
+                stat = os.stat(file)
+            except OSError:
+                continue
+            files.append((stat.st_mtime_ns, stat.st_size, file))
+        total = sum(size for _, size, _ in files)
+        for _, size, file in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        with self.lock:
+            self.memory.clear()
+        for file in glob.glob(os.path.join(self.cache_dir, '*.pkl')):
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+
+
+FORECAST_CACHE = ForecastCache()
+
+
+def get_series_hash(local_data):
+    '''Fingerprint of the dates and values of a region's series'''
+    series_hash = hashlib.sha1(local_data.index.asi8.tobytes())
+    series_hash.update(local_data.values.tobytes())
+    return series_hash.hexdigest()
+
+
+def get_forecast_key(forecast_fun, region, data_fun, types, args, kwargs):
+    '''Key of a forecast: the function, its arguments with defaults filled in, the fingerprint of every input
+    series of the region and every model parameter'''
+    arguments = inspect.signature(forecast_fun).bind(region, *args, **kwargs)
+    arguments.apply_defaults()
+    arguments = dict(arguments.arguments)
+    if not arguments.get('back_test', True):
+        # The back test cutoff is only used when back testing
+        arguments['last_data_date'] = None
+    for name in ['lockdown_date', 'relax_date', 'last_data_date']:
+        if arguments.get(name) is not None:
+            arguments[name] = pd.to_datetime(arguments[name])
+    series = tuple(get_series_hash(data_fun(region, type=type)) for type in types)
+    return FORECAST_CACHE_VERSION, forecast_fun.__name__, tuple(sorted(arguments.items())), series
+
+
+def cache_forecast(forecast_fun, data_fun, types, cache=None):
+    '''Wrap a model_utils forecast by region so results come from the cache as long as the region's data, the
+    arguments and the model parameters are unchanged. A call without params is keyed and run with the default
+    parameters of that moment'''
+    def cached_forecast(region, *args, **kwargs):
+        forecast_cache = FORECAST_CACHE if cache is None else cache
+        if kwargs.get('params') is None:
+            kwargs['params'] = mu.get_default_params()
+        key = get_forecast_key(forecast_fun, region, data_fun, types, args, kwargs)
+        result = forecast_cache.get(key)
+        if result is None:
+            result = forecast_fun(region, *args, **kwargs)
+            forecast_cache.put(key, result)
+        return result
+    cached_forecast.__name__ = forecast_fun.__name__
+    cached_forecast.__doc__ = forecast_fun.__doc__
+    return cached_forecast
+
+
+get_metrics_by_country = cache_forecast(mu.get_metrics_by_country, mu.get_data_by_country, ['deaths', 'confirmed'])
+get_metrics_by_state_US = cache_forecast(mu.get_metrics_by_state_US, mu.get_data_by_state, ['deaths', 'confirmed'])
+get_log_daily_predicted_death_by_country = cache_forecast(mu.get_log_daily_predicted_death_by_country,
+                                                          mu.get_data_by_country, ['deaths'])
+get_log_daily_predicted_death_by_state_US = cache_forecast(mu.get_log_daily_predicted_death_by_state_US,
+                                                           mu.get_data_by_state, ['deaths'])
+get_metric_quantiles_by_country = cache_forecast(mc.get_metric_quantiles_by_country, mu.get_data_by_country,
+                                                 ['deaths'])
+get_metric_quantiles_by_state_US = cache_forecast(mc.get_metric_quantiles_by_state_US, mu.get_data_by_state,
+                                                  ['deaths'])
+estimate_lockdown_date_by_country = cache_forecast(le.estimate_lockdown_date_by_country, mu.get_data_by_country,
+                                                   ['deaths'])
+estimate_lockdown_date_by_state_US = cache_forecast(le.estimate_lockdown_date_by_state_US, mu.get_data_by_state,
+                                                    ['deaths'])
@@ -0,0 +1,188 @@
+import numpy as np
+
+# Smallest scale, same lower bound as sklearn.linear_model.HuberRegressor
+MIN_SCALE = np.finfo(np.float64).eps * 10
+
+
+def pad_ragged(arrays, fill=0.0):
+    '''Stack 1-D arrays of different lengths into a (batch, max length) array and the mask of real values'''
+    lengths = np.array([len(a) for a in arrays], dtype=np.intp)
+    mask = np.arange(max(lengths.max(initial=0), 1))[None, :] < lengths[:, None]
+    padded = np.full(mask.shape, fill, dtype=np.float64)
+    padded[mask] = np.concatenate([np.asarray(a, dtype=np.float64) for a in arrays]) if len(arrays) > 0 else []
+    return padded, mask
+
+
+def get_huber_scale(abs_residual, mask, epsilon):
+    '''Scale minimizing the Huber objective of every row for fixed coefficients. The objective is convex in the
+    scale and piecewise smooth between the residuals, so the root of its derivative is found exactly from the sorted
+    residuals: with the k smallest residuals as inliers, scale**2 = sum of their squares / (n - (n-k)*epsilon**2)'''
+    n = mask.sum(axis=1)
+    sorted_residual = np.sort(np.where(mask, abs_residual, np.inf), axis=1)
+    squares = np.where(np.isfinite(sorted_residual), sorted_residual, 0) ** 2
+    inlier_sum = np.concatenate([np.zeros((len(n), 1)), np.cumsum(squares, axis=1)], axis=1)
+    k = np.arange(inlier_sum.shape[1])[None, :]
+    denominator = n[:, None] - (n[:, None] - k) * epsilon ** 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        candidate = np.sqrt(inlier_sum / denominator)
+    # Scale of k inliers is valid when residual k-1 is inside and residual k outside epsilon * scale
+    lower = np.concatenate([np.zeros((len(n), 1)), sorted_residual], axis=1)
+    upper = np.concatenate([sorted_residual, np.full((len(n), 1), np.inf)], axis=1)
+    valid = ((denominator > 0) & (k <= n[:, None]) & (lower <= epsilon * candidate) &
+             (epsilon * candidate <= upper))
+    scale = np.take_along_axis(candidate, np.argmax(valid, axis=1)[:, None], axis=1)[:, 0]
+    scale[~valid.any(axis=1)] = MIN_SCALE
+    return np.maximum(np.nan_to_num(scale, nan=MIN_SCALE), MIN_SCALE)
+
+
+def get_huber_objective(x, y, mask, coef, intercept, scale, epsilon, alpha):
+    '''Objective of sklearn.linear_model.HuberRegressor for every row'''
+    abs_residual = np.abs(y - intercept[:, None] - coef[:, None] * x)
+    outliers = mask & (abs_residual > epsilon * scale[:, None])
+    inliers = mask & ~outliers
+    return (mask.sum(axis=1) * scale + (inliers * abs_residual ** 2).sum(axis=1) / scale +
+            2 * epsilon * (outliers * abs_residual).sum(axis=1) - scale * outliers.sum(axis=1) * epsilon ** 2 +
+            alpha * coef ** 2)
+
+
+def get_newton_step(x, y, mask, coef, intercept, scale, epsilon, alpha):
+    '''Newton step on (intercept, coef, scale) of every row for the current inlier/outlier split, and its Newton
+    decrement'''
+    n = mask.sum(axis=1)
+    residual = y - intercept[:, None] - coef[:, None] * x
+    outliers = mask & (np.abs(residual) > epsilon * scale[:, None])
+    inliers = (mask & ~outliers).astype(np.float64)
+    signs = outliers * np.sign(residual)
+    gradient = np.stack([-2 / scale * (inliers * residual).sum(axis=1) - 2 * epsilon * signs.sum(axis=1),
+                         -2 / scale * (inliers * residual * x).sum(axis=1) - 2 * epsilon * (signs * x).sum(axis=1)
+                         + 2 * alpha * coef,
+                         n - outliers.sum(axis=1) * epsilon ** 2 - (inliers * residual ** 2).sum(axis=1) / scale ** 2],
+                        axis=1)
+    hessian = np.empty((len(x), 3, 3))
+    hessian[:, 0, 0] = 2 / scale * inliers.sum(axis=1)
+    hessian[:, 0, 1] = hessian[:, 1, 0] = 2 / scale * (inliers * x).sum(axis=1)
+    hessian[:, 1, 1] = 2 / scale * (inliers * x * x).sum(axis=1) + 2 * alpha
+    hessian[:, 0, 2] = hessian[:, 2, 0] = 2 / scale ** 2 * (inliers * residual).sum(axis=1)
+    hessian[:, 1, 2] = hessian[:, 2, 1] = 2 / scale ** 2 * (inliers * residual * x).sum(axis=1)
+    hessian[:, 2, 2] = 2 / scale ** 3 * (inliers * residual ** 2).sum(axis=1)
+    # The objective is only positive semi definite when a row has few inliers
+    damping = 1e-10 * (np.abs(np.diagonal(hessian, axis1=1, axis2=2)).max(axis=1) + 1)
+    step = -np.linalg.solve(hessian + damping[:, None, None] * np.eye(3), gradient[:, :, None])[:, :, 0]
+    return step, -(gradient * step).sum(axis=1)
+
+
+def fit_huber(x, y, mask=None, epsilon=1.35, alpha=0.0001, max_iter=100, tol=1e-12):
+    '''Fit y = intercept + coef * x for every row of x and y at once, with the objective of
+    sklearn.linear_model.HuberRegressor(epsilon, alpha, fit_intercept=True): sum over samples of
+    scale + Huber(residual / scale) * scale, plus alpha * coef**2.
+    Starts from least squares with its optimal scale, then takes damped Newton steps on (intercept, coef, scale) of
+    all rows together. Between inlier/outlier changes the objective is smooth, and a backtracking line search keeps
+    every step a descent step of the convex objective. mask marks the real samples of padded rows.
+    Return coef, intercept, scale and outliers (|residual| > epsilon * scale, as HuberRegressor.outliers_)'''
+    x = np.atleast_2d(np.asarray(x, dtype=np.float64))
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    mask = np.ones(x.shape, dtype=bool) if mask is None else np.atleast_2d(np.asarray(mask, dtype=bool))
+    x = np.where(mask, x, 0)
+    y = np.where(mask, y, 0)
+    n = mask.sum(axis=1)
+    # Least squares start, rows without samples stay at 0
+    sx = x.sum(axis=1)
+    sxx = (x * x).sum(axis=1)
+    determinant = n * sxx - sx * sx
+    safe = determinant > 0
+    coef = np.where(safe, (n * (x * y).sum(axis=1) - sx * y.sum(axis=1)) / np.where(safe, determinant, 1), 0)
+    intercept = np.where(n > 0, (y.sum(axis=1) - coef * sx) / np.maximum(n, 1), 0)
+    scale = get_huber_scale(np.abs(y - intercept[:, None] - coef[:, None] * x), mask, epsilon)
+    objective = get_huber_objective(x, y, mask, coef, intercept, scale, epsilon, alpha)
+    active = n > 0
+    for _ in range(max_iter):
+        # Only rows that have not converged yet are updated
+        rows = np.flatnonzero(active)
+        if len(rows) == 0:
+            break
+        step, decrement = get_newton_step(x[rows], y[rows], mask[rows], coef[rows], intercept[rows], scale[rows],
+                                          epsilon, alpha)
+        moving = np.isfinite(decrement) & (decrement > tol * (1 + np.abs(objective[rows])))
+        rows, step, decrement = rows[moving], step[moving], decrement[moving]
+        # Scale can shrink at most tenfold per step, rows with an exact fit head to a zero scale and a full Newton
+        # step would take it below zero
+        t = np.minimum(1, 0.9 * scale[rows] / np.maximum(-step[:, 2], 1e-300))
+        new_objective = objective[rows]
+        # Backtracking line search, rows whose step is accepted leave the search
+        searching = np.arange(len(rows))
+        for _ in range(30):
+            if len(searching) == 0:
+                break
+            r = rows[searching]
+            ts = t[searching]
+            new_scale = scale[r] + ts * step[searching, 2]
+            positive = new_scale >= MIN_SCALE
+            candidate = get_huber_objective(x[r], y[r], mask[r], coef[r] + ts * step[searching, 1],
+                                            intercept[r] + ts * step[searching, 0],
+                                            np.where(positive, new_scale, scale[r]), epsilon, alpha)
+            accept = positive & (candidate <= objective[r] - 1e-4 * ts * decrement[searching])
+            new_objective[searching[accept]] = candidate[accept]
+            t[searching[~accept]] /= 2
+            searching = searching[~accept]
+        t[searching] = 0
+        active[:] = False
+        active[rows[t > 0]] = True
+        coef[rows] += t * step[:, 1]
+        intercept[rows] += t * step[:, 0]
+        scale[rows] += t * step[:, 2]
+        objective[rows] = np.where(t > 0, new_objective, objective[rows])
+    coef = np.where(n > 0, coef, np.nan)
+    intercept = np.where(n > 0, intercept, np.nan)
+    outliers = mask & (np.abs(y - intercept[:, None] - coef[:, None] * x) > epsilon * scale[:, None])
+    return coef, intercept, scale, outliers
+
+
+def fit_huber_ragged(xs, ys, epsilon=1.35, alpha=0.0001):
+    '''fit_huber on lists of samples of different lengths, outliers are returned as a list of boolean arrays'''
+    x, mask = pad_ragged(xs)
+    y, _ = pad_ragged(ys)
+    coef, intercept, scale, outliers = fit_huber(x, y, mask, epsilon, alpha)
+    return coef, intercept, scale, [outliers[i, :len(xi)] for i, xi in enumerate(xs)]
+
+
+def compare_with_sklearn(xs, ys, epsilon=1.35, alpha=0.0001, tol=1e-6):
+    '''Tolerance check of fit_huber_ragged against sklearn.linear_model.HuberRegressor on lists of samples. A segment
+    agrees when coef and intercept are within tol (relative to 1 + their size) of sklearn, or when its objective is
+    not above the sklearn objective by more than tol. The second case covers the segments where L-BFGS stops before
+    the minimum, above all those a line fits almost exactly: their scale goes to MIN_SCALE and the outliers of
+    sklearn can differ.
+    Return coef, intercept, objective, the same three of sklearn and whether each segment agrees'''
+    from sklearn.linear_model import HuberRegressor
+    coef, intercept, scale, _ = fit_huber_ragged(xs, ys, epsilon, alpha)
+    sklearn_fits = [HuberRegressor(epsilon=epsilon, alpha=alpha).fit(np.asarray(x, dtype=np.float64)[:, None], y)
+                    for x, y in zip(xs, ys)]
+    sklearn_coef = np.array([fit.coef_[0] for fit in sklearn_fits])
+    sklearn_intercept = np.array([fit.intercept_ for fit in sklearn_fits])
+    sklearn_scale = np.array([fit.scale_ for fit in sklearn_fits])
+    x, mask = pad_ragged(xs)
+    y, _ = pad_ragged(ys)
+    objective = get_huber_objective(x, y, mask, coef, intercept, scale, epsilon, alpha)
+    sklearn_objective = get_huber_objective(x, y, mask, sklearn_coef, sklearn_intercept, sklearn_scale, epsilon, alpha)
+    agree = ((np.abs(coef - sklearn_coef) <= tol * (1 + np.abs(sklearn_coef)))
+             & (np.abs(intercept - sklearn_intercept) <= tol * (1 + np.abs(sklearn_intercept)))
+             | (objective <= sklearn_objective + tol * (1 + np.abs(sklearn_objective))))
+    return coef, intercept, objective, sklearn_coef, sklearn_intercept, sklearn_objective, agree
+
+
+if __name__ == '__main__':
+    import model_utils as mu
+    import batch_forecast as bf
+    xs = []
+    ys = []
+    for scope in ['global', 'US']:
+        data_store = mu.get_data_store(scope)
+        for region, rows, lockdown_date in bf.get_regions(data_store, scope):
+            try:
+                log_daily_death, _, segments = mu.prepare_log_daily_death(data_store.get_local_data(rows, 'deaths'),
+                                                                          lockdown_date=lockdown_date)[:3]
+            except ValueError:
+                continue
+            xs.extend(log_daily_death.time_idx.values[segment] for segment in segments)
+            ys.extend(log_daily_death.death.values[segment] for segment in segments)
+    *_, agree = compare_with_sklearn(xs, ys)
+    print('{} of {} segments agree with HuberRegressor'.format(agree.sum(), len(agree)))
@@ -0,0 +1,110 @@
+import numpy as np
+from scipy import signal, stats
+
+# Continuous distributions are cut off at this many days
+MAX_STAY_DAYS = 120
+# Probability left in the tail when a continuous distribution is cut off
+TAIL_PROBABILITY = 1e-4
+# FFT rounding noise below this is set back to exactly 0
+FFT_NOISE = 1e-12
+
+
+def fft_convolve(a, b):
+    '''Full convolution of two non negative 1-D arrays with FFT, without the rounding noise it leaves on zeros'''
+    result = signal.fftconvolve(a, b)
+    result[result < FFT_NOISE * max(result.max(), 1)] = 0
+    return result
+
+
+class StayDistribution(object):
+    '''Discrete distribution of a transition time, pmf[k] is the probability that it takes k days'''
+
+    def __init__(self, pmf):
+        pmf = np.clip(np.asarray(pmf, dtype=float), 0, None)
+        if pmf.ndim != 1 or pmf.sum() <= 0:
+            raise ValueError('pmf must be a 1-D array with positive total probability')
+        self.pmf = pmf[:np.flatnonzero(pmf)[-1] + 1] / pmf.sum()
+        self.pmf.flags.writeable = False
+
+    def __eq__(self, other):
+        return isinstance(other, StayDistribution) and np.array_equal(self.pmf, other.pmf)
+
+    def __hash__(self):
+        return hash(self.pmf.tobytes())
+
+    def __repr__(self):
+        return 'StayDistribution(mean={:.2f}, days={})'.format(self.mean, len(self.pmf))
+
+    @classmethod
+    def fixed(cls, days):
+        '''Transition that always takes the same number of days, as the mean based model assumes'''
+        pmf = np.zeros(int(days) + 1)
+        pmf[int(days)] = 1
+        return cls(pmf)
+
+    @classmethod
+    def from_scipy(cls, distribution):
+        '''Round a frozen continuous scipy.stats distribution to whole days'''
+        last_day = int(min(np.ceil(distribution.ppf(1 - TAIL_PROBABILITY)), MAX_STAY_DAYS))
+        edges = np.concatenate([[0], np.arange(last_day + 1) + 0.5])
+        return cls(np.diff(distribution.cdf(edges)))
+
+    @classmethod
+    def gamma(cls, mean, sd):
+        return cls.from_scipy(stats.gamma((mean / sd) ** 2, scale=sd ** 2 / mean))
+
+    @classmethod
+    def lognormal(cls, mean, sd):
+        sigma2 = np.log(1 + (sd / mean) ** 2)
+        return cls.from_scipy(stats.lognorm(np.sqrt(sigma2), scale=mean * np.exp(-sigma2 / 2)))
+
+    @classmethod
+    def empirical(cls, counts):
+        '''Histogram of observed transition times, counts[k] is the number of stays of k days'''
+        return cls(counts)
+
+    @property
+    def mean(self):
+        return float(np.dot(np.arange(len(self.pmf)), self.pmf))
+
+    def survival(self):
+        '''survival[k] is the probability that the transition takes more than k days'''
+        return np.clip(1 - np.cumsum(self.pmf)[:-1], 0, None)
+
+
+def add_stays(*distributions):
+    '''Distribution of the sum of independent transition times'''
+    pmf = distributions[0].pmf
+    for distribution in distributions[1:]:
+        pmf = fft_convolve(pmf, distribution.pmf)
+    return StayDistribution(pmf)
+
+
+def get_death_stay_kernel(time_to_death):
+    '''Occupancy relative to the day of death of a patient who stays until death, time_to_death days after
+    admission. Return the kernel and the day offset of its first element'''
+    survival = time_to_death.survival()
+    if len(survival) == 0:
+        return np.zeros(1), 0
+    return survival[::-1], 1 - len(survival)
+
+
+def get_stay_kernel(time_to_death, stay):
+    '''Occupancy relative to the day of death of one death, of patients admitted together with the dead patient
+    (time_to_death days before the death) who then stay for stay days. Return the kernel and the day offset of its
+    first element'''
+    survival = stay.survival()
+    if len(survival) == 0:
+        return np.zeros(1), 0
+    return fft_convolve(time_to_death.pmf[::-1], survival), 2 - len(time_to_death.pmf)
+
+
+def combine_kernels(kernels):
+    '''Weighted sum of kernels given as (weight, kernel, first_offset). Return the kernel and the day offset of its
+    first element'''
+    first_offset = min(offset for _, _, offset in kernels)
+    last_offset = max(offset + len(kernel) - 1 for _, kernel, offset in kernels)
+    combined = np.zeros(last_offset - first_offset + 1)
+    for weight, kernel, offset in kernels:
+        combined[offset - first_offset:offset - first_offset + len(kernel)] += weight * kernel
+    return combined, first_offset
@@ -0,0 +1,143 @@
+import os
+import time
+import datetime as dt
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+import model_utils as mu
+import pwlf_mod as pwlf
+import huber as hb
+import batch_forecast as bf
+
+# Fewest days of data on each side of an estimated break
+MIN_SEGMENT_DAYS = 7
+# Largest standard error of an estimated break, its 95% range is then about 4 weeks wide
+MAX_STD_ERROR_DAYS = 7
+ESTIMATE_COLUMNS = ['lockdown_date', 'lower_date', 'upper_date', 'std_error_days', 'effective_date',
+                    'slope_change']
+
+
+def get_log_daily_death(local_death_data):
+    '''Same log of the 3 day average of the daily death as fit_log_daily_death, without the days with no death.
+    Return the days since the first date, the log daily death and the first date'''
+    if len(local_death_data) == 0:
+        raise ValueError('Not enough fatality data to estimate the lockdown date')
+    daily_local_death_new = mu.get_daily_data(local_death_data.sort_index())
+    with np.errstate(divide='ignore'):
+        log_daily_death = np.log(daily_local_death_new.rolling(3, min_periods=1).mean().values[:, 0])
+    day = (daily_local_death_new.index - daily_local_death_new.index[0]).days.values.astype(float)
+    finite = np.isfinite(log_daily_death)
+    return day[finite], log_daily_death[finite], daily_local_death_new.index[0]
+
+
+def estimate_breakpoint(x, y, min_segment_days=MIN_SEGMENT_DAYS):
+    '''Break of the best 2 segment continuous fit of y on x. The best whole day is found exactly by
+    PiecewiseLinFit.fit_discrete, then refined by PiecewiseLinFit.fit_guess on the day before and the day after it,
+    the sum of squared residuals can have a local minimum on each side. Return the better fit and the delta method
+    standard error of its break'''
+    if len(x) < 2 * min_segment_days:
+        raise ValueError('Not enough fatality data to estimate the lockdown date')
+    candidates = np.arange(np.ceil(x[min_segment_days - 1]), np.floor(x[-min_segment_days]) + 1)
+    if len(candidates) == 0:
+        raise ValueError('Not enough fatality data to estimate the lockdown date')
+    regr_pw = pwlf.PiecewiseLinFit(x, y)
+    best = regr_pw.fit_discrete(2, candidates=candidates)[1]
+    fits = []
+    for low, high in [(max(best - 1, candidates[0]), best), (best, min(best + 1, candidates[-1]))]:
+        regr_pw = pwlf.PiecewiseLinFit(x, y)
+        regr_pw.fit_guess([(low + high) / 2], bounds=np.array([[low, high]]))
+        fits.append(regr_pw)
+    regr_pw = min(fits, key=lambda regr_pw: regr_pw.ssr)
+    std_error = regr_pw.standard_errors(method='non-linear')[-1]
+    return regr_pw, std_error
+
+
+def estimate_lockdown_date(local_death_data, params=None):
+    '''Lockdown date of a region from the bend of its log daily death curve: the break of the 2 segment fit is the
+    lockdown effective date, the lockdown happened the infection to death delay before it. Outliers of both segments
+    are found by Huber fits and left out of a second fit. Return a Series with the estimated lockdown date, its 95%
+    range, the standard error in days, the effective date and the change of slope at the break, a lockdown flattens
+    the curve so the change is negative. Raise ValueError when the curve does not flatten at the break or the break
+    is too uncertain, such a bend is no lockdown date'''
+    params = params or mu.get_default_params()
+    x, y, start_date = get_log_daily_death(local_death_data)
+    regr_pw, _ = estimate_breakpoint(x, y)
+    before = x < regr_pw.fit_breaks[1]
+    _, _, _, outliers = hb.fit_huber_ragged([x[before], x[~before]], [y[before], y[~before]])
+    kept = ~np.concatenate(outliers)
+    if kept.sum() >= 2 * MIN_SEGMENT_DAYS:
+        regr_pw, std_error = estimate_breakpoint(x[kept], y[kept])
+    else:
+        regr_pw, std_error = estimate_breakpoint(x, y)
+    if regr_pw.beta[-1] >= 0:
+        raise ValueError('The death curve does not flatten, no lockdown date can be estimated')
+    if not np.isfinite(std_error) or std_error > MAX_STD_ERROR_DAYS:
+        raise ValueError('The bend of the death curve is too uncertain to estimate the lockdown date')
+    break_day = regr_pw.fit_breaks[1]
+    delay = params.INFECT_2_HOSPITAL_TIME + params.HOSPITAL_2_ICU_TIME + params.ICU_2_DEATH_TIME
+    lockdown_date = start_date + dt.timedelta(int(np.round(break_day)) - delay)
+    margin = dt.timedelta(int(np.ceil(1.96 * std_error)))
+    return pd.Series([lockdown_date, lockdown_date - margin, lockdown_date + margin, std_error,
+                      start_date + dt.timedelta(int(np.round(break_day))), regr_pw.beta[-1]], index=ESTIMATE_COLUMNS)
+
+
+def estimate_lockdown_date_by_country(country, params=None):
+    return estimate_lockdown_date(mu.get_data_by_country(country, type='deaths'), params=params)
+
+
+def estimate_lockdown_date_by_state_US(state, params=None):
+    return estimate_lockdown_date(mu.get_data_by_state(state, type='deaths'), params=params)
+
+
+def estimate_region(task):
+    '''Estimate the lockdown date of one region of batch_forecast.WORKER_STORE'''
+    region, rows, params = task
+    start = time.perf_counter()
+    try:
+        estimate = estimate_lockdown_date(bf.WORKER_STORE.get_local_data(rows, 'deaths'), params=params)
+    except Exception as e:
+        return region, None, '{}: {}'.format(type(e).__name__, e), time.perf_counter() - start
+    return region, estimate, None, time.perf_counter() - start
+
+
+def estimate_lockdown_dates(scope='global', regions=None, missing_only=True, max_workers=None, params=None):
+    '''Estimate the lockdown date of every country (scope global) or US state (scope US) in parallel from one load
+    of the data store. By default only the regions missing from the lockdown date table are estimated. Return one
+    row per region with the estimate of estimate_lockdown_date and the error of the regions that could not be
+    estimated'''
+    params = params or mu.get_default_params()
+    data_store = mu.get_data_store(scope)
+    tasks = [(region, rows, params) for region, rows, lockdown_date in bf.get_regions(data_store, scope)
+             if (regions is None or region in regions) and (not missing_only or lockdown_date is None)]
+    if max_workers == 1 or len(tasks) <= 1:
+        bf.WORKER_STORE = data_store
+        try:
+            results = [estimate_region(task) for task in tasks]
+        finally:
+            bf.WORKER_STORE = None
+    else:
+        max_workers = os.cpu_count() if max_workers is None else max_workers
+        memory, template = bf.share_data_store(data_store)
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=bf.init_worker,
+                                     initargs=(memory.name, data_store.values.shape, data_store.values.dtype,
+                                               template)) as executor:
+                results = list(executor.map(estimate_region, tasks,
+                                            chunksize=max(1, len(tasks) // (4 * max_workers))))
+        finally:
+            memory.close()
+            memory.unlink()
+    estimates = pd.DataFrame([estimate if estimate is not None else pd.Series(index=ESTIMATE_COLUMNS, dtype=object)
+                              for _, estimate, _, _ in results], columns=ESTIMATE_COLUMNS,
+                             index=pd.Index([region for region, _, _, _ in results], name='region'))
+    estimates['error'] = [error for _, _, error, _ in results]
+    estimates['seconds'] = [seconds for _, _, _, seconds in results]
+    return estimates
+
+
+if __name__ == '__main__':
+    for scope in ['global', 'US']:
+        start = time.perf_counter()
+        estimates = estimate_lockdown_dates(scope)
+        print('{}: estimated {} lockdown dates in {:.1f}s, {} failed'.format(
+            scope, len(estimates), time.perf_counter() - start, estimates['error'].notna().sum()))
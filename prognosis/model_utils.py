@@ -26,9 +26,16 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 import datetime as dt
-from sklearn import linear_model
+import os
+import dataclasses
+from scipy import signal
 import streamlit as st
 import pwlf_mod as pwlf
+import data_cache as dc
+import data_store as ds
+import errata as er
+import length_of_stay as los
+import huber as hb
 from csv import writer
 
 #DEATH_RATE = 0.01
@@ -40,15 +47,71 @@ from csv import writer
 #ICU_2_DEATH_TIME = 5
 #ICU_2_RECOVER_TIME = 11
 #NOT_ICU_DISCHARGE_TIME = 7
-
-
-def get_data(file_template='../csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_{type}_{scope}.csv',
-            type='deaths', scope='global'):
+# Defaults of ModelParams, a forecast called without params uses their current values
+DEATH_RATE = 0.36
+ICU_RATE = 0.78
+HOSPITAL_RATE = 2.18
+SYMPTOM_RATE = 10.2
+INFECT_2_HOSPITAL_TIME = 11
+HOSPITAL_2_ICU_TIME = 4
+ICU_2_DEATH_TIME = 4
+ICU_2_RECOVER_TIME = 7
+NOT_ICU_DISCHARGE_TIME = 5
+# Length of stay distributions by name of the transition time above, e.g.
+# {'ICU_2_RECOVER_TIME': los.StayDistribution.gamma(mean=7, sd=3)}. Transitions not listed take exactly their time
+STAY_DISTRIBUTIONS = {}
+
+TIME_SERIES_FILE_TEMPLATE = '../csse_covid_19_data/csse_covid_19_time_series/time_series_covid19_{type}_{scope}.csv'
+LOOKUP_TABLE_FILE = '../csse_covid_19_data/UID_ISO_FIPS_LookUp_Table.csv'
+SCOPE_TYPES = {'global': ['deaths', 'confirmed', 'recovered'],
+               'US': ['deaths', 'confirmed']}
+DATA_STORE = {}
+# Models of fit_log_daily_death, chosen by the data there is around the lockdown effective date
+NO_LOCKDOWN, DEFAULT_SECOND_MODEL, TWO_SEGMENTS = 1, 2, 3
+# Slope change after lockdown of DEFAULT_SECOND_MODEL, learning from local with same temperature, transportation
+DEFAULT_SECOND_SLOPE = -0.2
+
+
+@dataclasses.dataclass(frozen=True)
+class ModelParams(object):
+    '''Every model parameter a forecast depends on. Frozen and hashable, so one session can not change the
+    parameters of another and they can be part of a cache key. STAY_DISTRIBUTIONS can be given as a dict, it is
+    kept as a sorted tuple of (name, distribution)'''
+    DEATH_RATE: float = DEATH_RATE
+    ICU_RATE: float = ICU_RATE
+    HOSPITAL_RATE: float = HOSPITAL_RATE
+    SYMPTOM_RATE: float = SYMPTOM_RATE
+    INFECT_2_HOSPITAL_TIME: int = INFECT_2_HOSPITAL_TIME
+    HOSPITAL_2_ICU_TIME: int = HOSPITAL_2_ICU_TIME
+    ICU_2_DEATH_TIME: int = ICU_2_DEATH_TIME
+    ICU_2_RECOVER_TIME: int = ICU_2_RECOVER_TIME
+    NOT_ICU_DISCHARGE_TIME: int = NOT_ICU_DISCHARGE_TIME
+    STAY_DISTRIBUTIONS: tuple = ()
+
+    def __post_init__(self):
+        object.__setattr__(self, 'STAY_DISTRIBUTIONS', tuple(sorted(dict(self.STAY_DISTRIBUTIONS).items())))
+
+    def replace(self, **changes):
+        return dataclasses.replace(self, **changes)
+
+    def get_stay_distributions(self):
+        return dict(self.STAY_DISTRIBUTIONS)
+
+    def to_dict(self):
+        return {field.name: getattr(self, field.name) for field in dataclasses.fields(self)}
+
+
+def get_default_params():
+    '''Parameters from the module globals, for scripts that set them before forecasting'''
+    return ModelParams(**{field.name: globals()[field.name] for field in dataclasses.fields(ModelParams)})
+
+
+def get_data(file_template=TIME_SERIES_FILE_TEMPLATE, type='deaths', scope='global'):
     """
     type = enum('deaths', 'confirmed', 'recovered'),
     scope = enum('global', 'US')
     """
-    death_data = pd.read_csv(file_template.format(type=type, scope=scope))
+    death_data = dc.read_csv_cached(file_template.format(type=type, scope=scope))
     return death_data.rename(index=str, columns={"Country/Region": "Country",
                                                  "Province/State": "State",
                                                  "Country_Region": "Country",
@@ -56,25 +119,48 @@ def get_data(file_template='../csse_covid_19_data/csse_covid_19_time_series/time
                                                  "Admin2": "County"})
 
 
+def get_data_store(scope='global'):
+    '''All metrics of one scope in a single region x date x metric array, corrected with Errata.csv. It is built
+    once per data load and rebuilt when one of the csv files changes'''
+    csv_files = [TIME_SERIES_FILE_TEMPLATE.format(type=type, scope=scope) for type in SCOPE_TYPES[scope]]
+    csv_files.append(LOOKUP_TABLE_FILE)
+    if os.path.exists(er.ERRATA_FILE):
+        csv_files.append(er.ERRATA_FILE)
+    key = tuple(dc.get_cache_key(csv_file) for csv_file in csv_files)
+    data_store = DATA_STORE.get(scope)
+    if data_store is None or data_store.key != key:
+        tables = {type: get_data(type=type, scope=scope) for type in SCOPE_TYPES[scope]}
+        data_store = ds.DataStore(tables, lookup=pd.read_csv(LOOKUP_TABLE_FILE), key=key)
+        if os.path.exists(er.ERRATA_FILE):
+            er.apply_errata(data_store, er.compile_errata(er.get_errata(), data_store, scope))
+        DATA_STORE[scope] = data_store
+    return data_store
+
+
+def refresh_time_series():
+    '''Append the new days of every time series csv to its cache and rewrite only corrected days.
+    Return {(type, scope): (new_days, changed_days)}'''
+    updates = {}
+    for scope, types in SCOPE_TYPES.items():
+        for type in types:
+            _, new_days, changed_days = dc.update_csv_cache(TIME_SERIES_FILE_TEMPLATE.format(type=type, scope=scope))
+            updates[(type, scope)] = (new_days, changed_days)
+    return updates
+
+
 def get_data_by_country(country, type='deaths'):
-    global_data = get_data(scope='global', type=type)
-    local_data = global_data.query('Country == "{}"'.format(country)).iloc[:,4:].T.sum(axis=1).to_frame()
-    local_data.index = pd.to_datetime(local_data.index)
-    return local_data[local_data>0].dropna()
+    data_store = get_data_store(scope='global')
+    return data_store.get_local_data(data_store.index.get_rows(country=country), type)
 
 
 def get_data_by_state(state, type='deaths'):
-    US_data = get_data(scope='US', type=type)
-    local_data = US_data.query('State == "{}"'.format(state)).iloc[:,12:].T.sum(axis=1).to_frame()
-    local_data.index = pd.to_datetime(local_data.index)
-    return local_data[local_data>0].dropna()
+    data_store = get_data_store(scope='US')
+    return data_store.get_local_data(data_store.index.get_rows(state=state), type)
 
 
 def get_data_by_county_and_state(county, state, type='deaths'):
-    US_data = get_data(scope='US', type=type)
-    local_data = US_data.query('County == "{}" and State == "{}"'.format(county, state)).iloc[:,12:].T.sum(axis=1).to_frame()
-    local_data.index = pd.to_datetime(local_data.index)
-    return local_data[local_data>0].dropna()
+    data_store = get_data_store(scope='US')
+    return data_store.get_local_data(data_store.index.get_rows(county=county, state=state), type)
 
 
 def get_lockdown_date_global(csv_file='data/lockdown_date_country.csv'):
@@ -114,100 +200,268 @@ def get_impute_from_death(death_row, periods, end_date_offset=0):
     return pd.DataFrame(death_row.tolist()*periods, index=date_range)
 
 
-def get_hospital_beds_from_death(death_row):
+def get_hospital_beds_from_death(death_row, params=None):
     '''Get imputation of hospital beds needed from one day record of new death'''
-    dead_hospital_use_periods = HOSPITAL_2_ICU_TIME+ICU_2_DEATH_TIME
+    params = params or get_default_params()
+    dead_hospital_use_periods = params.HOSPITAL_2_ICU_TIME+params.ICU_2_DEATH_TIME
     dead_hospital_use = get_impute_from_death(death_row=death_row, 
                                               periods=dead_hospital_use_periods)
-    ICU_recovered_hospital_use_periods = HOSPITAL_2_ICU_TIME+ICU_2_RECOVER_TIME+NOT_ICU_DISCHARGE_TIME
-    ICU_recovered_hospital_use_end_date_offset = ICU_2_RECOVER_TIME-ICU_2_DEATH_TIME+NOT_ICU_DISCHARGE_TIME
+    ICU_recovered_hospital_use_periods = \
+        params.HOSPITAL_2_ICU_TIME+params.ICU_2_RECOVER_TIME+params.NOT_ICU_DISCHARGE_TIME
+    ICU_recovered_hospital_use_end_date_offset = \
+        params.ICU_2_RECOVER_TIME-params.ICU_2_DEATH_TIME+params.NOT_ICU_DISCHARGE_TIME
     ICU_recovered_hospital_use = get_impute_from_death(death_row=death_row, 
                                                        periods=ICU_recovered_hospital_use_periods,
                                                        end_date_offset=ICU_recovered_hospital_use_end_date_offset)
-    no_ICU_hospital_use_periods = NOT_ICU_DISCHARGE_TIME
-    no_ICU_hospital_use_end_date_offset = -HOSPITAL_2_ICU_TIME-ICU_2_DEATH_TIME+NOT_ICU_DISCHARGE_TIME
+    no_ICU_hospital_use_periods = params.NOT_ICU_DISCHARGE_TIME
+    no_ICU_hospital_use_end_date_offset = \
+        -params.HOSPITAL_2_ICU_TIME-params.ICU_2_DEATH_TIME+params.NOT_ICU_DISCHARGE_TIME
     no_ICU_hospital_use = get_impute_from_death(death_row=death_row, 
                                                 periods=no_ICU_hospital_use_periods,
                                                 end_date_offset=no_ICU_hospital_use_end_date_offset)
-    hospital_beds = dead_hospital_use.add(((ICU_RATE-DEATH_RATE)/DEATH_RATE)*ICU_recovered_hospital_use, fill_value=0)\
-            .add(((HOSPITAL_RATE-ICU_RATE)/DEATH_RATE)*no_ICU_hospital_use, fill_value=0)
+    hospital_beds = dead_hospital_use.add(((params.ICU_RATE-params.DEATH_RATE)/params.DEATH_RATE)
+                                          * ICU_recovered_hospital_use, fill_value=0)\
+            .add(((params.HOSPITAL_RATE-params.ICU_RATE)/params.DEATH_RATE)*no_ICU_hospital_use, fill_value=0)
     hospital_beds.columns = ['hospital_beds']
     return hospital_beds
 
 
-def get_ICU_from_death(death_row):
+def get_ICU_from_death(death_row, params=None):
     '''Get imputation of ICU needed from one day record of new death'''
-    dead_ICU_use = get_impute_from_death(death_row=death_row, periods=ICU_2_DEATH_TIME)
-    recovered_ICU_use_end_date_offset = ICU_2_RECOVER_TIME-ICU_2_DEATH_TIME
+    params = params or get_default_params()
+    dead_ICU_use = get_impute_from_death(death_row=death_row, periods=params.ICU_2_DEATH_TIME)
+    recovered_ICU_use_end_date_offset = params.ICU_2_RECOVER_TIME-params.ICU_2_DEATH_TIME
     recovered_ICU_use = get_impute_from_death(death_row=death_row, 
-                                              periods=ICU_2_RECOVER_TIME,
+                                              periods=params.ICU_2_RECOVER_TIME,
                                               end_date_offset=recovered_ICU_use_end_date_offset)
-    ICU_n = dead_ICU_use.add(((ICU_RATE-DEATH_RATE)/DEATH_RATE)*recovered_ICU_use, fill_value=0)
+    ICU_n = dead_ICU_use.add(((params.ICU_RATE-params.DEATH_RATE)/params.DEATH_RATE)*recovered_ICU_use, fill_value=0)
     ICU_n.columns = ['ICU']
     return ICU_n
 
 
-def get_infected_cases(local_death_data):
+def get_infected_cases(local_death_data, params=None):
     '''This number only is close to number of confirmed case in country very early in the disease and 
     can still do contact tracing or very wide testing, eg. South Korea, Germany'''
-    delay_time = INFECT_2_HOSPITAL_TIME + HOSPITAL_2_ICU_TIME + ICU_2_DEATH_TIME
-    infected_cases = (100/DEATH_RATE)*local_death_data.tshift(-delay_time)
+    params = params or get_default_params()
+    delay_time = params.INFECT_2_HOSPITAL_TIME + params.HOSPITAL_2_ICU_TIME + params.ICU_2_DEATH_TIME
+    infected_cases = (100/params.DEATH_RATE)*local_death_data.shift(-delay_time, freq='D')
     infected_cases.columns = ['infected']
     return infected_cases
 
 
-def get_symptomatic_cases(local_death_data):
+def get_symptomatic_cases(local_death_data, params=None):
     '''This is number of cases that show clear symptoms (severe),
     in country without investigative testing this is close to number of confirmed case, most country'''
-    delay_time = HOSPITAL_2_ICU_TIME + ICU_2_DEATH_TIME
-    symptomatic_cases = (SYMPTOM_RATE/DEATH_RATE)*local_death_data.tshift(-delay_time)
+    params = params or get_default_params()
+    delay_time = params.HOSPITAL_2_ICU_TIME + params.ICU_2_DEATH_TIME
+    symptomatic_cases = (params.SYMPTOM_RATE/params.DEATH_RATE)*local_death_data.shift(-delay_time, freq='D')
     symptomatic_cases.columns = ['symptomatic']
     return symptomatic_cases
 
 
-def get_hospitalized_cases(local_death_data):
+def get_hospitalized_cases(local_death_data, params=None):
     '''In country with severe lack of testing, this is close to number of confirmed case, eg. Italy, Iran'''
-    delay_time = HOSPITAL_2_ICU_TIME + ICU_2_DEATH_TIME
-    hospitalized_cases = (HOSPITAL_RATE/DEATH_RATE)*local_death_data.tshift(-delay_time)
+    params = params or get_default_params()
+    delay_time = params.HOSPITAL_2_ICU_TIME + params.ICU_2_DEATH_TIME
+    hospitalized_cases = (params.HOSPITAL_RATE/params.DEATH_RATE)*local_death_data.shift(-delay_time, freq='D')
     hospitalized_cases.columns = ['hospitalized']
     return hospitalized_cases
 
 
-def get_number_hospital_beds_need(daily_local_death_new):
+def get_occupancy_kernel(stays):
+    '''Occupancy caused by one death, from stays given as (weight, first_day, last_day) relative to the day of death.
+    Return the kernel and the day offset of its first element'''
+    first_offset = min(first_day for _, first_day, _ in stays)
+    last_offset = max(last_day for _, _, last_day in stays)
+    kernel = np.zeros(last_offset - first_offset + 1)
+    for weight, first_day, last_day in stays:
+        kernel[first_day - first_offset:last_day - first_offset + 1] += weight
+    return kernel, first_offset
+
+
+def get_hospital_beds_mean_kernel(params=None):
+    '''Same stays as get_hospital_beds_from_death: dead patients, ICU patients who recover and patients who never
+    need ICU'''
+    params = params or get_default_params()
+    return get_occupancy_kernel([
+        (1.0, -(params.HOSPITAL_2_ICU_TIME+params.ICU_2_DEATH_TIME)+1, 0),
+        ((params.ICU_RATE-params.DEATH_RATE)/params.DEATH_RATE,
+         -(params.HOSPITAL_2_ICU_TIME+params.ICU_2_DEATH_TIME)+1,
+         params.ICU_2_RECOVER_TIME-params.ICU_2_DEATH_TIME+params.NOT_ICU_DISCHARGE_TIME),
+        ((params.HOSPITAL_RATE-params.ICU_RATE)/params.DEATH_RATE,
+         -(params.HOSPITAL_2_ICU_TIME+params.ICU_2_DEATH_TIME)+1,
+         -params.HOSPITAL_2_ICU_TIME-params.ICU_2_DEATH_TIME+params.NOT_ICU_DISCHARGE_TIME)])
+
+
+def get_ICU_mean_kernel(params=None):
+    '''Same stays as get_ICU_from_death: dead patients and ICU patients who recover'''
+    params = params or get_default_params()
+    return get_occupancy_kernel([
+        (1.0, -params.ICU_2_DEATH_TIME+1, 0),
+        ((params.ICU_RATE-params.DEATH_RATE)/params.DEATH_RATE, -params.ICU_2_DEATH_TIME+1,
+         params.ICU_2_RECOVER_TIME-params.ICU_2_DEATH_TIME)])
+
+
+def get_stay_distribution(name, params=None):
+    '''Distribution of a transition time from STAY_DISTRIBUTIONS, or its fixed mean time'''
+    params = params or get_default_params()
+    stay_distributions = params.get_stay_distributions()
+    if name in stay_distributions:
+        return stay_distributions[name]
+    return los.StayDistribution.fixed({'HOSPITAL_2_ICU_TIME': params.HOSPITAL_2_ICU_TIME,
+                                       'ICU_2_DEATH_TIME': params.ICU_2_DEATH_TIME,
+                                       'ICU_2_RECOVER_TIME': params.ICU_2_RECOVER_TIME,
+                                       'NOT_ICU_DISCHARGE_TIME': params.NOT_ICU_DISCHARGE_TIME}[name])
+
+
+def get_hospital_beds_kernel(params=None):
+    '''Hospital bed occupancy caused by one death, using STAY_DISTRIBUTIONS when set. Return the kernel and the
+    day offset of its first element'''
+    params = params or get_default_params()
+    if not params.STAY_DISTRIBUTIONS:
+        return get_hospital_beds_mean_kernel(params=params)
+    hospital_2_ICU = get_stay_distribution('HOSPITAL_2_ICU_TIME', params=params)
+    not_ICU_discharge = get_stay_distribution('NOT_ICU_DISCHARGE_TIME', params=params)
+    hospital_2_death = los.add_stays(hospital_2_ICU, get_stay_distribution('ICU_2_DEATH_TIME', params=params))
+    ICU_recover_stay = los.add_stays(hospital_2_ICU, get_stay_distribution('ICU_2_RECOVER_TIME', params=params),
+                                     not_ICU_discharge)
+    return los.combine_kernels([
+        (1.0,) + los.get_death_stay_kernel(hospital_2_death),
+        ((params.ICU_RATE-params.DEATH_RATE)/params.DEATH_RATE,)
+        + los.get_stay_kernel(hospital_2_death, ICU_recover_stay),
+        ((params.HOSPITAL_RATE-params.ICU_RATE)/params.DEATH_RATE,)
+        + los.get_stay_kernel(hospital_2_death, not_ICU_discharge)])
+
+
+def get_ICU_kernel(params=None):
+    '''ICU occupancy caused by one death, using STAY_DISTRIBUTIONS when set. Return the kernel and the day offset
+    of its first element'''
+    params = params or get_default_params()
+    if not params.STAY_DISTRIBUTIONS:
+        return get_ICU_mean_kernel(params=params)
+    ICU_2_death = get_stay_distribution('ICU_2_DEATH_TIME', params=params)
+    return los.combine_kernels([
+        (1.0,) + los.get_death_stay_kernel(ICU_2_death),
+        ((params.ICU_RATE-params.DEATH_RATE)/params.DEATH_RATE,)
+        + los.get_stay_kernel(ICU_2_death, get_stay_distribution('ICU_2_RECOVER_TIME', params=params))])
+
+
+def get_occupancy_window(kernel, first_offset, drop_last):
+    '''First and last day of the occupancy estimate, relative to the first and last day of death data, when the
+    last drop_last days of the full convolution with kernel are dropped'''
+    return first_offset, first_offset + len(kernel) - 1 - drop_last
+
+
+def get_hospital_beds_window(params=None):
+    '''Days covered by the hospital bed estimate. They only depend on the mean times, so distributions do not
+    change the dates of the estimate'''
+    params = params or get_default_params()
+    return get_occupancy_window(*get_hospital_beds_mean_kernel(params=params),
+                                params.HOSPITAL_2_ICU_TIME+params.ICU_2_RECOVER_TIME+params.NOT_ICU_DISCHARGE_TIME)
+
+
+def get_ICU_window(params=None):
+    '''Days covered by the ICU estimate, see get_hospital_beds_window'''
+    params = params or get_default_params()
+    return get_occupancy_window(*get_ICU_mean_kernel(params=params), params.ICU_2_RECOVER_TIME)
+
+
+def convolve_occupancy(daily_death_new, kernel, first_offset, window, method='direct'):
+    '''Convolve every row of a (regions, days) array of daily new death with an occupancy kernel in one call and
+    keep the days of window. method='fft' is faster on many rows with a long kernel, at the cost of rounding noise'''
+    daily_death_new = np.atleast_2d(np.asarray(daily_death_new, dtype=float))
+    if method == 'fft':
+        occupancy = signal.fftconvolve(daily_death_new, kernel[None, :], axes=1)
+    else:
+        occupancy = signal.convolve2d(daily_death_new, kernel[None, :])
+    start = window[0] - first_offset
+    stop = max(daily_death_new.shape[1] + window[1] - first_offset, start)
+    pad_before = max(-start, 0)
+    pad_after = max(stop - occupancy.shape[1], 0)
+    if pad_before > 0 or pad_after > 0:
+        occupancy = np.pad(occupancy, ((0, 0), (pad_before, pad_after)))
+    return occupancy[:, start + pad_before:stop + pad_before]
+
+
+def apply_occupancy_kernel(daily_local_death_new, kernel, first_offset, window):
+    '''Convolve daily new death (consecutive days) with an occupancy kernel, keep the days of window'''
+    occupancy = convolve_occupancy(np.ravel(daily_local_death_new.values), kernel, first_offset, window)[0]
+    index = pd.date_range(start=daily_local_death_new.index[0] + dt.timedelta(int(window[0])),
+                          periods=len(occupancy))
+    return pd.DataFrame(occupancy, index=index)
+
+
+def get_number_hospital_beds_need(daily_local_death_new, params=None):
     '''Calculate number of hospital bed needed from number of daily new death '''
-    # Start by first date
-    hospital_beds = get_hospital_beds_from_death(daily_local_death_new.iloc[0])
-    # Run through all days
-    for i in range(len(daily_local_death_new)-1):
-        hospital_beds = hospital_beds.add(get_hospital_beds_from_death(daily_local_death_new.iloc[i+1]), 
-                                          fill_value=0)
-    hospital_beds = hospital_beds.iloc[:-(HOSPITAL_2_ICU_TIME+ICU_2_RECOVER_TIME+NOT_ICU_DISCHARGE_TIME)]
+    params = params or get_default_params()
+    hospital_beds = apply_occupancy_kernel(daily_local_death_new, *get_hospital_beds_kernel(params=params),
+                                           get_hospital_beds_window(params=params))
+    hospital_beds.columns = ['hospital_beds']
     return hospital_beds
 
 
-def get_number_ICU_need(daily_local_death_new):
+def get_number_ICU_need(daily_local_death_new, params=None):
     '''Calculate number of ICU needed from number of daily new death '''
-    # Start by first date
-    ICU_n = get_ICU_from_death(daily_local_death_new.iloc[0])
-    # Run through all days
-    for i in range(len(daily_local_death_new)-1):
-        ICU_n = ICU_n.add(get_ICU_from_death(daily_local_death_new.iloc[i+1]), fill_value=0)
-    ICU_n = ICU_n.iloc[:-ICU_2_RECOVER_TIME]
+    params = params or get_default_params()
+    ICU_n = apply_occupancy_kernel(daily_local_death_new, *get_ICU_kernel(params=params),
+                                   get_ICU_window(params=params))
+    ICU_n.columns = ['ICU']
     return ICU_n
 
 
-def get_log_daily_predicted_death(local_death_data, forecast_horizon=60, lockdown_date=None,
-                                  relax_date=None, contain_rate=0.5, test_rate=0.2):
-    '''Since this is highly contagious disease. Daily new death, which is a proxy for daily new infected cases
-    is model as d(t)=a*d(t-1) or equivalent to d(t) = b*a^(t). After a log transform, it becomes linear.
-    log(d(t))=logb+t*loga, so we can use linear regression to provide forecast (use robust linear regressor to avoid
-    data anomaly in death reporting)
-    There are two seperate linear curves, one before the lockdown is effective(21 days after lockdown) and one after
-    For using this prediction to infer back the other metrics (infected cases, hospital, ICU, etc..) only the before
-    curve is used and valid. If we assume there is no new infection after lock down (perfect lockdown), the after
-    curve only depends on the distribution of time to death since ICU.
-    WARNING: if lockdown_date is not provided, we will default to no lockdown to raise awareness of worst case
-    if no action. If you have info on lockdown date please use it to make sure the model provide accurate result'''
+def get_occupancy_by_region(daily_death_new, params=None):
+    '''Hospital beds and ICU needed by many regions in one call. daily_death_new is a (regions, days) array or a
+    DataFrame with one row per region and one column per consecutive day. Return (hospital_beds, ICU) of the same
+    type, row i is get_number_hospital_beds_need and get_number_ICU_need of row i of daily_death_new'''
+    params = params or get_default_params()
+    beds_window = get_hospital_beds_window(params=params)
+    ICU_window = get_ICU_window(params=params)
+    hospital_beds = convolve_occupancy(daily_death_new, *get_hospital_beds_kernel(params=params), beds_window)
+    ICU_n = convolve_occupancy(daily_death_new, *get_ICU_kernel(params=params), ICU_window)
+    if not isinstance(daily_death_new, pd.DataFrame):
+        return hospital_beds, ICU_n
+    start_date = pd.to_datetime(daily_death_new.columns[0])
+    hospital_beds = pd.DataFrame(hospital_beds, index=daily_death_new.index,
+                                 columns=pd.date_range(start_date + dt.timedelta(int(beds_window[0])),
+                                                       periods=hospital_beds.shape[1]))
+    ICU_n = pd.DataFrame(ICU_n, index=daily_death_new.index,
+                         columns=pd.date_range(start_date + dt.timedelta(int(ICU_window[0])),
+                                               periods=ICU_n.shape[1]))
+    return hospital_beds, ICU_n
+
+
+def get_model_branch(data_end_date_idx, forecast_horizon):
+    '''Model of fit_log_daily_death for the time index of the last data day relative to the lockdown effective date:
+    NO_LOCKDOWN when the lockdown is not effective in the forecast range, DEFAULT_SECOND_MODEL when there are not
+    enough days after it to fit the second slope and TWO_SEGMENTS otherwise. data_end_date_idx can be an array'''
+    data_end_date_idx = np.asarray(data_end_date_idx)
+    return np.where(data_end_date_idx + forecast_horizon < 0, NO_LOCKDOWN,
+                    np.where(data_end_date_idx <= 3, DEFAULT_SECOND_MODEL, TWO_SEGMENTS))
+
+
+def get_outlier_segments(time_idx, branch):
+    '''Masks of the days of the robust fits that find outliers: the days before the lockdown effective date and, for
+    the two segment model only, the days after it. time_idx and branch can hold one row per cutoff'''
+    return time_idx < 0, (time_idx >= 0) & (np.asarray(branch) == TWO_SEGMENTS)[..., None]
+
+
+def get_out_of_sample_variance(prediction_variance, oos_step_variance, time_idx, data_end_date_idx):
+    '''Variance of the log daily death at time_idx after the last data day. The two segment model, oos_step_variance
+    None or nan, extrapolates the prediction variance of its fit, the other models have a random walk error of
+    oos_step_variance per day. The arguments can hold one row per cutoff'''
+    oos_step_variance = np.asarray(np.nan if oos_step_variance is None else oos_step_variance, dtype=float)[..., None]
+    return np.where(np.isnan(oos_step_variance), prediction_variance,
+                    oos_step_variance * (time_idx - np.asarray(data_end_date_idx)[..., None]))
+
+
+def prepare_log_daily_death(local_death_data, forecast_horizon=60, lockdown_date=None, params=None):
+    '''Log daily death of fit_log_daily_death and its model before any fit. Return the log daily death with its time
+    index relative to the lockdown effective date, the model branch, the masks of the segments of the robust fits,
+    the break points, the forecast dates and their time index, the time index of the last data day and the lockdown
+    effective date'''
+    params = params or get_default_params()
+    if len(local_death_data) == 0:
+        raise ValueError('Not enough fatality data to fit the death curve')
     daily_local_death_new = get_daily_data(local_death_data)
     daily_local_death_new = daily_local_death_new.rolling(3, min_periods=1).mean()
     #shift ahead 1 day to avoid overfitted due to average of exponential value
@@ -225,7 +479,7 @@ def get_log_daily_predicted_death(local_death_data, forecast_horizon=60, lockdow
     else:
         lockdown_date = forecast_end_date
     lockdown_effective_date = lockdown_date + dt.timedelta(
-        INFECT_2_HOSPITAL_TIME + HOSPITAL_2_ICU_TIME + ICU_2_DEATH_TIME)
+        params.INFECT_2_HOSPITAL_TIME + params.HOSPITAL_2_ICU_TIME + params.ICU_2_DEATH_TIME)
     data_start_date_idx = (data_start_date - lockdown_effective_date).days
     data_end_date_idx = (data_end_date - lockdown_effective_date).days
     forecast_end_date_idx = data_end_date_idx + forecast_horizon
@@ -233,74 +487,225 @@ def get_log_daily_predicted_death(local_death_data, forecast_horizon=60, lockdow
     data_time_idx = (log_daily_death.index - lockdown_effective_date).days.values
     log_daily_death['time_idx'] = data_time_idx
     log_daily_death = log_daily_death.replace([np.inf, -np.inf], np.nan).dropna()
-    log_daily_death_before = log_daily_death[log_daily_death.time_idx < 0]
-    regr_before = linear_model.HuberRegressor(fit_intercept=True)
-    regr_before.fit(log_daily_death_before.time_idx.values.reshape(-1, 1), log_daily_death_before.death)
-    outliers_before = regr_before.outliers_
-    log_predicted_death_before_values = regr_before.predict(forecast_time_idx[forecast_time_idx < 0].reshape(-1, 1))
-    log_predicted_death_before_index = forecast_date_index[forecast_time_idx < 0]
-    log_predicted_death_before = pd.DataFrame(log_predicted_death_before_values,
-                                              index=log_predicted_death_before_index)
-    if all(forecast_time_idx < 0):
-        print("Lockdown is not effective in forecast range. Second model not needed")
-        outliers = outliers_before
-        regr_pw = pwlf.PiecewiseLinFit(x=log_daily_death[~outliers].time_idx.values, y=log_daily_death[~outliers].death)
+    branch = get_model_branch(data_end_date_idx, forecast_horizon)
+    # Robust fits of the curves before and after lockdown, only used to find outliers
+    before, after = get_outlier_segments(log_daily_death.time_idx.values, branch)
+    segments = [before, after] if branch == TWO_SEGMENTS else [before]
+    if not all(segment.any() for segment in segments):
+        raise ValueError('Not enough fatality data to fit the death curve')
+    if branch == NO_LOCKDOWN:
         break_points = np.array([data_start_date_idx, data_end_date_idx])
-        regr_pw.fit_with_breaks(break_points)
-        variance = regr_pw.variance()
-        log_predicted_death_pred_var_oos = variance * (forecast_time_idx[forecast_time_idx > data_end_date_idx] -
-                                                       data_end_date_idx)
-    elif all(data_time_idx <= 3):
-        print("Use default second model due to not enough data")
-
-        if (len(log_daily_death) - len(outliers_before))>0:
-            outliers_after = np.array([False] * (len(log_daily_death) - len(outliers_before)))
-            outliers = np.concatenate((outliers_before, outliers_after))
-        else:
-            outliers = outliers_before
-        regr_pw = pwlf.PiecewiseLinFit(x=log_daily_death[~outliers].time_idx.values, y=log_daily_death[~outliers].death)
+    elif branch == DEFAULT_SECOND_MODEL:
         break_points = np.array([data_start_date_idx, 0, forecast_end_date_idx])
-        regr_pw.fit_with_breaks(break_points)
-        # Replace second slope by default value, learning from local with same temperature, transportation
-        regr_pw.beta[2]= -0.2
-        variance = regr_pw.variance()
-        log_predicted_death_pred_var_oos = variance*(forecast_time_idx[forecast_time_idx>data_end_date_idx]-
-                                                     data_end_date_idx)
-        print(regr_pw.variance())
-        print(len(forecast_time_idx[forecast_time_idx>data_end_date_idx]))
     else:
-        regr_after = linear_model.HuberRegressor(fit_intercept=True)
-        log_daily_death_after = log_daily_death[log_daily_death.time_idx >= 0]
-        regr_after.fit(log_daily_death_after.time_idx.values.reshape(-1, 1),
-                       log_daily_death_after.death)
-        outliers_after = regr_after.outliers_
-        outliers = np.concatenate((outliers_before, outliers_after))
-        regr_pw = pwlf.PiecewiseLinFit(x=log_daily_death[~outliers].time_idx.values, y=log_daily_death[~outliers].death)
         break_points = np.array([data_start_date_idx, 0, data_end_date_idx])
-        regr_pw.fit_with_breaks(break_points)
-        log_predicted_death_pred_var = regr_pw.prediction_variance(forecast_time_idx)
-        log_predicted_death_pred_var_oos = log_predicted_death_pred_var[sum(forecast_time_idx <= data_end_date_idx):]
+    return (log_daily_death, branch, segments, break_points, forecast_date_index, forecast_time_idx, data_end_date_idx,
+            lockdown_effective_date)
+
+
+def get_inlier_model(prepared, segment_outliers):
+    '''Piecewise linear model, not fit yet, of the result of prepare_log_daily_death without the outliers of the
+    robust fit of each of its segments'''
+    log_daily_death, _, segments = prepared[:3]
+    outliers = np.zeros(len(log_daily_death), dtype=bool)
+    for segment, segment_outlier in zip(segments, segment_outliers):
+        outliers[segment] = segment_outlier
+    return pwlf.PiecewiseLinFit(x=log_daily_death[~outliers].time_idx.values, y=log_daily_death[~outliers].death)
+
+
+def fit_prepared_log_daily_death(prepared, regr_pw):
+    '''Fit of fit_log_daily_death from the result of prepare_log_daily_death and its model of get_inlier_model, fit
+    with the break points of prepared'''
+    _, branch, _, break_points, forecast_date_index, forecast_time_idx, data_end_date_idx, \
+        lockdown_effective_date = prepared
+    if branch == NO_LOCKDOWN:
+        # Lockdown is not effective in forecast range, second model not needed
+        oos_step_variance = regr_pw.variance()
+    elif branch == DEFAULT_SECOND_MODEL:
+        # Not enough data after the lockdown effective date, replace second slope by default value
+        regr_pw.beta[2] = DEFAULT_SECOND_SLOPE
+        oos_step_variance = regr_pw.variance()
+    else:
+        oos_step_variance = None
         #variance = regr_pw.variance()
         #log_predicted_death_pred_var_oos = variance*(forecast_time_idx[forecast_time_idx>data_end_date_idx]-
         #                                             data_end_date_idx)
 
-    model_beta = regr_pw.beta
+    return (regr_pw, break_points, forecast_date_index, forecast_time_idx, data_end_date_idx, lockdown_effective_date,
+            oos_step_variance)
+
+
+def fit_log_daily_death(local_death_data, forecast_horizon=60, lockdown_date=None, params=None):
+    '''Robust fit of the log daily death curves of get_log_daily_predicted_death. Return the fitted PiecewiseLinFit,
+    its break points, the forecast dates and their time index relative to the lockdown effective date, the time index
+    of the last data day, the lockdown effective date and the variance per day of the out of sample random walk
+    error of the models that do not extrapolate the prediction variance (None for the two segment model)'''
+    prepared = prepare_log_daily_death(local_death_data, forecast_horizon, lockdown_date, params=params)
+    log_daily_death, _, segments = prepared[:3]
+    _, _, _, segment_outliers = hb.fit_huber_ragged([log_daily_death.time_idx.values[segment] for segment in segments],
+                                                    [log_daily_death.death.values[segment] for segment in segments])
+    regr_pw = get_inlier_model(prepared, segment_outliers)
+    regr_pw.fit_with_breaks(prepared[3])
+    return fit_prepared_log_daily_death(prepared, regr_pw)
+
+
+def fit_log_daily_death_batch(local_death_data, forecast_horizon=60, lockdown_dates=None, params=None):
+    '''fit_log_daily_death of many regions, local_death_data and lockdown_dates hold one entry per region. The robust
+    fits of the segments of all regions run as one hb.fit_huber_ragged batch and the piecewise linear fits of the
+    regions with the same number of break points as one pwlf.fit_with_breaks_batch. Return the fits and the errors,
+    a region that can not be fit has a None fit and the exception as error'''
+    lockdown_dates = [None] * len(local_death_data) if lockdown_dates is None else lockdown_dates
+    prepared = []
+    errors = []
+    for data, lockdown_date in zip(local_death_data, lockdown_dates):
+        try:
+            prepared.append(prepare_log_daily_death(data, forecast_horizon, lockdown_date, params=params))
+            errors.append(None)
+        except Exception as e:
+            prepared.append(None)
+            errors.append(e)
+    xs = []
+    ys = []
+    for region in prepared:
+        if region is not None:
+            log_daily_death, _, segments = region[:3]
+            xs.extend(log_daily_death.time_idx.values[segment] for segment in segments)
+            ys.extend(log_daily_death.death.values[segment] for segment in segments)
+    _, _, _, outliers = hb.fit_huber_ragged(xs, ys)
+    models = [None] * len(prepared)
+    first = 0
+    for i, region in enumerate(prepared):
+        if region is None:
+            continue
+        n_segments = len(region[2])
+        try:
+            models[i] = get_inlier_model(region, outliers[first:first + n_segments])
+        except Exception as e:
+            errors[i] = e
+        first += n_segments
+    for n_breaks in sorted({len(region[3]) for region, model in zip(prepared, models) if model is not None}):
+        batch = [i for i, model in enumerate(models) if model is not None and len(prepared[i][3]) == n_breaks]
+        beta, ssr, _, _ = pwlf.fit_with_breaks_batch([models[i].x_data for i in batch],
+                                                     [models[i].y_data for i in batch],
+                                                     [prepared[i][3] for i in batch])
+        for i, region_beta, region_ssr in zip(batch, beta, ssr):
+            models[i].set_fit(prepared[i][3], region_beta, region_ssr)
+    fits = [None] * len(prepared)
+    for i, (region, model) in enumerate(zip(prepared, models)):
+        if model is None:
+            continue
+        try:
+            fits[i] = fit_prepared_log_daily_death(region, model)
+        except Exception as e:
+            errors[i] = e
+    return fits, errors
+
+
+def get_relax_beta(model_beta, contain_rate=0.5):
+    '''Change of slope when the lockdown is relaxed: the slope of the third segment is contain_rate of the way back
+    from the after lockdown slope to the before lockdown slope. model_beta can hold one set of parameters per row
+    and contain_rate one rate per row'''
+    model_beta = np.asarray(model_beta)
+    return ((model_beta[..., 1] + model_beta[..., 2]) * contain_rate +
+            model_beta[..., 1] * (1 - contain_rate)) - (model_beta[..., 1] + model_beta[..., 2])
+
+
+def get_relax_effective_date_idx(relax_date, lockdown_effective_date, params=None):
+    '''Time index of the day relaxing the lockdown at relax_date shows in the death'''
+    params = params or get_default_params()
+    relax_effective_date = pd.to_datetime(relax_date) + dt.timedelta(
+        params.INFECT_2_HOSPITAL_TIME + params.HOSPITAL_2_ICU_TIME + params.ICU_2_DEATH_TIME)
+    return (relax_effective_date - lockdown_effective_date).days
+
+
+def get_relax_model(model_beta, forecast_time_idx, lockdown_effective_date, relax_date, contain_rate=0.5,
+                    params=None):
+    '''Model parameters and break points when the lockdown is relaxed at relax_date, see get_relax_beta.
+    model_beta can hold one set of parameters per row'''
+    break_points = np.array([forecast_time_idx[0], 0,
+                             get_relax_effective_date_idx(relax_date, lockdown_effective_date, params=params),
+                             forecast_time_idx[-1]])
+    model_beta = np.asarray(model_beta)
+    return np.concatenate([model_beta, np.asarray(get_relax_beta(model_beta, contain_rate))[..., None]],
+                          axis=-1), break_points
+
+
+def get_model_prediction(x_data, y_data, beta, break_points, time_idx):
+    '''Prediction and prediction variance at time_idx of piecewise linear models with break_points and parameters
+    beta on the data x_data, y_data, as PiecewiseLinFit.predict and prediction_variance give them: the in sample
+    variance of the model times the leverage of pinv(A^T A). beta holds one model per row, return (models, days)
+    arrays'''
+    breaks = np.sort(np.asarray(break_points, dtype=float))[None, :]
+    Ad = pwlf.assemble_regression_matrix_batch(breaks, np.asarray(x_data, dtype=float)[None, :])[0]
+    A = pwlf.assemble_regression_matrix_batch(breaks, np.asarray(time_idx, dtype=float)[None, :])[0]
+    leverage = np.einsum('dp,pq,dq->d', A, np.linalg.pinv(np.dot(Ad.T, Ad)), A)
+    residual = np.dot(beta, Ad.T) - np.asarray(y_data)
+    variance = np.einsum('si,si->s', residual, residual) / (len(x_data) - beta.shape[1])
+    return np.dot(beta, A.T), variance[:, None] * leverage
+
+
+def get_scenario_log_predictions(fit, relax_dates, contain_rates, test_rates, params=None):
+    '''Model parameters, log daily predicted death and its prediction variance of a fit of fit_log_daily_death for
+    the scenarios (relax_dates[i], contain_rates[i], test_rates[i]), a relax_date of None keeps the lockdown. A
+    scenario that relaxes the lockdown predicts with the parameters and break points of get_relax_model, with the in
+    sample variance of that relaxed model, and scales the out of sample variance by its test rate. Scenarios with
+    the same relax date are evaluated together. Return the parameters of every scenario and (scenarios, days)
+    arrays'''
+    params = params or get_default_params()
+    regr_pw, break_points, _, forecast_time_idx, data_end_date_idx, lockdown_effective_date, \
+        oos_step_variance = fit
+    relax = np.array([relax_date is not None for relax_date in relax_dates])
+    if relax.any() and len(regr_pw.beta) < 3:
+        raise ValueError('Relaxing the lockdown needs a lockdown date')
+    n_in_sample = int(np.sum(forecast_time_idx <= data_end_date_idx))
+    log_predicted = np.empty((len(relax_dates), len(forecast_time_idx)))
+    log_predicted_var = np.empty((len(relax_dates), len(forecast_time_idx)))
+    model_betas = [regr_pw.beta] * len(relax_dates)
+    fit_predicted, fit_predicted_var = get_model_prediction(regr_pw.x_data, regr_pw.y_data, regr_pw.beta[None, :],
+                                                            break_points, forecast_time_idx)
+    log_predicted[~relax] = fit_predicted
+    log_predicted_var[~relax] = fit_predicted_var
+    scenarios = {}
+    for i in np.flatnonzero(relax):
+        scenarios.setdefault(pd.to_datetime(relax_dates[i]), []).append(i)
+    for relax_date, rows in scenarios.items():
+        beta, relax_break_points = get_relax_model(np.tile(regr_pw.beta, (len(rows), 1)), forecast_time_idx,
+                                                   lockdown_effective_date, relax_date,
+                                                   np.asarray(contain_rates, dtype=float)[rows], params=params)
+        log_predicted[rows], log_predicted_var[rows] = get_model_prediction(regr_pw.x_data, regr_pw.y_data, beta,
+                                                                            relax_break_points, forecast_time_idx)
+        for i, row_beta in zip(rows, beta):
+            model_betas[i] = row_beta
+    oos_variance = get_out_of_sample_variance(fit_predicted_var[0, n_in_sample:], oos_step_variance,
+                                              forecast_time_idx[n_in_sample:], data_end_date_idx)
+    oos_scale = np.where(relax, (0.2 / (np.asarray(test_rates, dtype=float) + 0.01)) ** 3, 1.0)
+    log_predicted_var[:, n_in_sample:] = oos_scale[:, None] * oos_variance
+    return model_betas, log_predicted, log_predicted_var
+
+
+def get_log_daily_predicted_death(local_death_data, forecast_horizon=60, lockdown_date=None,
+                                  relax_date=None, contain_rate=0.5, test_rate=0.2, params=None):
+    '''Since this is highly contagious disease. Daily new death, which is a proxy for daily new infected cases
+    is model as d(t)=a*d(t-1) or equivalent to d(t) = b*a^(t). After a log transform, it becomes linear.
+    log(d(t))=logb+t*loga, so we can use linear regression to provide forecast (use robust linear regressor to avoid
+    data anomaly in death reporting)
+    There are two seperate linear curves, one before the lockdown is effective(21 days after lockdown) and one after
+    For using this prediction to infer back the other metrics (infected cases, hospital, ICU, etc..) only the before
+    curve is used and valid. If we assume there is no new infection after lock down (perfect lockdown), the after
+    curve only depends on the distribution of time to death since ICU.
+    WARNING: if lockdown_date is not provided, we will default to no lockdown to raise awareness of worst case
+    if no action. If you have info on lockdown date please use it to make sure the model provide accurate result'''
+    params = params or get_default_params()
+    return predict_log_daily_death(fit_log_daily_death(local_death_data, forecast_horizon, lockdown_date, params=params),
+                                   relax_date, contain_rate, test_rate, params=params)
 
-    if relax_date is not None:
-        relax_date = pd.to_datetime(relax_date)
-        relax_effective_date = relax_date + dt.timedelta(
-            INFECT_2_HOSPITAL_TIME + HOSPITAL_2_ICU_TIME + ICU_2_DEATH_TIME)
-        relax_effective_date_idx = (relax_effective_date - lockdown_effective_date).days
-        break_points = np.array([data_start_date_idx, 0, relax_effective_date_idx, forecast_end_date_idx])
-        model_beta = np.append(model_beta, ((model_beta[1] + model_beta[2]) * contain_rate +
-                                                model_beta[1] * (1 - contain_rate)) - (model_beta[1] + model_beta[2]))
-        log_predicted_death_pred_var_oos = log_predicted_death_pred_var_oos*((0.2/(test_rate+0.01))**3)
-    log_predicted_death_values = regr_pw.predict(forecast_time_idx, beta=model_beta, breaks=break_points)
-    log_predicted_death_pred_var = regr_pw.prediction_variance(forecast_time_idx)
 
-    log_predicted_death_pred_var = np.concatenate(
-        (log_predicted_death_pred_var[:sum(forecast_time_idx <= data_end_date_idx)],
-         log_predicted_death_pred_var_oos))
+def predict_log_daily_death(fit, relax_date=None, contain_rate=0.5, test_rate=0.2, params=None):
+    '''get_log_daily_predicted_death from the result of fit_log_daily_death'''
+    params = params or get_default_params()
+    forecast_date_index = fit[2]
+    (model_beta,), (log_predicted_death_values,), (log_predicted_death_pred_var,) = get_scenario_log_predictions(
+        fit, [relax_date], [contain_rate], [test_rate], params=params)
 
     log_predicted_death_lower_bound_values = log_predicted_death_values - 1.96 * np.sqrt(log_predicted_death_pred_var)
     log_predicted_death_upper_bound_values = log_predicted_death_values + 1.96 * np.sqrt(log_predicted_death_pred_var)
@@ -311,55 +716,86 @@ def get_log_daily_predicted_death(local_death_data, forecast_horizon=60, lockdow
     log_predicted_death.columns = ['predicted_death']
     log_predicted_death_lower_bound.columns = ['lower_bound']
     log_predicted_death_upper_bound.columns = ['upper_bound']
-    return log_predicted_death, log_predicted_death_lower_bound, log_predicted_death_upper_bound, regr_pw.beta
+    return log_predicted_death, log_predicted_death_lower_bound, log_predicted_death_upper_bound, model_beta
 
 
 def get_daily_predicted_death(local_death_data, forecast_horizon=60, lockdown_date=None,
-                              relax_date=None, contain_rate=0.5, test_rate=0.2):
+                              relax_date=None, contain_rate=0.5, test_rate=0.2, params=None):
+    params = params or get_default_params()
     log_daily_predicted_death, lb, ub, model_beta = get_log_daily_predicted_death(local_death_data,
                                                                                   forecast_horizon,
                                                                                   lockdown_date,
                                                                                   relax_date,
                                                                                   contain_rate,
-                                                                                  test_rate)
+                                                                                  test_rate, params=params)
     return np.exp(log_daily_predicted_death), np.exp(lb), np.exp(ub), model_beta
 
 
 
 def get_cumulative_predicted_death(local_death_data, forecast_horizon=60, lockdown_date=None,
-                                   relax_date=None, contain_rate=0.5, test_rate=0.2):
+                                   relax_date=None, contain_rate=0.5, test_rate=0.2, params=None):
+    params = params or get_default_params()
     daily, lb, ub, model_beta = get_daily_predicted_death(local_death_data, forecast_horizon, lockdown_date,
-                                                          relax_date, contain_rate, test_rate)
+                                                          relax_date, contain_rate, test_rate, params=params)
     return daily.cumsum(), lb.cumsum(), ub.cumsum(), model_beta
 
 
+def build_daily_metrics(daily_local_death_new, daily_predicted_death, daily_predicted_death_lb,
+                        daily_predicted_death_ub, params=None):
+    '''Table of daily metrics in one pass. Every metric is a run of consecutive days placed at its day offset from
+    the first predicted day in one preallocated array, the DataFrame is created once at the end. Predictions are on
+    consecutive days'''
+    params = params or get_default_params()
+    predicted = np.ravel(daily_predicted_death.values)
+    infected_delay = params.INFECT_2_HOSPITAL_TIME + params.HOSPITAL_2_ICU_TIME + params.ICU_2_DEATH_TIME
+    symptomatic_delay = params.HOSPITAL_2_ICU_TIME + params.ICU_2_DEATH_TIME
+    beds_window = get_hospital_beds_window(params=params)
+    ICU_window = get_ICU_window(params=params)
+    metrics = [('predicted_death', 0, predicted),
+               ('lower_bound', 0, np.ravel(daily_predicted_death_lb.values)),
+               ('upper_bound', 0, np.ravel(daily_predicted_death_ub.values)),
+               ('infected', -infected_delay, (100/params.DEATH_RATE)*predicted),
+               ('symptomatic', -symptomatic_delay, (params.SYMPTOM_RATE/params.DEATH_RATE)*predicted),
+               ('hospitalized', -symptomatic_delay, (params.HOSPITAL_RATE/params.DEATH_RATE)*predicted),
+               ('hospital_beds', beds_window[0],
+                convolve_occupancy(predicted, *get_hospital_beds_kernel(params=params), beds_window)[0]),
+               ('ICU', ICU_window[0], convolve_occupancy(predicted, *get_ICU_kernel(params=params), ICU_window)[0])]
+    start_date = daily_predicted_death.index[0]
+    death_offset = (daily_local_death_new.index - start_date).days.values
+    first_offset = min([offset for _, offset, values in metrics if len(values) > 0] + list(death_offset[:1]))
+    last_offset = max([offset + len(values) - 1 for _, offset, values in metrics] + list(death_offset[-1:]))
+    block = np.full((last_offset - first_offset + 1, len(metrics) + 1), np.nan)
+    block[death_offset - first_offset, 0] = np.ravel(daily_local_death_new.values)
+    for column, (_, offset, values) in enumerate(metrics, start=1):
+        block[offset - first_offset:offset - first_offset + len(values), column] = values
+    return pd.DataFrame(block, index=pd.date_range(start_date + dt.timedelta(int(first_offset)), periods=len(block)),
+                        columns=['death'] + [name for name, _, _ in metrics])
+
+
 def get_daily_metrics_from_death_data(local_death_data, forecast_horizon=60, lockdown_date=None,
-                                      relax_date=None, contain_rate=0.5, test_rate=0.2):
-    daily_predicted_death, daily_predicted_death_lb, daily_predicted_death_ub, model_beta  = \
-            get_daily_predicted_death(local_death_data, forecast_horizon, lockdown_date,
-                                      relax_date, contain_rate, test_rate)
+                                      relax_date=None, contain_rate=0.5, test_rate=0.2, params=None):
+    params = params or get_default_params()
+    return get_daily_metrics_from_fit(local_death_data,
+                                      fit_log_daily_death(local_death_data, forecast_horizon, lockdown_date,
+                                                          params=params),
+                                      relax_date, contain_rate, test_rate, params=params)
+
+
+def get_daily_metrics_from_fit(local_death_data, fit, relax_date=None, contain_rate=0.5, test_rate=0.2, params=None):
+    '''get_daily_metrics_from_death_data from the result of fit_log_daily_death, e.g. of fit_log_daily_death_batch'''
+    params = params or get_default_params()
+    log_daily_predicted_death, lb, ub, model_beta = predict_log_daily_death(fit, relax_date, contain_rate, test_rate,
+                                                                            params=params)
     daily_local_death_new = local_death_data.diff().fillna(0)
-    daily_local_death_new.columns = ['death']
-    daily_infected_cases_new = get_infected_cases(daily_predicted_death)
-    daily_symptomatic_cases_new = get_symptomatic_cases(daily_predicted_death)
-    daily_hospitalized_cases_new = get_hospitalized_cases(daily_predicted_death)
-    daily_hospital_beds_need = get_number_hospital_beds_need(daily_predicted_death)
-    daily_ICU_need = get_number_ICU_need(daily_predicted_death)
-    return pd.concat([daily_local_death_new,
-                      daily_predicted_death,
-                      daily_predicted_death_lb,
-                      daily_predicted_death_ub,
-                      daily_infected_cases_new,
-                      daily_symptomatic_cases_new,
-                      daily_hospitalized_cases_new,
-                      daily_hospital_beds_need,
-                      daily_ICU_need], axis=1, sort=True), model_beta
+    return build_daily_metrics(daily_local_death_new, np.exp(log_daily_predicted_death), np.exp(lb), np.exp(ub),
+                               params=params), model_beta
 
 
 def get_cumulative_metrics_from_death_data(local_death_data, forecast_horizon=60, lockdown_date=None,
-                                           relax_date=None, contain_rate=0.5, test_rate=0.2):
+                                           relax_date=None, contain_rate=0.5, test_rate=0.2, params=None):
+    params = params or get_default_params()
     daily_metrics, model_beta = get_daily_metrics_from_death_data(local_death_data, forecast_horizon, lockdown_date,
-                                                      relax_date, contain_rate, test_rate)
+                                                      relax_date, contain_rate, test_rate, params=params)
     cumulative_metrics = daily_metrics.drop(columns=['ICU', 'hospital_beds']).cumsum()
     # data_end_date = max(local_death_data.index)
     # cumulative_metrics['lower_bound'] = daily_metrics['lower_bound']
@@ -377,7 +813,8 @@ def get_cumulative_metrics_from_death_data(local_death_data, forecast_horizon=60
 
 
 def get_metrics_by_country(country, forecast_horizon=60, lockdown_date=None,
-                           back_test=False, last_data_date=dt.date.today()):
+                           back_test=False, last_data_date=dt.date.today(), params=None):
+    params = params or get_default_params()
     local_death_data = get_data_by_country(country, type='deaths')
     local_death_data_original = local_death_data.copy()
     daily_local_death_data_original = get_daily_data(local_death_data_original)
@@ -385,7 +822,8 @@ def get_metrics_by_country(country, forecast_horizon=60, lockdown_date=None,
         local_death_data = local_death_data[local_death_data.index.date <= last_data_date]
     local_confirmed_data = get_data_by_country(country, type='confirmed')
     daily_local_confirmed_data = get_daily_data(local_confirmed_data)
-    daily_metrics, model_beta = get_daily_metrics_from_death_data(local_death_data, forecast_horizon, lockdown_date)
+    daily_metrics, model_beta = get_daily_metrics_from_death_data(local_death_data, forecast_horizon, lockdown_date,
+                                                                  params=params)
     daily_metrics['confirmed'] = daily_local_confirmed_data
     if back_test:
         daily_metrics['death']= daily_local_death_data_original
@@ -398,7 +836,8 @@ def get_metrics_by_country(country, forecast_horizon=60, lockdown_date=None,
 
 def get_metrics_by_state_US(state, forecast_horizon=60, lockdown_date=None,
                             relax_date=None, contain_rate=0.5, test_rate=0.2,
-                            back_test=False, last_data_date=dt.date.today()):
+                            back_test=False, last_data_date=dt.date.today(), params=None):
+    params = params or get_default_params()
     local_death_data = get_data_by_state(state, type='deaths')
     local_death_data_original = local_death_data.copy()
     daily_local_death_data_original = get_daily_data(local_death_data_original)
@@ -407,7 +846,7 @@ def get_metrics_by_state_US(state, forecast_horizon=60, lockdown_date=None,
     local_confirmed_data = get_data_by_state(state, type='confirmed')
     daily_local_confirmed_data = get_daily_data(local_confirmed_data)
     daily_metrics, model_beta = get_daily_metrics_from_death_data(local_death_data, forecast_horizon, lockdown_date,
-                                                                  relax_date, contain_rate, test_rate)
+                                                                  relax_date, contain_rate, test_rate, params=params)
     daily_metrics['confirmed'] = daily_local_confirmed_data
     if back_test:
         daily_metrics['death']= daily_local_death_data_original
@@ -417,11 +856,13 @@ def get_metrics_by_state_US(state, forecast_horizon=60, lockdown_date=None,
     return daily_metrics, cumulative_metrics, model_beta
 
 
-def get_metrics_by_county_and_state_US(county, state, forecast_horizon=60, lockdown_date=None):
+def get_metrics_by_county_and_state_US(county, state, forecast_horizon=60, lockdown_date=None, params=None):
+    params = params or get_default_params()
     local_death_data = get_data_by_county_and_state(county, state, type='deaths')
     local_confirmed_data = get_data_by_county_and_state(county, state, type='confirmed')
     daily_local_confirmed_data = get_daily_data(local_confirmed_data)
-    daily_metrics, model_beta = get_daily_metrics_from_death_data(local_death_data, forecast_horizon, lockdown_date)
+    daily_metrics, model_beta = get_daily_metrics_from_death_data(local_death_data, forecast_horizon, lockdown_date,
+                                                                  params=params)
     daily_metrics['confirmed'] = daily_local_confirmed_data
     cumulative_metrics = daily_metrics.drop(columns=['ICU', 'hospital_beds']).cumsum()
     cumulative_metrics['ICU'] = daily_metrics['ICU']
@@ -430,7 +871,8 @@ def get_metrics_by_county_and_state_US(county, state, forecast_horizon=60, lockd
 
 
 def get_log_daily_predicted_death_by_country(country, forecast_horizon=60, lockdown_date=None,
-                                             back_test=False, last_data_date=dt.date.today()):
+                                             back_test=False, last_data_date=dt.date.today(), params=None):
+    params = params or get_default_params()
     local_death_data = get_data_by_country(country, type='deaths')
     local_death_data.columns = ['death']
     local_death_data_original = local_death_data.copy()
@@ -439,14 +881,15 @@ def get_log_daily_predicted_death_by_country(country, forecast_horizon=60, lockd
     if back_test:
         local_death_data = local_death_data[local_death_data.index.date <= last_data_date]
     log_predicted_death, log_predicted_death_lb, log_predicted_death_ub, model_beta = \
-            get_log_daily_predicted_death(local_death_data, forecast_horizon, lockdown_date)
+            get_log_daily_predicted_death(local_death_data, forecast_horizon, lockdown_date, params=params)
     return  pd.concat([log_daily_death_original, log_predicted_death, log_predicted_death_lb,
                        log_predicted_death_ub], axis=1).replace([np.inf, -np.inf], np.nan), model_beta
 
 
 def get_log_daily_predicted_death_by_state_US(state, forecast_horizon=60, lockdown_date=None,
                                               relax_date=None, contain_rate=0.5, test_rate=0.2,
-                                              back_test=False, last_data_date=dt.date.today()):
+                                              back_test=False, last_data_date=dt.date.today(), params=None):
+    params = params or get_default_params()
     local_death_data = get_data_by_state(state, type='deaths')
     local_death_data.columns = ['death']
     local_death_data_original = local_death_data.copy()
@@ -456,18 +899,20 @@ def get_log_daily_predicted_death_by_state_US(state, forecast_horizon=60, lockdo
         local_death_data = local_death_data[local_death_data.index.date <= last_data_date]
     log_predicted_death, log_predicted_death_lb, log_predicted_death_ub, model_beta = \
         get_log_daily_predicted_death(local_death_data, forecast_horizon, lockdown_date,
-                                      relax_date, contain_rate, test_rate)
+                                      relax_date, contain_rate, test_rate, params=params)
     return pd.concat([log_daily_death_original, log_predicted_death, log_predicted_death_lb,
                       log_predicted_death_ub], axis=1).replace([np.inf, -np.inf], np.nan), model_beta
 
 
-def get_log_daily_predicted_death_by_county_and_state_US(county, state, forecast_horizon=60, lockdown_date=None):
+def get_log_daily_predicted_death_by_county_and_state_US(county, state, forecast_horizon=60, lockdown_date=None,
+                                                         params=None):
+    params = params or get_default_params()
     local_death_data = get_data_by_county_and_state(county, state, type='deaths')
     daily_local_death_new = local_death_data.diff().fillna(0)
     daily_local_death_new.columns = ['death']
     log_daily_death = np.log(daily_local_death_new)
     log_predicted_death, log_predicted_death_lb, log_predicted_death_ub, model_beta = \
-        get_log_daily_predicted_death(local_death_data, forecast_horizon, lockdown_date)
+        get_log_daily_predicted_death(local_death_data, forecast_horizon, lockdown_date, params=params)
     return pd.concat([log_daily_death, log_predicted_death, log_predicted_death_lb,
                       log_predicted_death_ub], axis=1).replace([np.inf, -np.inf], np.nan), model_beta
 
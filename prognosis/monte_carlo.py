@@ -0,0 +1,124 @@
+import datetime as dt
+import numpy as np
+import pandas as pd
+from scipy import linalg
+import model_utils as mu
+import pwlf_mod as pwlf
+
+N_SAMPLES = 2000
+QUANTILES = (0.025, 0.5, 0.975)
+
+
+def get_beta_samples(regr_pw, branch, n_samples=N_SAMPLES, rng=None):
+    '''Model parameters of a fit of mu.fit_log_daily_death drawn from its covariance, variance * pinv(A^T A), as a
+    (samples, parameters) array. The second slope of the default second model is set, not estimated, so only the
+    other parameters are drawn and it is the same in every sample'''
+    rng = np.random.default_rng(0) if rng is None else rng
+    estimated = np.ones(len(regr_pw.beta), dtype=bool)
+    if branch == mu.DEFAULT_SECOND_MODEL:
+        estimated[2] = False
+    variance, AtA_pinv, _ = regr_pw.get_fit_statistics()
+    eigenvalues, eigenvectors = linalg.eigh(variance * AtA_pinv[np.ix_(estimated, estimated)])
+    covariance_root = eigenvectors * np.sqrt(np.clip(eigenvalues, 0, None))
+    beta_samples = np.tile(regr_pw.beta, (n_samples, 1))
+    beta_samples[:, estimated] += np.dot(rng.standard_normal((n_samples, estimated.sum())), covariance_root.T)
+    return beta_samples
+
+
+def get_log_death_samples(local_death_data, forecast_horizon=60, lockdown_date=None, relax_date=None,
+                          contain_rate=0.5, test_rate=0.2, n_samples=N_SAMPLES, seed=0, params=None):
+    '''Sample paths of the log daily predicted death of get_log_daily_predicted_death as one (samples, days) array.
+    Model parameters are drawn by get_beta_samples, so every day of a path comes from the same parameters and sums
+    over days get the right spread. Models that extrapolate with variance * days since the last data day add a
+    random walk out of sample instead. Return the forecast dates and the paths'''
+    params = params or mu.get_default_params()
+    regr_pw, break_points, forecast_date_index, forecast_time_idx, data_end_date_idx, lockdown_effective_date, \
+        oos_step_variance = mu.fit_log_daily_death(local_death_data, forecast_horizon, lockdown_date, params=params)
+    rng = np.random.default_rng(seed)
+    model_beta = regr_pw.beta
+    beta_samples = get_beta_samples(regr_pw, mu.get_model_branch(data_end_date_idx, forecast_horizon), n_samples,
+                                    rng)
+    oos_scale = 1.0
+    if relax_date is not None:
+        model_beta, break_points = mu.get_relax_model(model_beta, forecast_time_idx, lockdown_effective_date,
+                                                      relax_date, contain_rate, params=params)
+        beta_samples, _ = mu.get_relax_model(beta_samples, forecast_time_idx, lockdown_effective_date, relax_date,
+                                             contain_rate, params=params)
+        oos_scale = np.sqrt((0.2/(test_rate+0.01))**3)
+    A = pwlf.assemble_regression_matrix_batch(np.sort(break_points)[None, :].astype(float),
+                                              forecast_time_idx[None, :].astype(float))[0]
+    deviation = np.dot(beta_samples - model_beta, A.T)
+    n_in_sample = int(np.sum(forecast_time_idx <= data_end_date_idx))
+    if oos_step_variance is not None:
+        steps = rng.standard_normal((n_samples, len(forecast_time_idx) - n_in_sample)) * np.sqrt(oos_step_variance)
+        deviation[:, n_in_sample:] = np.cumsum(steps, axis=1)
+    deviation[:, n_in_sample:] *= oos_scale
+    return forecast_date_index, np.dot(A, model_beta)[None, :] + deviation
+
+
+def build_quantile_table(start_date, metrics, quantiles):
+    '''Table of quantiles of many metrics: metrics are (name, day offset from start_date, (quantiles, days) array),
+    columns are (metric, quantile)'''
+    first_offset = min(offset for _, offset, _ in metrics)
+    last_offset = max(offset + values.shape[1] - 1 for _, offset, values in metrics)
+    block = np.full((last_offset - first_offset + 1, len(metrics) * len(quantiles)), np.nan)
+    for i, (_, offset, values) in enumerate(metrics):
+        block[offset - first_offset:offset - first_offset + values.shape[1],
+              i * len(quantiles):(i + 1) * len(quantiles)] = values.T
+    return pd.DataFrame(block, index=pd.date_range(start_date + dt.timedelta(int(first_offset)), periods=len(block)),
+                        columns=pd.MultiIndex.from_product([[name for name, _, _ in metrics], list(quantiles)],
+                                                           names=['metric', 'quantile']))
+
+
+def get_metric_quantiles(local_death_data, forecast_horizon=60, lockdown_date=None, relax_date=None,
+                         contain_rate=0.5, test_rate=0.2, quantiles=QUANTILES, n_samples=N_SAMPLES, seed=0,
+                         params=None):
+    '''Quantiles of every metric of get_daily_metrics_from_death_data from sample paths of the daily death, pushed
+    through exp, cumsum and the occupancy kernels as whole (samples, days) arrays. Return daily and cumulative
+    tables with (metric, quantile) columns, cumulative hospital_beds and ICU are the daily ones as in
+    get_metrics_by_country'''
+    params = params or mu.get_default_params()
+    forecast_date_index, log_death = get_log_death_samples(local_death_data, forecast_horizon, lockdown_date,
+                                                           relax_date, contain_rate, test_rate, n_samples, seed,
+                                                           params=params)
+    daily_death = np.exp(log_death)
+    beds_window = mu.get_hospital_beds_window(params=params)
+    ICU_window = mu.get_ICU_window(params=params)
+    hospital_beds = mu.convolve_occupancy(daily_death, *mu.get_hospital_beds_kernel(params=params), beds_window,
+                                          'fft')
+    ICU_n = mu.convolve_occupancy(daily_death, *mu.get_ICU_kernel(params=params), ICU_window, 'fft')
+    occupancy = [('hospital_beds', beds_window[0], np.quantile(hospital_beds, quantiles, axis=0)),
+                 ('ICU', ICU_window[0], np.quantile(ICU_n, quantiles, axis=0))]
+    infected_delay = params.INFECT_2_HOSPITAL_TIME + params.HOSPITAL_2_ICU_TIME + params.ICU_2_DEATH_TIME
+    symptomatic_delay = params.HOSPITAL_2_ICU_TIME + params.ICU_2_DEATH_TIME
+    tables = []
+    for death in [daily_death, np.cumsum(daily_death, axis=1)]:
+        # Other case counts are positive multiples of the death, so are their quantiles
+        death_quantiles = np.quantile(death, quantiles, axis=0)
+        metrics = [('predicted_death', 0, death_quantiles),
+                   ('infected', -infected_delay, (100/params.DEATH_RATE)*death_quantiles),
+                   ('symptomatic', -symptomatic_delay, (params.SYMPTOM_RATE/params.DEATH_RATE)*death_quantiles),
+                   ('hospitalized', -symptomatic_delay, (params.HOSPITAL_RATE/params.DEATH_RATE)*death_quantiles)]
+        tables.append(build_quantile_table(forecast_date_index[0], metrics + occupancy, quantiles))
+    return tables[0], tables[1]
+
+
+def get_metric_quantiles_by_country(country, forecast_horizon=60, lockdown_date=None, back_test=False,
+                                    last_data_date=dt.date.today(), quantiles=QUANTILES, n_samples=N_SAMPLES,
+                                    params=None):
+    local_death_data = mu.get_data_by_country(country, type='deaths')
+    if back_test:
+        local_death_data = local_death_data[local_death_data.index.date <= last_data_date]
+    return get_metric_quantiles(local_death_data, forecast_horizon, lockdown_date, quantiles=quantiles,
+                                n_samples=n_samples, params=params)
+
+
+def get_metric_quantiles_by_state_US(state, forecast_horizon=60, lockdown_date=None, relax_date=None,
+                                     contain_rate=0.5, test_rate=0.2, back_test=False,
+                                     last_data_date=dt.date.today(), quantiles=QUANTILES, n_samples=N_SAMPLES,
+                                     params=None):
+    local_death_data = mu.get_data_by_state(state, type='deaths')
+    if back_test:
+        local_death_data = local_death_data[local_death_data.index.date <= last_data_date]
+    return get_metric_quantiles(local_death_data, forecast_horizon, lockdown_date, relax_date, contain_rate,
+                                test_rate, quantiles, n_samples, params=params)
@@ -23,6 +23,8 @@
 
 from __future__ import print_function
 # import libraries
+import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from scipy.optimize import differential_evolution
 from scipy.optimize import fmin_l_bfgs_b
@@ -137,6 +139,11 @@ class PiecewiseLinFit(object):
             of line segments using a specialized optimization routine that
             should be faster than fit() for large problems. The tradeoff may
             be that fitfast() results in a lower quality model.
+        fit_discrete(n_segments, candidates=None, min_points=2,
+                     max_solves=2**22)
+            Fit a continuous piecewise linear function for a specified number
+            of line segments with the globally optimal breakpoints among
+            candidate locations, by default the integers within the data.
         fit_with_breaks(breaks)
             Fit a continuous piecewise linear function where the breakpoint
             locations are known.
@@ -152,6 +159,9 @@ class PiecewiseLinFit(object):
             fit for a specified number of breakpoints. This is to be used
             with a custom optimization routine, and after use_custom_opt has
             been called.
+        fit_with_breaks_opt_grad(var)
+            Same as fit_with_breaks_opt(var), also returning the derivative
+            of the sum of squares of the residuals by breakpoint.
         fit_force_points_opt(var)'
             Same as fit_with_breaks_opt(var), except this allows for points to
             be forced through x_c and y_c.
@@ -176,6 +186,12 @@ class PiecewiseLinFit(object):
         variance()
             Calculate unbiased variance estimator after fit
 
+        Notes
+        -----
+        A fit object is not thread-safe. The fits reuse its work arrays of
+        get_buffer and store their results on it, so threads must not share
+        one, use an object per thread. Process pools, such as the workers of
+        differential_evolution or fitfast, work on copies and are safe.
 
         Examples
         --------
@@ -240,8 +256,45 @@ class PiecewiseLinFit(object):
         self.slopes = None
         self.intercepts = None
         self.se = None
+        # sufficient statistics of fit_with_breaks_online
+        self.AtA = None
+        self.Aty = None
+        self.yty = None
+        self.AtA_inv = None
+        self.online_beta = None
+        self.online_breaks = None
+        # preallocated work arrays of get_buffer by name
+        self.buffers = {}
+        # get_fit_statistics of the beta and fit_breaks arrays in the key
+        self.fit_statistics = None
+        self.fit_statistics_key = None
+
+    def get_buffer(self, name, shape):
+        r"""
+        Fortran ordered work array of the fit object. It is allocated on the
+        first request of a shape and reused by later requests of the same
+        name, so its content is only valid until the next use. This is why
+        a fit object must not be shared between threads.
 
-    def assemble_regression_matrix(self, breaks, x):
+        Parameters
+        ----------
+        name : str
+            The name of the work array.
+        shape : tuple
+            The shape of the work array.
+
+        Returns
+        -------
+        buffer : ndarray
+            The work array, with undefined content.
+        """
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, order='F')
+            self.buffers[name] = buffer
+        return buffer
+
+    def assemble_regression_matrix(self, breaks, x, out=None):
         r"""
         Assemble the linear regression matrix A
 
@@ -254,11 +307,14 @@ class PiecewiseLinFit(object):
         x : ndarray (1-D)
             The x locations which the linear regression matrix is assembled on.
             This must be a numpy array!
+        out : ndarray (2-D), optional
+            Fortran ordered array of shape (len(x), n_parameters) to assemble
+            the matrix in. Default is None, a new array is returned.
 
         Returns
         -------
         A : ndarray (2-D)
-            The assembled linear regression matrix.
+            The assembled linear regression matrix, Fortran ordered.
 
         Examples
         --------
@@ -280,30 +336,61 @@ class PiecewiseLinFit(object):
         self.fit_breaks = breaks[breaks_order]
         # store the number of parameters and line segments
         self.n_segments = len(breaks) - 1
-
-        # Assemble the regression matrix
-        A_list = [np.ones_like(x)]
         if self.degree >= 1:
-            A_list.append(x - self.fit_breaks[0])
+            self.n_parameters = self.degree * self.n_segments + 1
+        else:
+            self.n_parameters = self.n_segments
+
+        # Assemble the regression matrix column by column in place, every
+        # column of a Fortran ordered array is contiguous
+        if out is None:
+            out = np.empty((x.size, self.n_parameters), order='F')
+        A = out
+        A[:, 0] = 1.0
+        if self.degree >= 1:
+            np.subtract(x, self.fit_breaks[0], out=A[:, 1])
             for i in range(self.n_segments - 1):
-                A_list.append(np.where(x > self.fit_breaks[i+1],
-                                       x - self.fit_breaks[i+1],
-                                       0.0))
-            if self.degree >= 2:
-                for k in range(2, self.degree + 1):
-                    A_list.append((x - self.fit_breaks[0])**k)
-                    for i in range(self.n_segments - 1):
-                        A_list.append(np.where(x > self.fit_breaks[i+1],
-                                               (x - self.fit_breaks[i+1])**k,
-                                               0.0))
+                np.subtract(x, self.fit_breaks[i+1], out=A[:, i+2])
+                np.maximum(A[:, i+2], 0.0, out=A[:, i+2])
+            # the columns of degree k are the linear columns to the power k,
+            # squared as ** squares them
+            n = self.n_segments
+            for k in range(2, self.degree + 1):
+                if k == 2:
+                    np.square(A[:, 1:n+1], out=A[:, n+1:2*n+1])
+                else:
+                    np.power(A[:, 1:n+1], k, out=A[:, (k-1)*n+1:k*n+1])
         else:
-            A_list = [np.ones_like(x)]
             for i in range(self.n_segments - 1):
-                A_list.append(np.where(x > self.fit_breaks[i+1], 1.0, 0.0))
-        A = np.vstack(A_list).T
-        self.n_parameters = A.shape[1]
+                np.greater(x, self.fit_breaks[i+1], out=A[:, i+1])
         return A
 
+    def assemble_regression_buffer(self, breaks):
+        r"""
+        Assemble the linear regression matrix on the x data in the
+        preallocated buffer of the fit object. This is what the objective
+        functions use, a breakpoint search then evaluates them without
+        allocating a regression matrix. The matrix is overwritten by the next
+        call, use assemble_regression_matrix for a matrix to keep.
+
+        Parameters
+        ----------
+        breaks : array_like
+            The x locations where each line segment terminates.
+
+        Returns
+        -------
+        A : ndarray (2-D)
+            The assembled linear regression matrix, Fortran ordered.
+        """
+        if self.degree >= 1:
+            n_parameters = self.degree * (len(breaks) - 1) + 1
+        else:
+            n_parameters = len(breaks) - 1
+        buffer = self.get_buffer('A', (self.n_data, n_parameters))
+        return self.assemble_regression_matrix(breaks, self.x_data,
+                                               out=buffer)
+
     def fit_with_breaks(self, breaks):
         r"""
         A function which fits a continuous piecewise linear function
@@ -357,7 +444,8 @@ class PiecewiseLinFit(object):
         if isinstance(breaks, np.ndarray) is False:
             breaks = np.array(breaks)
 
-        A = self.assemble_regression_matrix(breaks, self.x_data)
+        self.reset_fit_statistics()
+        A = self.assemble_regression_buffer(breaks)
 
         # try to solve the regression problem
         try:
@@ -374,6 +462,47 @@ class PiecewiseLinFit(object):
         self.ssr = ssr
         return ssr
 
+    def set_fit(self, breaks, beta, ssr):
+        r"""
+        Store a fit with known breakpoints that was solved elsewhere, e.g. by
+        fit_with_breaks_batch, as if fit_with_breaks had computed it.
+
+        Parameters
+        ----------
+        breaks : array_like
+            The x locations where each line segment terminates.
+        beta : ndarray (1-D)
+            The model parameters of the fit.
+        ssr : float
+            The sum of squares of the residuals of the fit.
+
+        Examples
+        --------
+        Fit two data sets at once and keep the fit of the first.
+
+        >>> import pwlf
+        >>> x = [np.linspace(0.0, 1.0, 10), np.linspace(0.0, 2.0, 15)]
+        >>> y = [np.random.random(10), np.random.random(15)]
+        >>> breaks = [[0.0, 0.5, 1.0], [0.0, 1.2, 2.0]]
+        >>> beta, ssr, _, _ = pwlf.fit_with_breaks_batch(x, y, breaks)
+        >>> my_pwlf = pwlf.PiecewiseLinFit(x[0], y[0])
+        >>> my_pwlf.set_fit(breaks[0], beta[0], ssr[0])
+
+        """
+        # Check if breaks in ndarray, if not convert to np.array
+        if isinstance(breaks, np.ndarray) is False:
+            breaks = np.array(breaks)
+        self.reset_fit_statistics()
+        self.fit_breaks = np.sort(breaks)
+        self.n_segments = len(breaks) - 1
+        if self.degree >= 1:
+            self.n_parameters = self.degree * self.n_segments + 1
+        else:
+            self.n_parameters = self.n_segments
+        self.beta = np.array(beta, dtype=float)
+        self.calc_slopes()
+        self.ssr = ssr
+
     def fit_with_breaks_force_points(self, breaks, x_c, y_c):
         r"""
         A function which fits a continuous piecewise linear function
@@ -450,7 +579,7 @@ class PiecewiseLinFit(object):
         if isinstance(breaks, np.ndarray) is False:
             breaks = np.array(breaks)
 
-        A = self.assemble_regression_matrix(breaks, self.x_data)
+        A = self.assemble_regression_buffer(breaks)
         L = self.conlstsq(A)
         return L
 
@@ -558,7 +687,7 @@ class PiecewiseLinFit(object):
         breaks[0] = self.break_0
         breaks[-1] = self.break_n
 
-        A = self.assemble_regression_matrix(breaks, self.x_data)
+        A = self.assemble_regression_buffer(breaks)
 
         # try to solve the regression problem
         try:
@@ -575,6 +704,115 @@ class PiecewiseLinFit(object):
             # something went wrong...
         return ssr
 
+    def fit_with_breaks_opt_batch(self, var):
+        r"""
+        Vectorized fit_with_breaks_opt, the sum of squares of the residuals of
+        many breakpoint candidates from one stacked regression tensor. This is
+        the objective of fit, differential_evolution then evaluates a whole
+        population per call.
+
+        Parameters
+        ----------
+        var : array_like
+            The breakpoint locations of the candidates, shaped (nVar, S) as
+            differential_evolution passes them with vectorized=True, or a
+            single candidate shaped (nVar,).
+
+        Returns
+        -------
+        ssr : ndarray (1-D) or float
+            The sum of squares of the residuals of every candidate, a float
+            for a single candidate.
+
+        Notes
+        -----
+        Every candidate is solved with the SVD of its regression matrix.
+        Singular values up to machine precision times the largest one are left
+        out, as the gelsd driver of lstsq does, so rank deficient candidates
+        with two breakpoints between the same data points get the same ssr as
+        from fit_with_breaks_opt.
+        """
+        var = np.asarray(var, dtype=float)
+        if var.ndim == 1:
+            return self.fit_with_breaks_opt(var)
+        n_candidates = var.shape[1]
+        breaks = np.empty((n_candidates, var.shape[0] + 2))
+        breaks[:, 1:-1] = var.T
+        breaks[:, 0] = self.break_0
+        breaks[:, -1] = self.break_n
+        # sorted as assemble_regression_matrix sorts them
+        x = np.broadcast_to(self.x_data, (n_candidates, self.n_data))
+        A = assemble_regression_matrix_batch(np.sort(breaks, axis=1), x,
+                                             self.degree)
+        y = self.y_data
+        if self.weights is not None:
+            A *= self.weights[:, None]
+            y = self.y_w
+        try:
+            u, s, _ = np.linalg.svd(A, full_matrices=False)
+        except np.linalg.LinAlgError:
+            # one candidate did not converge, evaluate them one by one
+            return np.array([self.fit_with_breaks_opt(v) for v in var.T])
+        keep = s > np.finfo(float).eps * s[:, :1]
+        # the fit is the projection of y on the kept left singular vectors
+        uty = np.einsum('snp,n->sp', u, y) * keep
+        e = np.einsum('snp,sp->sn', u, uty) - y
+        ssr = np.einsum('sn,sn->s', e, e)
+        ssr[~np.isfinite(ssr)] = np.inf
+        return ssr
+
+    def fit_with_breaks_opt_grad(self, var):
+        r"""
+        fit_with_breaks_opt together with the derivative of the sum of
+        squares of the residuals with respect to every breakpoint, for
+        gradient based optimization routines such as fmin_l_bfgs_b.
+
+        Parameters
+        ----------
+        var : array_like
+            The breakpoint locations, or variable, in a custom
+            optimization routine.
+
+        Returns
+        -------
+        ssr : float
+            The sum of square of the residuals.
+        grad : ndarray (1-D)
+            The derivative of ssr with respect to every element of var.
+
+        Notes
+        -----
+        beta minimizes ssr for the breakpoints, so the derivative of ssr is
+        the one of the squared residuals with beta held fixed. Moving the
+        breakpoint b_j changes the model at every x > b_j by
+        -k beta_jk (x - b_j)^(k-1) for each degree k term of b_j, so
+
+            dssr/db_j = -2 sum_{x_i > b_j} w_i^2 r_i
+                        sum_k k beta_jk (x_i - b_j)^(k-1)
+
+        with the residuals r = A beta - y. Where a breakpoint is on a data
+        point the derivative from the left is returned. With degree=0 the
+        model is a step function and the derivative is 0.
+        """
+        var = np.asarray(var, dtype=float)
+        ssr = self.fit_with_breaks_opt(var)
+        grad = np.zeros(len(var))
+        if not np.isfinite(ssr) or self.degree == 0:
+            return ssr, grad
+        # the buffer still holds the regression matrix of var
+        A = self.get_buffer('A', (self.n_data, self.n_parameters))
+        r = np.dot(A, self.beta) - self.y_data
+        if self.weights is not None:
+            r *= self.weights**2
+        n = self.n_segments
+        # (x - b_j) after every inner breakpoint b_j, 0 before it
+        hinge = A[:, 2:n+1]
+        slope = (hinge > 0.0) * self.beta[2:n+1]
+        for k in range(2, self.degree + 1):
+            slope += k * self.beta[(k-1)*n+2:k*n+1] * hinge**(k-1)
+        grad[np.argsort(var)] = -2.0 * np.dot(r, slope)
+        return ssr, grad
+
     def fit_force_points_opt(self, var):
         r"""
         The objective function to perform a continuous piecewise linear
@@ -625,7 +863,7 @@ class PiecewiseLinFit(object):
         breaks_order = np.argsort(breaks)
         breaks = breaks[breaks_order]
 
-        A = self.assemble_regression_matrix(breaks, self.x_data)
+        A = self.assemble_regression_buffer(breaks)
         L = self.conlstsq(A)
         return L
 
@@ -676,6 +914,12 @@ class PiecewiseLinFit(object):
         For me information see:
         https://github.com/cjekel/piecewise_linear_fit_py/issues/15#issuecomment-434717232
 
+        Without x_c and y_c and with the default **kwargs, the population of
+        every generation is evaluated at once by fit_with_breaks_opt_batch
+        (vectorized=True, which updates the best solution once per
+        generation). Custom **kwargs are passed as given, add vectorized=True
+        to them to keep evaluating a generation at once.
+
         Examples
         --------
         This example shows you how to fit three continuous piecewise lines to
@@ -711,7 +955,7 @@ class PiecewiseLinFit(object):
             raise ValueError('You must provide both x_c and y_c!')
 
         # set the function to minimize
-        min_function = self.fit_with_breaks_opt
+        min_function = self.fit_with_breaks_opt_batch
 
         # if you've provided both x_c and y_c
         if x_c is not None and y_c is not None:
@@ -749,16 +993,15 @@ class PiecewiseLinFit(object):
 
         # run the optimization
         if len(kwargs) == 0:
-            res = differential_evolution(min_function, bounds,
-                                         strategy='best1bin', maxiter=1000,
-                                         popsize=50, tol=1e-3,
-                                         mutation=(0.5, 1), recombination=0.7,
-                                         seed=None, callback=None, disp=False,
-                                         polish=True, init='latinhypercube',
-                                         atol=1e-4)
-        else:
-            res = differential_evolution(min_function,
-                                         bounds, **kwargs)
+            kwargs = dict(strategy='best1bin', maxiter=1000, popsize=50,
+                          tol=1e-3, mutation=(0.5, 1), recombination=0.7,
+                          seed=None, callback=None, disp=False, polish=True,
+                          init='latinhypercube', atol=1e-4)
+            # evaluate the population of a generation at once, unless the
+            # fit is forced through points
+            if x_c is None:
+                kwargs.update(vectorized=True, updating='deferred')
+        res = differential_evolution(min_function, bounds, **kwargs)
         if self.print is True:
             print(res)
 
@@ -779,7 +1022,48 @@ class PiecewiseLinFit(object):
 
         return self.fit_breaks
 
-    def fitfast(self, n_segments, pop=2, bounds=None, **kwargs):
+    def optimize_breaks(self, x0, bounds, **kwargs):
+        r"""
+        Run fmin_l_bfgs_b on the breakpoints from x0, with the analytic
+        gradient of fit_with_breaks_opt_grad. This is one start of fitfast
+        and the optimization of fit_guess.
+
+        Parameters
+        ----------
+        x0 : array_like
+            The starting breakpoint locations.
+        bounds : array_like
+            Bounds for each breakpoint location, shaped (nVar, 2).
+        **kwargs : optional
+            Directly passed into scipy.optimize.fmin_l_bfgs_b(), in place of
+            the pwlf defaults. approx_grad=True uses finite differences of
+            fit_with_breaks_opt instead of the analytic gradient.
+
+        Returns
+        -------
+        x : ndarray (1-D)
+            The optimized breakpoint locations.
+        f : float
+            The sum of squares of the residuals at x.
+        d : dict
+            The information dictionary of fmin_l_bfgs_b.
+        """
+        if len(kwargs) == 0:
+            kwargs = dict(args=(), m=10, factr=1e2, pgtol=1e-05,
+                          iprint=-1, maxfun=15000, maxiter=15000, disp=None,
+                          callback=None)
+        if self.degree == 0 or kwargs.get('approx_grad', False):
+            # a step function has no useful derivative
+            kwargs.update(approx_grad=True,
+                          epsilon=kwargs.get('epsilon', 1e-08))
+            return fmin_l_bfgs_b(self.fit_with_breaks_opt, x0, bounds=bounds,
+                                 **kwargs)
+        kwargs['approx_grad'] = False
+        return fmin_l_bfgs_b(self.fit_with_breaks_opt_grad, x0,
+                             bounds=bounds, **kwargs)
+
+    def fitfast(self, n_segments, pop=2, bounds=None, max_workers=1,
+                **kwargs):
         r"""
         Uses multi start LBFGSB optimization to find the location of
         breakpoints for a given number of line segments by minimizing the sum
@@ -806,6 +1090,9 @@ class PiecewiseLinFit(object):
         bounds : array_like, optional
             Bounds for each breakpoint location within the optimization. This
             should have the shape of (n_segments, 2).
+        max_workers : int, optional
+            The number of processes that run the starts. Default is 1, every
+            start runs in this process. None runs one process per CPU.
         **kwargs : optional
             Directly passed into scipy.optimize.fmin_l_bfgs_b(). This
             will override any pwlf defaults when provided. See Note for more
@@ -872,20 +1159,17 @@ class PiecewiseLinFit(object):
         f = np.zeros(pop)
         d = []
 
-        for i, x0 in enumerate(mypop):
-            if len(kwargs) == 0:
-                resx, resf, resd = fmin_l_bfgs_b(self.fit_with_breaks_opt, x0,
-                                                 fprime=None, args=(),
-                                                 approx_grad=True,
-                                                 bounds=bounds, m=10,
-                                                 factr=1e2, pgtol=1e-05,
-                                                 epsilon=1e-08, iprint=-1,
-                                                 maxfun=15000, maxiter=15000,
-                                                 disp=None, callback=None)
-            else:
-                resx, resf, resd = fmin_l_bfgs_b(self.fit_with_breaks_opt, x0,
-                                                 fprime=None, approx_grad=True,
-                                                 bounds=bounds, **kwargs)
+        tasks = [(self, x0, bounds, kwargs) for x0 in mypop]
+        if max_workers == 1 or pop <= 1:
+            results = map(optimize_breaks_start, tasks)
+        else:
+            # every process optimizes its own copy of the fit object
+            if max_workers is None:
+                max_workers = os.cpu_count()
+            with ProcessPoolExecutor(max_workers=min(max_workers, pop)) as \
+                    executor:
+                results = list(executor.map(optimize_breaks_start, tasks))
+        for i, (resx, resf, resd) in enumerate(results):
             x[i, :] = resx
             f[i] = resf
             d.append(resd)
@@ -982,21 +1266,8 @@ class PiecewiseLinFit(object):
             bounds[:, 0] = self.break_0
             bounds[:, 1] = self.break_n
 
-        if len(kwargs) == 0:
-            resx, resf, _ = fmin_l_bfgs_b(self.fit_with_breaks_opt,
-                                          guess_breakpoints,
-                                          fprime=None, args=(),
-                                          approx_grad=True,
-                                          bounds=bounds, m=10,
-                                          factr=1e2, pgtol=1e-05,
-                                          epsilon=1e-08, iprint=-1,
-                                          maxfun=15000, maxiter=15000,
-                                          disp=None, callback=None)
-        else:
-            resx, resf, _ = fmin_l_bfgs_b(self.fit_with_breaks_opt,
-                                          guess_breakpoints,
-                                          fprime=None, approx_grad=True,
-                                          bounds=bounds, **kwargs)
+        resx, resf, _ = self.optimize_breaks(guess_breakpoints, bounds,
+                                             **kwargs)
 
         self.ssr = resf
 
@@ -1012,6 +1283,188 @@ class PiecewiseLinFit(object):
 
         return self.fit_breaks
 
+    def fit_discrete(self, n_segments, candidates=None, min_points=2,
+                     max_solves=2**22):
+        r"""
+        Fit a continuous piecewise linear function for a specified number
+        of line segments with the globally optimal breakpoints among candidate
+        locations. By default the candidates are the integers between the
+        smallest and largest x, for data on whole numbers such as day indexes
+        this is an exact and deterministic version of the breakpoint search of
+        fit.
+
+        Parameters
+        ----------
+        n_segments : int
+            The desired number of line segments.
+        candidates : array_like, optional
+            The possible breakpoint locations. Default is None, every integer
+            strictly between the smallest and the largest x.
+        min_points : int, optional
+            The fewest data points of a line segment. A point on a breakpoint
+            counts in the segment before it. Default is 2, which keeps every
+            regression full rank for distinct x values.
+        max_solves : int or None, optional
+            The most continuous fits before giving up, a search node counts as
+            one fit per candidate. Default is 2**22, some seconds. None
+            searches until the optimum is proven.
+
+        Returns
+        -------
+        fit_breaks : ndarray (1-D)
+            breakpoint locations stored as a 1-D numpy array.
+
+        Raises
+        ------
+        ValueError
+            The model is not linear (degree=1).
+        ValueError
+            No choice of candidates gives every segment min_points points.
+        ValueError
+            The search needs more than max_solves fits, use fit instead.
+
+        Notes
+        -----
+        Fitting a line to every segment on its own, without continuity, gives
+        a lower bound of the sum of squares of the residuals of the continuous
+        fit with the same breakpoints. The segment fits come from prefix sums
+        of x, y, x^2, xy and y^2, and dynamic programming gives the best bound
+        of the data after every candidate for every number of segments in
+        O(m^2 n_segments) for m candidates. Breakpoints are then chosen depth
+        first from left to right, skipping the choices whose bound is above
+        the best continuous fit found so far. The last two breakpoints of a
+        path are bounded together and their continuous fits are solved at
+        once from normal equations built from the same sums, so the memory
+        is O(m^2 + n_segments).
+
+        The search is a branch and bound, not a polynomial algorithm. When
+        the bound is loose, such as for noise with no trend, it solves up to
+        every one of the C(m, n_segments - 1) combinations of candidates,
+        O(m^(n_segments - 1)) time. Clear bends prune nearly all of them,
+        and max_solves caps the work of the hard cases.
+
+        Examples
+        --------
+        Fit three line segments to data on whole days.
+
+        >>> import pwlf
+        >>> x = np.arange(60.0)
+        >>> y = np.random.random(60)
+        >>> my_pwlf = pwlf.PiecewiseLinFit(x, y)
+        >>> breaks = my_pwlf.fit_discrete(3)
+
+        """
+        if self.degree != 1:
+            raise ValueError('fit_discrete only fits linear segments '
+                             '(degree=1).')
+        self.n_segments = int(n_segments)
+        self.n_parameters = self.n_segments + 1
+        self.nVar = self.n_segments - 1
+        if candidates is None:
+            candidates = np.arange(np.floor(self.break_0) + 1.0,
+                                   np.ceil(self.break_n))
+        candidates = np.unique(np.asarray(candidates, dtype=float))
+        candidates = candidates[(candidates > self.break_0) &
+                                (candidates < self.break_n)]
+
+        # shifting x and y changes no fit and keeps the sums small
+        order = np.argsort(self.x_data, kind='stable')
+        x = self.x_data[order] - self.break_0
+        y = self.y_data[order] - np.mean(self.y_data)
+        c = candidates - self.break_0
+        if self.weights is None:
+            w2 = np.ones(self.n_data)
+        else:
+            w2 = self.weights[order]**2
+        min_points = max(int(min_points), 1)
+        sums = get_prefix_sums(x, y, w2)
+        # bounds of the data of every segment in sums, the start, every
+        # candidate and the end
+        position = np.concatenate([[0], np.searchsorted(x, c, side='right'),
+                                   [self.n_data]])
+        end = len(position) - 1
+        start, stop = np.meshgrid(position, position, indexing='ij')
+        cost = line_ssr(sums, start, stop)
+        cost[stop - start < min_points] = np.inf
+        cost[:, 0] = np.inf
+        # rest[r][i] is the least cost of r segments from bound i to the end
+        rest = [None, cost[:, end].copy()]
+        rest[1][end] = np.inf
+        for r in range(2, self.n_segments + 1):
+            rest.append(np.min(cost[:, :end] + rest[r - 1][:end], axis=1))
+            rest[r][end] = np.inf
+        if not np.isfinite(rest[self.n_segments][0]):
+            raise ValueError('No breakpoints give every segment at least '
+                             'min_points points.')
+
+        # the best breakpoints of the bound give the first upper bound
+        choice = []
+        i = 0
+        for r in range(self.n_segments, 1, -1):
+            i = int(np.argmin(cost[i, :end] + rest[r - 1][:end]))
+            choice.append(i)
+        best = np.array(choice, dtype=int)
+        best_ssr = hinge_ssr(sums, x, c[best - 1][None, :])[0]
+        tol = 1e-9 * sums[5, -1] + 1e-12
+
+        # depth first search from left to right, with the cost of the
+        # segments so far and the lower bound of the choices below a node,
+        # the last two breakpoints of a path are bounded and solved at once
+        state = {'best': best, 'best_ssr': best_ssr, 'solves': 0}
+
+        def count(solves):
+            state['solves'] += solves
+            if max_solves is not None and state['solves'] > max_solves:
+                raise ValueError('fit_discrete needs more than max_solves '
+                                 'continuous fits, use fit or fewer '
+                                 'candidates.')
+
+        def solve(prefix, tails, lower):
+            keep = lower <= state['best_ssr'] + tol
+            tails, lower = tails[keep], lower[keep]
+            by_bound = np.argsort(lower, kind='stable')
+            tails, lower = tails[by_bound], lower[by_bound]
+            chunk = 4096
+            for first in range(0, len(tails), chunk):
+                if lower[first] > state['best_ssr'] + tol:
+                    break
+                part = tails[first:first + chunk]
+                count(len(part))
+                chosen = np.concatenate([np.tile(np.array(prefix, dtype=int),
+                                                 (len(part), 1)),
+                                         part], axis=1)
+                ssr = hinge_ssr(sums, x, c[chosen - 1])
+                if np.min(ssr) < state['best_ssr']:
+                    state['best_ssr'] = np.min(ssr)
+                    state['best'] = chosen[int(np.argmin(ssr))]
+
+        def search(prefix, last, so_far):
+            # a node costs about as much as a fit per candidate
+            count(end)
+            remaining = self.nVar - len(prefix)
+            new = so_far + cost[last, :end]
+            if remaining == 1:
+                solve(prefix, np.arange(end)[:, None], new + rest[1][:end])
+            elif remaining == 2:
+                lower = new[:, None] + cost[:end, :end] + rest[1][:end]
+                i, j = np.nonzero(lower <= state['best_ssr'] + tol)
+                solve(prefix, np.stack([i, j], axis=1), lower[i, j])
+            else:
+                lower = new + rest[self.n_segments - len(prefix) - 1][:end]
+                for i in np.argsort(lower, kind='stable'):
+                    if lower[i] > state['best_ssr'] + tol:
+                        break
+                    search(prefix + [i], i, new[i])
+
+        if self.nVar > 0:
+            search([], 0, 0.0)
+        best = state['best']
+
+        breaks = np.concatenate([[self.break_0], candidates[best - 1],
+                                 [self.break_n]])
+        self.fit_with_breaks(breaks)
+        return self.fit_breaks
+
     def use_custom_opt(self, n_segments, x_c=None, y_c=None):
         r"""
         Provide the number of line segments you want to use with your
@@ -1113,6 +1566,63 @@ class PiecewiseLinFit(object):
         self.intercepts = y_hat[0:-1] - self.slopes*self.fit_breaks[0:-1]
         return self.slopes
 
+    def reset_fit_statistics(self):
+        r"""
+        Drop the statistics kept by get_fit_statistics. The fits and the
+        methods that change the data call this, call it after changing beta
+        or fit_breaks in place.
+        """
+        self.fit_statistics = None
+        self.fit_statistics_key = None
+
+    def get_fit_statistics(self):
+        r"""
+        The unbiased variance estimate and the pseudo-inverse of A^T A of
+        the current fit, which variance, standard_errors and
+        prediction_variance share. They are computed once and kept until
+        reset_fit_statistics runs or beta or fit_breaks is replaced by another
+        array, so a repeated call costs nothing and the uncertainty of a fit
+        costs O(p^2) per query point after the first call. Changing beta or
+        fit_breaks in place is not noticed, call reset_fit_statistics then.
+
+        Returns
+        -------
+        variance : float
+            The unbiased variance estimate of the residuals.
+        AtA_pinv : ndarray (2-D)
+            The pseudo-inverse of A^T A for the regression matrix A on the x
+            data. A pseudo-inverse, as a segment without data leaves A^T A
+            singular.
+        AtA_w_pinv : ndarray (2-D)
+            The same for the weighted regression matrix, None without
+            weights.
+
+        Raises
+        ------
+        LinAlgError
+            This typically means your regression problem is ill-conditioned.
+        """
+        # The key holds the arrays themselves, their ids can not be reused
+        # while they are kept
+        key = self.fit_statistics_key
+        if key is None or key[0] is not self.beta or \
+                key[1] is not self.fit_breaks:
+            Ad = self.assemble_regression_matrix(self.fit_breaks, self.x_data)
+            try:
+                e = np.dot(Ad, self.beta) - self.y_data
+                # solve for the unbiased estimate of variance
+                variance = np.dot(e, e) / (self.n_data - self.beta.size)
+                AtA_pinv = linalg.pinv(np.dot(Ad.T, Ad))
+                AtA_w_pinv = None
+                if self.weights is not None:
+                    Ad *= self.weights[:, None]
+                    AtA_w_pinv = linalg.pinv(np.dot(Ad.T, Ad))
+            except linalg.LinAlgError:
+                raise linalg.LinAlgError('Singular matrix')
+            self.fit_statistics = (variance, AtA_pinv, AtA_w_pinv)
+            self.fit_statistics_key = (self.beta, self.fit_breaks)
+        return self.fit_statistics
+
     def standard_errors(self, method='linear', step_size=1e-4):
         r"""
         Calculate the standard errors for each beta parameter determined
@@ -1187,10 +1697,11 @@ class PiecewiseLinFit(object):
             raise AttributeError(errmsg)
         ny = self.n_data
         if method == 'linear':
-            A = self.assemble_regression_matrix(self.fit_breaks, self.x_data)
-            y_hat = np.dot(A, self.beta)
-            e = y_hat - self.y_data
-
+            variance, AtA_pinv, AtA_w_pinv = self.get_fit_statistics()
+            if self.weights is not None:
+                AtA_pinv = AtA_w_pinv
+            self.se = np.sqrt(variance * np.abs(AtA_pinv.diagonal()))
+            return self.se
         elif method == 'non-linear':
             nb = self.beta.size + self.fit_breaks.size - 2
             f0 = self.predict(self.x_data)
@@ -1303,31 +1814,16 @@ class PiecewiseLinFit(object):
         if isinstance(x, np.ndarray) is False:
             x = np.array(x)
 
-        # Regression matrix on training data
-        Ad = self.assemble_regression_matrix(self.fit_breaks, self.x_data)
-
-        # try to solve for the unbiased variance estimation
-        try:
-
-            y_hat = np.dot(Ad, self.beta)
-            e = y_hat - self.y_data
-            # solve for the unbiased estimate of variance
-            variance = np.dot(e, e) / (ny - nb)
-
-        except linalg.LinAlgError:
-            raise linalg.LinAlgError('Singular matrix')
-
+        # the online fit keeps the inverse of A^T A
+        if self.online_valid() and self.AtA_inv is not None:
+            A = self.assemble_regression_matrix(self.fit_breaks, x)
+            variance = self.ssr / (ny - nb)
+            return variance * np.einsum('ij,jk,ik->i', A, self.AtA_inv, A)
+        variance, AtA_pinv, _ = self.get_fit_statistics()
         # Regression matrix on prediction data
         A = self.assemble_regression_matrix(self.fit_breaks, x)
-
-        # try to solve for the prediction variance at the x locations
-        try:
-            pre_var = variance * \
-                np.dot(np.dot(A, linalg.pinv(np.dot(Ad.T, Ad))), A.T)
-            return pre_var.diagonal()
-
-        except linalg.LinAlgError:
-            raise linalg.LinAlgError('Singular matrix')
+        # only the diagonal of A (A^T A)^+ A^T
+        return variance * np.einsum('ij,jk,ik->i', A, AtA_pinv, A)
 
     def r_squared(self):
         r"""
@@ -1477,9 +1973,14 @@ class PiecewiseLinFit(object):
         r"""
         Perform the least squares fit for A matrix.
         """
+        # LAPACK overwrites the matrix it solves, it gets a copy in a work
+        # buffer instead of a new copy per call, and A stays intact
+        work = self.get_buffer('lstsq', A.shape)
         if self.weights is None:
-            beta, ssr, _, _ = linalg.lstsq(A, self.y_data,
-                                           lapack_driver=self.lapack_driver)
+            np.copyto(work, A)
+            beta, ssr, _, _ = linalg.lstsq(work, self.y_data,
+                                           lapack_driver=self.lapack_driver,
+                                           overwrite_a=True)
             # ssr is only calculated if self.n_data > self.n_parameters
             # in this case I'll need to calculate ssr manually
             # where ssr = sum of square of residuals
@@ -1488,8 +1989,10 @@ class PiecewiseLinFit(object):
                 e = y_hat - self.y_data
                 ssr = np.dot(e, e)
         else:
-            beta, _, _, _ = linalg.lstsq((A.T*self.weights).T, self.y_w,
-                                         lapack_driver=self.lapack_driver)
+            np.multiply(A, self.weights[:, None], out=work)
+            beta, _, _, _ = linalg.lstsq(work, self.y_w,
+                                         lapack_driver=self.lapack_driver,
+                                         overwrite_a=True)
             # calculate the weighted sum of square of residuals
             y_hat = np.dot(A, beta)
             e = y_hat - self.y_data
@@ -1515,28 +2018,10 @@ class PiecewiseLinFit(object):
         r"""
         Perform a constrained least squares fit for A matrix.
         """
-        # Assemble the constraint matrix
-        C_list = [np.ones_like(self.x_c)]
-        if self.degree >= 1:
-            C_list.append(self.x_c - self.fit_breaks[0])
-            for i in range(self.n_segments - 1):
-                C_list.append(np.where(self.x_c > self.fit_breaks[i+1],
-                                       self.x_c - self.fit_breaks[i+1],
-                                       0.0))
-            if self.degree >= 2:
-                for k in range(2, self.degree + 1):
-                    C_list.append((self.x_c - self.fit_breaks[0])**k)
-                    for i in range(self.n_segments - 1):
-                        C_list.append(np.where(self.x_c > self.fit_breaks[i+1],
-                                               (self.x_c
-                                                - self.fit_breaks[i+1])**k,
-                                               0.0))
-        else:
-            for i in range(self.n_segments - 1):
-                C_list.append(np.where(self.x_c > self.fit_breaks[i+1],
-                                       1.0,
-                                       0.0))
-        C = np.vstack(C_list).T
+        # Assemble the constraint matrix, the regression matrix on x_c
+        C = self.assemble_regression_matrix(
+            self.fit_breaks, self.x_c,
+            out=self.get_buffer('C', (self.c_n, self.n_parameters)))
 
         _, m = A.shape
         o, _ = C.shape
@@ -1547,7 +2032,7 @@ class PiecewiseLinFit(object):
         K[:m, m:] = C.T
         K[m:, :m] = C
         # Assemble right hand side vector
-        yt = np.dot(2.0*A.T, self.y_data)
+        yt = 2.0*np.dot(A.T, self.y_data)
 
         z = np.zeros(self.n_parameters + self.c_n)
         z[:self.n_parameters] = yt
@@ -1626,17 +2111,475 @@ class PiecewiseLinFit(object):
 
         ny = self.n_data
 
-        # Regression matrix on training data
-        Ad = self.assemble_regression_matrix(self.fit_breaks, self.x_data)
+        # the online fit keeps the sum of squares of the residuals
+        if self.online_valid():
+            return self.ssr / (ny - nb)
+        return self.get_fit_statistics()[0]
 
-        # try to solve for the unbiased variance estimation
-        try:
+    def fit_with_breaks_online(self, breaks):
+        r"""
+        Fit with specified breakpoint locations as fit_with_breaks does, and
+        keep the sufficient statistics A^T A, A^T y and y^T y so that data
+        can then be added with add_data() and removed with remove_data()
+        without assembling the regression matrix again.
 
-            y_hat = np.dot(Ad, self.beta)
-            e = y_hat - self.y_data
-            # solve for the unbiased estimate of variance
-            variance = np.dot(e, e) / (ny - nb)
+        Parameters
+        ----------
+        breaks : array_like
+            The x locations where each line segment terminates.
 
-        except linalg.LinAlgError:
-            raise linalg.LinAlgError('Singular matrix')
-        return variance
+        Returns
+        -------
+        ssr : float
+            Returns the sum of squares of the residuals.
+
+        Raises
+        ------
+        ValueError
+            Online updates are not supported for weighted fits.
+
+        Examples
+        --------
+        Fit the data, then add a new day and remove an outlier.
+
+        >>> import pwlf
+        >>> my_pwlf = pwlf.PiecewiseLinFit(x, y)
+        >>> ssr = my_pwlf.fit_with_breaks_online([0.0, 0.5, 1.0])
+        >>> ssr = my_pwlf.add_data(1.1, 0.4)
+        >>> ssr = my_pwlf.remove_data(x[3], y[3])
+
+        """
+        if self.weights is not None:
+            raise ValueError('Online updates are not supported with weights.')
+        self.reset_fit_statistics()
+        ssr = self.fit_with_breaks(breaks)
+        A = self.assemble_regression_matrix(self.fit_breaks, self.x_data)
+        self.AtA = np.dot(A.T, A)
+        self.Aty = np.dot(A.T, self.y_data)
+        self.yty = np.dot(self.y_data, self.y_data)
+        if np.linalg.matrix_rank(self.AtA) == self.n_parameters:
+            self.AtA_inv = linalg.inv(self.AtA)
+        else:
+            self.AtA_inv = None
+        self.online_beta = self.beta.copy()
+        self.online_breaks = self.fit_breaks.copy()
+        return ssr
+
+    def online_valid(self):
+        r"""
+        Whether beta and the breakpoints are still those of the online fit,
+        so the kept statistics describe the current model.
+        """
+        return self.AtA is not None and \
+            np.array_equal(self.beta, self.online_beta) and \
+            np.array_equal(self.fit_breaks, self.online_breaks)
+
+    def solve_online(self):
+        r"""
+        Least squares solution from the kept statistics, the minimum norm
+        solution when a line segment has no data. Return beta and ssr.
+        """
+        if np.linalg.matrix_rank(self.AtA) == self.n_parameters:
+            self.AtA_inv = linalg.inv(self.AtA)
+            beta = np.dot(self.AtA_inv, self.Aty)
+        else:
+            self.AtA_inv = None
+            beta = np.dot(linalg.pinv(self.AtA), self.Aty)
+        ssr = self.yty - 2 * np.dot(beta, self.Aty) + \
+            np.dot(beta, np.dot(self.AtA, beta))
+        return beta, max(ssr, 0.0)
+
+    def update_online(self, x, y, sign):
+        r"""
+        Add (sign=1) or remove (sign=-1) observations with rank one updates
+        of the inverse of A^T A (Sherman-Morrison), which costs O(p^2) per
+        observation. Removing an observation that leaves a parameter without
+        data falls back to solving from the kept statistics.
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        y = np.atleast_1d(np.asarray(y, dtype=float))
+        if x.shape != y.shape or x.ndim != 1:
+            raise ValueError('x and y must be 1-D with the same length.')
+        if self.AtA is None:
+            raise AttributeError('You must call fit_with_breaks_online() '
+                                 'before adding or removing data.')
+        if sign < 0:
+            # find every removed observation before changing anything
+            keep = np.ones(self.n_data, dtype=bool)
+            for xi, yi in zip(x, y):
+                idx = np.flatnonzero(keep & (self.x_data == xi) &
+                                     (self.y_data == yi))
+                if len(idx) == 0:
+                    raise ValueError('(' + str(xi) + ', ' + str(yi) +
+                                     ') is not in the data.')
+                keep[idx[0]] = False
+        if not np.array_equal(self.fit_breaks, self.online_breaks):
+            # the breakpoints changed since the online fit
+            self.fit_with_breaks_online(self.fit_breaks)
+        if np.array_equal(self.beta, self.online_beta):
+            beta, ssr = self.beta.copy(), self.ssr
+        else:
+            # beta was changed by hand, start from the least squares beta
+            beta, ssr = self.solve_online()
+        A = self.assemble_regression_matrix(self.online_breaks, x)
+        for a, yi in zip(A, y):
+            self.AtA += sign * np.outer(a, a)
+            self.Aty += sign * a * yi
+            self.yty += sign * yi * yi
+            if self.AtA_inv is not None:
+                g = np.dot(self.AtA_inv, a)
+                d = 1.0 + sign * np.dot(a, g)
+                if d > 1e-10:
+                    e = yi - np.dot(a, beta)
+                    beta += sign * g * e / d
+                    self.AtA_inv -= sign * np.outer(g, g) / d
+                    ssr = max(ssr + sign * e * e / d, 0.0)
+                    continue
+            beta, ssr = self.solve_online()
+        if sign > 0:
+            self.x_data = np.append(self.x_data, x)
+            self.y_data = np.append(self.y_data, y)
+        else:
+            self.x_data = self.x_data[keep]
+            self.y_data = self.y_data[keep]
+        self.n_data = self.x_data.size
+        if self.n_data > 0:
+            self.break_0 = np.min(self.x_data)
+            self.break_n = np.max(self.x_data)
+        self.beta = beta
+        self.ssr = ssr
+        self.online_beta = beta.copy()
+        self.calc_slopes()
+        return ssr
+
+    def add_data(self, x, y):
+        r"""
+        Add observations to an online fit and update beta and ssr in O(p^2)
+        per observation.
+
+        Parameters
+        ----------
+        x : array_like
+            The x locations of the new observations.
+        y : array_like
+            The y values of the new observations.
+
+        Returns
+        -------
+        ssr : float
+            The sum of squares of the residuals with the new observations.
+
+        Raises
+        ------
+        AttributeError
+            You have not performed fit_with_breaks_online() yet.
+
+        Examples
+        --------
+        Refresh the fit when one more day of data arrives.
+
+        >>> ssr = my_pwlf.fit_with_breaks_online(breaks)
+        >>> ssr = my_pwlf.add_data(x_new, y_new)
+        >>> variance = my_pwlf.variance()
+
+        """
+        self.reset_fit_statistics()
+        return self.update_online(x, y, 1)
+
+    def remove_data(self, x, y):
+        r"""
+        Remove observations (e.g. outliers) from an online fit and update
+        beta and ssr in O(p^2) per observation.
+
+        Parameters
+        ----------
+        x : array_like
+            The x locations of the removed observations.
+        y : array_like
+            The y values of the removed observations, each (x, y) pair must
+            be in the data.
+
+        Returns
+        -------
+        ssr : float
+            The sum of squares of the residuals without the observations.
+
+        Raises
+        ------
+        ValueError
+            An (x, y) pair is not in the data.
+        AttributeError
+            You have not performed fit_with_breaks_online() yet.
+
+        Examples
+        --------
+        Drop the outliers found by a robust fit.
+
+        >>> ssr = my_pwlf.fit_with_breaks_online(breaks)
+        >>> ssr = my_pwlf.remove_data(x[outliers], y[outliers])
+
+        """
+        self.reset_fit_statistics()
+        return self.update_online(x, y, -1)
+
+
+def optimize_breaks_start(task):
+    r"""
+    One start of fitfast, PiecewiseLinFit.optimize_breaks of the task
+    (fit object, x0, bounds, kwargs). A module function, so that a process
+    pool can run it.
+    """
+    regr_pw, x0, bounds, kwargs = task
+    return regr_pw.optimize_breaks(x0, bounds, **kwargs)
+
+
+def pad_batch(arrays):
+    r"""
+    Stack 1-D arrays of different lengths into a zero padded 2-D array.
+
+    Parameters
+    ----------
+    arrays : list of array_like
+        One 1-D array per problem.
+
+    Returns
+    -------
+    padded : ndarray (2-D)
+        padded[i, :len(arrays[i])] is arrays[i], the rest is 0.
+    mask : ndarray (2-D)
+        True where padded holds a value of arrays.
+    """
+    lengths = np.array([len(a) for a in arrays], dtype=int)
+    mask = np.arange(max(lengths.max(initial=0), 1))[None, :] < \
+        lengths[:, None]
+    padded = np.zeros(mask.shape)
+    if len(arrays) > 0:
+        padded[mask] = np.concatenate([np.asarray(a, dtype=float)
+                                       for a in arrays])
+    return padded, mask
+
+
+def assemble_regression_matrix_batch(breaks, x, degree=1):
+    r"""
+    Assemble the linear regression matrices of many problems at once, column
+    by column as PiecewiseLinFit.assemble_regression_matrix does.
+
+    Parameters
+    ----------
+    breaks : ndarray (2-D)
+        Sorted breakpoints of every problem, shaped (n_problems, n_breaks).
+    x : ndarray (2-D)
+        The x locations of every problem, shaped (n_problems, n_x).
+    degree : int, optional
+        The degree of polynomial to use. Default is degree=1.
+
+    Returns
+    -------
+    A : ndarray (3-D)
+        The regression matrices, shaped (n_problems, n_x, n_parameters).
+    """
+    n_segments = breaks.shape[1] - 1
+    inner = breaks[:, 1:-1, None]
+    after = x[:, None, :] > inner
+    A_list = [np.ones_like(x)[:, None, :]]
+    if degree >= 1:
+        A_list.append((x - breaks[:, :1])[:, None, :])
+        A_list.append(np.where(after, x[:, None, :] - inner, 0.0))
+        for k in range(2, degree + 1):
+            A_list.append(((x - breaks[:, :1])**k)[:, None, :])
+            A_list.append(np.where(after, (x[:, None, :] - inner)**k, 0.0))
+    elif n_segments > 1:
+        A_list.append(np.where(after, 1.0, 0.0))
+    return np.concatenate(A_list, axis=1).transpose(0, 2, 1)
+
+
+def get_prefix_sums(x, y, w2):
+    r"""
+    Prefix sums of the data for fit_discrete.
+
+    Parameters
+    ----------
+    x : ndarray (1-D)
+        The sorted x data.
+    y : ndarray (1-D)
+        The y data in the order of x.
+    w2 : ndarray (1-D)
+        The squared weights of the data.
+
+    Returns
+    -------
+    sums : ndarray (2-D)
+        sums[:, i] are the weighted sums of 1, x, x^2, y, xy and y^2 of the
+        first i data points, shaped (6, n + 1).
+    """
+    sums = np.zeros((6, len(x) + 1))
+    np.cumsum([w2, w2*x, w2*x*x, w2*y, w2*x*y, w2*y*y], axis=1,
+              out=sums[:, 1:])
+    return sums
+
+
+def line_ssr(sums, start, stop):
+    r"""
+    Sum of squares of the residuals of the least squares line through the
+    data points from start to stop (excluded), from the prefix sums of
+    get_prefix_sums. Fewer than two distinct x give a constant or no fit.
+
+    Parameters
+    ----------
+    sums : ndarray (2-D)
+        The prefix sums of get_prefix_sums.
+    start : ndarray
+        The index of the first data point of every line.
+    stop : ndarray
+        The index after the last data point of every line, same shape as
+        start.
+
+    Returns
+    -------
+    ssr : ndarray
+        The sum of squares of the residuals of every line, 0 for no data.
+    """
+    s0, s1, s2, sy, sxy, syy = sums[:, stop] - sums[:, start]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sxx = s2 - s1*s1/s0
+        sxy = sxy - s1*sy/s0
+        syy = syy - sy*sy/s0
+        ssr = np.where(sxx > 0, syy - sxy*sxy/sxx, syy)
+    return np.clip(np.where(s0 > 0, ssr, 0.0), 0.0, None)
+
+
+def hinge_ssr(sums, x, breaks):
+    r"""
+    Sum of squares of the residuals of continuous piecewise linear fits of
+    the data for many sets of breakpoints at once. The normal equations of
+    every set are built from the prefix sums of get_prefix_sums, no
+    regression matrix is assembled.
+
+    Parameters
+    ----------
+    sums : ndarray (2-D)
+        The prefix sums of get_prefix_sums.
+    x : ndarray (1-D)
+        The sorted x data, the first breakpoint is at x = 0.
+    breaks : ndarray (2-D)
+        The sorted inner breakpoints of every set, shaped (n_sets,
+        n_segments - 1).
+
+    Returns
+    -------
+    ssr : ndarray (1-D)
+        The sum of squares of the residuals of every set.
+    """
+    n_sets = len(breaks)
+    # a hinge at the first breakpoint is x itself
+    c = np.concatenate([np.zeros((n_sets, 1)), breaks], axis=1)
+    first = np.searchsorted(x, c, side='right')
+    first[:, 0] = 0
+    # sums over the data points after every breakpoint
+    t0, t1, t2, ty, txy = (sums[:, -1:] - sums)[:5, first]
+    p = c.shape[1] + 1
+    AtA = np.empty((n_sets, p, p))
+    Aty = np.empty((n_sets, p))
+    AtA[:, 0, 0] = sums[0, -1]
+    AtA[:, 0, 1:] = AtA[:, 1:, 0] = t1 - c*t0
+    Aty[:, 0] = sums[3, -1]
+    Aty[:, 1:] = txy - c*ty
+    # two hinges are both nonzero after the later breakpoint
+    later = np.maximum.outer(np.arange(p - 1), np.arange(p - 1))
+    ci, cj = c[:, :, None], c[:, None, :]
+    AtA[:, 1:, 1:] = t2[:, later] - (ci + cj)*t1[:, later] + \
+        ci*cj*t0[:, later]
+    try:
+        beta = np.linalg.solve(AtA, Aty[:, :, None])[:, :, 0]
+    except np.linalg.LinAlgError:
+        beta = np.einsum('npq,nq->np', np.linalg.pinv(AtA), Aty)
+    return sums[5, -1] - np.einsum('np,np->n', beta, Aty)
+
+
+def fit_with_breaks_batch(x, y, breaks, x_pred=None, degree=1):
+    r"""
+    Fit continuous piecewise linear functions with known breakpoints to many
+    data sets at once. This is PiecewiseLinFit.fit_with_breaks followed by
+    variance() and prediction_variance() for every data set, except that all
+    normal equations are solved with one stacked solve instead of one lstsq
+    per data set.
+
+    Parameters
+    ----------
+    x : list of array_like
+        The x data of every data set, data sets can have different lengths.
+    y : list of array_like
+        The y data of every data set, same lengths as x.
+    breaks : array_like (2-D)
+        The breakpoints of every data set, shaped (n_sets, n_breaks). Every
+        data set has the same number of line segments.
+    x_pred : list of array_like, optional
+        The x locations of every data set where the prediction variance is
+        calculated. Default is None, no prediction variance.
+    degree : int, optional
+        The degree of polynomial to use. Default is degree=1.
+
+    Returns
+    -------
+    beta : ndarray (2-D)
+        The model parameters of every data set, shaped (n_sets,
+        n_parameters).
+    ssr : ndarray (1-D)
+        The sum of squares of the residuals of every data set.
+    variance : ndarray (1-D)
+        The unbiased variance estimate of every data set.
+    pre_var : list of ndarray (1-D)
+        The prediction variance at x_pred of every data set, None when x_pred
+        is None.
+
+    Notes
+    -----
+    The normal equations square the condition number of the regression
+    matrix, which is fine for the few well separated breakpoints this is
+    meant for. Only the singular problems, e.g. with a line segment without
+    data, fall back to lstsq and to the pseudo-inverse for the prediction
+    variance as prediction_variance() does, the others of the batch are
+    still solved with the inverse. Use set_fit to store the fit of a data set
+    in its PiecewiseLinFit.
+
+    Examples
+    --------
+    Fit two data sets with their own breakpoints.
+
+    >>> import pwlf
+    >>> x = [np.linspace(0.0, 1.0, 10), np.linspace(0.0, 2.0, 15)]
+    >>> y = [np.random.random(10), np.random.random(15)]
+    >>> breaks = [[0.0, 0.5, 1.0], [0.0, 1.2, 2.0]]
+    >>> beta, ssr, variance, _ = pwlf.fit_with_breaks_batch(x, y, breaks)
+
+    """
+    breaks = np.sort(np.asarray(breaks, dtype=float), axis=1)
+    x_data, mask = pad_batch(x)
+    y_data, _ = pad_batch(y)
+    # Padded rows of A are 0 so they do not enter the normal equations
+    A = assemble_regression_matrix_batch(breaks, x_data, degree) * \
+        mask[:, :, None]
+    AtA = np.einsum('nip,niq->npq', A, A)
+    Aty = np.einsum('nip,ni->np', A, y_data)
+    # Only the singular problems get the pseudo-inverse, as in solve_online.
+    # inv does not flag every singular matrix, rounding can leave a tiny pivot
+    singular = np.linalg.matrix_rank(AtA) < AtA.shape[1]
+    AtA_inv = np.empty_like(AtA)
+    AtA_inv[~singular] = np.linalg.inv(AtA[~singular])
+    AtA_inv[singular] = np.linalg.pinv(AtA[singular])
+    beta = np.einsum('npq,nq->np', AtA_inv, Aty)
+    # Singular problems are rare, their minimum norm solution comes from
+    # lstsq on A itself as in fit_with_breaks, which keeps an exact fit exact
+    for i in np.flatnonzero(singular):
+        beta[i] = linalg.lstsq(A[i][mask[i]], y_data[i][mask[i]])[0]
+    e = (np.einsum('nip,np->ni', A, beta) - y_data) * mask
+    ssr = np.einsum('ni,ni->n', e, e)
+    variance = ssr / (mask.sum(axis=1) - beta.shape[1])
+    if x_pred is None:
+        return beta, ssr, variance, None
+    x_pred_data, pred_mask = pad_batch(x_pred)
+    A_pred = assemble_regression_matrix_batch(breaks, x_pred_data, degree)
+    pre_var = variance[:, None] * np.einsum('nip,npq,niq->ni', A_pred,
+                                            AtA_inv, A_pred)
+    return beta, ssr, variance, [pre_var[i, :pred_mask[i].sum()]
+                                 for i in range(len(pre_var))]
@@ -0,0 +1,92 @@
+import itertools
+import numpy as np
+import pandas as pd
+import model_utils as mu
+
+SCENARIO_LEVELS = ['relax_date', 'contain_rate', 'test_rate']
+SCENARIO_COLUMNS = ['predicted_death', 'lower_bound', 'upper_bound', 'hospital_beds', 'ICU']
+
+
+class ScenarioSweep(object):
+    '''Forecasts of many (relax_date, contain_rate, test_rate) scenarios of one region from one fit. A scenario only
+    appends a relax segment to the fitted parameters and scales the out of sample variance, so the data, the robust
+    fits and the regression of get_log_daily_predicted_death run once here and the scenarios are evaluated together
+    by mu.get_scenario_log_predictions, as get_log_daily_predicted_death evaluates one. A relax_date of None is the
+    scenario without relaxing the lockdown'''
+
+    def __init__(self, local_death_data, forecast_horizon=60, lockdown_date=None, params=None):
+        self.params = params or mu.get_default_params()
+        self.fit = mu.fit_log_daily_death(local_death_data, forecast_horizon, lockdown_date, params=self.params)
+        self.regr_pw, _, self.forecast_date_index, self.forecast_time_idx, _, self.lockdown_effective_date, _ = \
+            self.fit
+        self.model_beta = self.regr_pw.beta.copy()
+        self.beds_kernel = mu.get_hospital_beds_kernel(params=self.params)
+        self.beds_window = mu.get_hospital_beds_window(params=self.params)
+        self.ICU_kernel = mu.get_ICU_kernel(params=self.params)
+        self.ICU_window = mu.get_ICU_window(params=self.params)
+
+    def get_log_predictions(self, relax_dates, contain_rates, test_rates):
+        '''Log daily predicted death and its prediction variance of every scenario as (scenarios, days) arrays,
+        scenario i is (relax_dates[i], contain_rates[i], test_rates[i]). Same values as
+        get_log_daily_predicted_death, both come from mu.get_scenario_log_predictions'''
+        _, log_predicted, log_predicted_var = mu.get_scenario_log_predictions(self.fit, relax_dates, contain_rates,
+                                                                              test_rates, params=self.params)
+        return log_predicted, log_predicted_var
+
+    def get_log_fit(self, relax_date=None, contain_rate=0.5, test_rate=0.2):
+        '''Log daily predicted death and its bounds of one scenario, as get_log_daily_predicted_death returns them'''
+        log_predicted, log_predicted_var = self.get_log_predictions([relax_date], [contain_rate], [test_rate])
+        return pd.DataFrame({'predicted_death': log_predicted[0],
+                             'lower_bound': log_predicted[0] - 1.96 * np.sqrt(log_predicted_var[0]),
+                             'upper_bound': log_predicted[0] + 1.96 * np.sqrt(log_predicted_var[0])},
+                            index=self.forecast_date_index)
+
+    def evaluate(self, relax_dates, contain_rates, test_rates):
+        '''Daily death with its bounds, hospital beds and ICU of every scenario, indexed by (relax_date,
+        contain_rate, test_rate, date). Scenario i is (relax_dates[i], contain_rates[i], test_rates[i]), values
+        are the ones of get_daily_metrics_from_death_data. Beds and ICU of all scenarios come from one convolution'''
+        log_predicted, log_predicted_var = self.get_log_predictions(relax_dates, contain_rates, test_rates)
+        predicted = np.exp(log_predicted)
+        metrics = [('predicted_death', 0, predicted),
+                   ('lower_bound', 0, np.exp(log_predicted - 1.96 * np.sqrt(log_predicted_var))),
+                   ('upper_bound', 0, np.exp(log_predicted + 1.96 * np.sqrt(log_predicted_var))),
+                   ('hospital_beds', self.beds_window[0],
+                    mu.convolve_occupancy(predicted, *self.beds_kernel, self.beds_window)),
+                   ('ICU', self.ICU_window[0], mu.convolve_occupancy(predicted, *self.ICU_kernel, self.ICU_window))]
+        first_offset = min(offset for _, offset, _ in metrics)
+        n_days = max(offset + values.shape[1] for _, offset, values in metrics) - first_offset
+        block = np.full((len(relax_dates), n_days, len(metrics)), np.nan)
+        for column, (_, offset, values) in enumerate(metrics):
+            block[:, offset - first_offset:offset - first_offset + values.shape[1], column] = values
+        dates = pd.date_range(self.forecast_date_index[0] + pd.Timedelta(days=int(first_offset)), periods=n_days)
+        scenarios = pd.MultiIndex.from_arrays([[pd.NaT if relax_date is None else pd.to_datetime(relax_date)
+                                                for relax_date in relax_dates], contain_rates, test_rates],
+                                              names=SCENARIO_LEVELS)
+        index = pd.MultiIndex.from_arrays([np.repeat(scenarios.get_level_values(level), n_days)
+                                           for level in SCENARIO_LEVELS] + [np.tile(dates, len(relax_dates))],
+                                          names=SCENARIO_LEVELS + ['date'])
+        return pd.DataFrame(block.reshape(-1, len(metrics)), index=index, columns=SCENARIO_COLUMNS)
+
+    def evaluate_grid(self, relax_dates=(None,), contain_rates=(0.5,), test_rates=(0.2,)):
+        '''evaluate on every combination of relax_dates, contain_rates and test_rates'''
+        grid = list(itertools.product(relax_dates, contain_rates, test_rates))
+        return self.evaluate(*[list(values) for values in zip(*grid)])
+
+
+def get_scenario_summary(forecasts):
+    '''One row per scenario of evaluate: total predicted death and peaks of the daily death, beds and ICU, the
+    table behind a heatmap over scenarios'''
+    grouped = forecasts.groupby(level=SCENARIO_LEVELS, dropna=False)
+    summary = grouped.agg({'predicted_death': ['sum', 'max'], 'hospital_beds': 'max', 'ICU': 'max'})
+    summary.columns = ['total_death', 'peak_death', 'peak_hospital_beds', 'peak_ICU']
+    summary['peak_ICU_date'] = grouped['ICU'].idxmax().map(lambda index: index[-1])
+    return summary
+
+
+def get_scenario_sweep_by_country(country, forecast_horizon=60, lockdown_date=None, params=None):
+    return ScenarioSweep(mu.get_data_by_country(country, type='deaths'), forecast_horizon, lockdown_date,
+                         params=params)
+
+
+def get_scenario_sweep_by_state_US(state, forecast_horizon=60, lockdown_date=None, params=None):
+    return ScenarioSweep(mu.get_data_by_state(state, type='deaths'), forecast_horizon, lockdown_date, params=params)
@@ -0,0 +1,28 @@
+import numpy as np
+import pandas as pd
+import model_utils as mu
+import data_store as ds
+import batch_forecast as bf
+
+
+def get_data_store():
+    '''Store of two countries, one with an exponential death curve that flattens and one without any death'''
+    dates = pd.date_range('2020-03-01', periods=80)
+    days = np.arange(len(dates))
+    daily_death = np.where(days < 40, np.exp(0.15 * days), np.exp(0.15 * 40 - 0.05 * (days - 40)))
+    death = np.vstack([np.cumsum(np.round(daily_death)), np.zeros(len(dates))]).astype(int)
+    table = pd.DataFrame(death, columns=['{}/{}/{:%y}'.format(date.month, date.day, date) for date in dates])
+    table.insert(0, 'Country', ['Growing', 'Zero'])
+    table.insert(0, 'State', np.nan)
+    return ds.DataStore({'deaths': table})
+
+
+def test_forecast_all_zero_region(monkeypatch):
+    data_store = get_data_store()
+    monkeypatch.setattr(mu, 'get_data_store', lambda scope: data_store)
+    monkeypatch.setattr(mu, 'get_lockdown_date_global', lambda: pd.DataFrame(
+        {'lockdown_date': ['2020-03-22']}, index=pd.Index(['Growing'], name='country')))
+    forecasts, summary = bf.forecast_all('global', max_workers=1)
+    assert summary.loc['Zero', 'error'] == 'ValueError: Not enough fatality data to fit the death curve'
+    assert pd.isna(summary.loc['Growing', 'error'])
+    assert list(forecasts.index.unique('region')) == ['Growing']
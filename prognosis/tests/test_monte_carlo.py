@@ -0,0 +1,27 @@
+import datetime as dt
+import numpy as np
+import pandas as pd
+import model_utils as mu
+import monte_carlo as mc
+
+
+def get_death_data():
+    '''Cumulative death of an exponential curve over 60 days'''
+    dates = pd.date_range('2020-03-01', periods=60)
+    daily_death = np.round(np.exp(0.1 * np.arange(len(dates))) + np.arange(len(dates)) % 3)
+    return pd.DataFrame({'deaths': np.cumsum(daily_death)}, index=dates)
+
+
+def test_default_second_slope_is_not_sampled():
+    local_death_data = get_death_data()
+    params = mu.get_default_params()
+    delay = params.INFECT_2_HOSPITAL_TIME + params.HOSPITAL_2_ICU_TIME + params.ICU_2_DEATH_TIME
+    # Lockdown effective 2 days before the last data day, too early for a fit of the second slope
+    lockdown_date = local_death_data.index[-1] - dt.timedelta(delay + 2)
+    fit = mu.fit_log_daily_death(local_death_data, lockdown_date=lockdown_date)
+    regr_pw, data_end_date_idx = fit[0], fit[4]
+    branch = mu.get_model_branch(data_end_date_idx, 60)
+    assert branch == mu.DEFAULT_SECOND_MODEL
+    beta_samples = mc.get_beta_samples(regr_pw, branch, n_samples=500)
+    assert (beta_samples[:, 2] == mu.DEFAULT_SECOND_SLOPE).all()
+    assert (beta_samples[:, :2].std(axis=0) > 0).all()
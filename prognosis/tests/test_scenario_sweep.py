@@ -0,0 +1,25 @@
+import numpy as np
+import pandas as pd
+import pytest
+import model_utils as mu
+import scenario_sweep as ss
+
+
+def get_death_data():
+    '''Cumulative death of a curve that grows for 40 days and then declines'''
+    dates = pd.date_range('2020-03-01', periods=80)
+    days = np.arange(len(dates))
+    daily_death = np.where(days < 40, np.exp(0.15 * days), np.exp(0.15 * 40 - 0.05 * (days - 40)))
+    return pd.DataFrame({'deaths': np.cumsum(np.round(daily_death + days % 3))}, index=dates)
+
+
+@pytest.mark.parametrize('relax_date, contain_rate, test_rate', [(None, 0.5, 0.2), ('2020-05-01', 0.3, 0.1)])
+def test_log_fit_matches_pipeline(relax_date, contain_rate, test_rate):
+    local_death_data = get_death_data()
+    sweep = ss.ScenarioSweep(local_death_data, 60, '2020-03-22')
+    log_fit = sweep.get_log_fit(relax_date, contain_rate, test_rate)
+    predicted, lower_bound, upper_bound, _ = mu.get_log_daily_predicted_death(
+        local_death_data, 60, '2020-03-22', relax_date, contain_rate, test_rate)
+    np.testing.assert_allclose(log_fit.predicted_death.values, predicted.predicted_death.values, rtol=1e-12)
+    np.testing.assert_allclose(log_fit.lower_bound.values, lower_bound.lower_bound.values, rtol=1e-12)
+    np.testing.assert_allclose(log_fit.upper_bound.values, upper_bound.upper_bound.values, rtol=1e-12)